@@ -4,12 +4,15 @@ Performance testing script for FTrack. Tests the ftrack_api vs sqlalchemy vs
 MySQLdb performing similar queries.
 
 `setup_*` functions are run once and their corresponding `test_*` may be run
-multiple times to get timing averages.
+multiple times to get timing averages. Both are called with the same
+`TestContext`, on which the setup leaves what its tests need.
 """
 
 import time
 import timeit
+import itertools
 import gc
+import math
 
 global_data = dict(
     FTRACK_SERVER='http://ftrack.luma.ninja',
@@ -27,8 +30,146 @@ global_data = dict(
     SHOTS_PER_SEQUENCES=50,
     TASKS_PER_SHOT=5,
 
-    # whether to get the first or all results
-    RESULT_MODE='all'
+    # whether to get the 'first' or 'all' results, or to 'stream' all of
+    # them in chunks of STREAM_CHUNK_SIZE rows without keeping them
+    RESULT_MODE='all',
+    STREAM_CHUNK_SIZE='1000',
+    # RESULT_MODE='paged' (mysql_02, sqlalchemy_02 and ftrack_02) fetches
+    # the shots PAGE_SIZE at a time by 'offset' or 'keyset' PAGING, with
+    # PAGE_WORKERS connections at once (see fetch_pages)
+    PAGING='offset',
+    PAGE_SIZE='1000',
+    PAGE_WORKERS='1',
+
+    # how sqlalchemy_03/04 load the context of each shot: 'lazy' (one query
+    # per shot), 'joined', 'subquery' (not with RESULT_MODE='stream') or
+    # 'selectin'
+    SQLALCHEMY_LOADING='lazy',
+    # statements run at least this many times per run, and at least once
+    # per row the run returned, are reported as possible N+1 queries
+    N_PLUS_ONE_THRESHOLD='10',
+
+    # how the mysql_01/02 and sqlalchemy_01/02 'all' results hold their
+    # rows: 'default' (dicts for mysql, tuples for sqlalchemy_01 and Shot
+    # objects for sqlalchemy_02), 'tuple', 'dict', 'orm' (sqlalchemy only)
+    # or 'columnar' (see ColumnarResult)
+    MATERIALIZE='default',
+
+    # how mysql_01/02 pass the names into their sql: 'literal' (formatted
+    # into the text), 'bound' (driver parameters) or 'prepared' (server
+    # side PREPARE/EXECUTE), and whether sqlalchemy_01/02 'construct' and
+    # compile their query every run or reuse a 'baked' one. Streamed
+    # results always use the first
+    MYSQL_STATEMENTS='literal',
+    SQLALCHEMY_STATEMENTS='construct',
+
+    # how tests get their connections: 'cold', 'pooled' or 'persistent'
+    # (see ConnectionPool) and the size of the shared pools
+    CONNECTION_MODE='cold',
+    POOL_SIZE='5',
+
+    # entity cache of the ftrack sessions: 'session' (ftrack's default, a
+    # memory cache per session), 'memory' (shared by the sessions of the
+    # process, warm after the first run), 'file' (kept in FTRACK_CACHE_PATH
+    # between invocations) or 'shared' (served to every process, see --pool
+    # process). ftrack_01/02 also read the comma separated Shot
+    # FTRACK_ATTRIBUTES of each row: fetched lazily by auto-population, or
+    # selected by the query with FTRACK_AUTO_POPULATE='0'
+    FTRACK_CACHE='session',
+    FTRACK_CACHE_PATH='ftrack_cache.dbm',
+    FTRACK_AUTO_POPULATE='1',
+    FTRACK_ATTRIBUTES='',
+
+    # fanout_01/02 get the shots of every sequence of PROJECT_NAME, one
+    # query per sequence: one after another ('sequential'), from FANOUT_LIMIT
+    # threads ('threads') or with FANOUT_LIMIT queries in flight on
+    # non-blocking sockets in one thread ('async', see run_coroutines)
+    FANOUT_MODE='sequential',
+    FANOUT_LIMIT='8',
+
+    # read mirror (mirror_01/02/03): its sqlite file, rebuilt by each setup,
+    # where its ftrack.update events come from ('hub', the event hub of
+    # FTRACK_SERVER, or 'local', the journal of the local server, which
+    # --local switches to) and the event storm of mirror_03: shots renamed
+    # (and back) per run and renames per commit, i.e. per event
+    MIRROR_DB='perf_mirror.db',
+    MIRROR_EVENTS='hub',
+    MIRROR_STORM='1000',
+    MIRROR_STORM_BATCH='100',
+
+    # workload traces: the file trace_generate writes and replay_01 plays,
+    # how replay_01 runs sql operations ('mysql', raw cursors, or
+    # 'sqlalchemy') and its speed ('1' as recorded, '10' ten times faster,
+    # '0' as fast as possible). trace_generate writes TRACE_OPERATIONS
+    # 'ftrack' or 'sql' (TRACE_BACKEND) operations arriving at TRACE_RATE
+    # per second from TRACE_STREAMS clients, TRACE_WRITES of them writes and
+    # the reads Zipf skewed by TRACE_ZIPF, from random seed TRACE_SEED
+    TRACE_PATH='perf_trace.jsonl.gz',
+    TRACE_SQL='mysql',
+    TRACE_SPEED='1',
+    TRACE_BACKEND='ftrack',
+    TRACE_OPERATIONS='1000',
+    TRACE_RATE='50',
+    TRACE_STREAMS='4',
+    TRACE_WRITES='0.05',
+    TRACE_ZIPF='1.1',
+    TRACE_SEED='0',
+
+    # sqlite file and port used by the local stand-in backend (see --local)
+    LOCAL_DB='perf_local.db',
+    LOCAL_PORT='8765',
+
+    # simulated WAN link of --wan: one-way latency and its jitter (ms),
+    # bandwidth each way (kB/s, 0 for unlimited), fraction of TCP segments
+    # lost and the retransmission timeout (ms) after which they arrive
+    WAN_LATENCY_MS='40',
+    WAN_JITTER_MS='5',
+    WAN_BANDWIDTH_KBPS='0',
+    WAN_LOSS='0',
+    WAN_RTO_MS='200',
+
+    # fixture loading with setup/cleanup and bulk_seed/bulk_setup: rows (or
+    # entities) per insert batch or commit, or 'auto' for the ftrack loaders
+    # to size commits so the round-trip is BULK_RTT_SHARE of each (see
+    # CommitBatcher), bulk_seed's 'executemany' or 'load_data' method, the
+    # number of ftrack sessions used and retries of a failed project (or
+    # sequence)
+    BULK_BATCH_SIZE='5000',
+    BULK_METHOD='executemany',
+    BULK_WORKERS='4',
+    BULK_RETRIES='2',
+    BULK_RTT_SHARE='0.1',
+
+    # sqlite database every run is recorded in, and when --compare reports a
+    # regression: p-value below COMPARE_ALPHA and a median more than
+    # COMPARE_THRESHOLD (fraction) slower than the baseline's
+    HISTORY_DB='perf_history.db',
+    COMPARE_ALPHA='0.05',
+    COMPARE_THRESHOLD='0.05',
+
+    # seconds between stack samples of the sampling profiler (see --profile)
+    PROFILE_INTERVAL='0.001',
+
+    # read-through cache benchmark (cache_01): the backend behind the
+    # cache, its entries and seconds to live, whether ftrack_api commits
+    # invalidate it ('1'), and the replayed pattern: number of requests,
+    # Zipf exponent of their skew, fraction of writes and random seed
+    QUERY_CACHE_BACKEND='mysql',
+    QUERY_CACHE_SIZE='128',
+    QUERY_CACHE_TTL='60',
+    QUERY_CACHE_INVALIDATE='1',
+    QUERY_CACHE_REQUESTS='1000',
+    QUERY_CACHE_ZIPF='1.1',
+    QUERY_CACHE_WRITES='0',
+    QUERY_CACHE_SEED='0',
+
+    # cold start suite (startup_01): modules whose import is timed, the
+    # FTRACK_EVENT_PLUGIN_PATH configurations a first session is built with
+    # ('empty', 'environment', 'generated' or a path list) and the number of
+    # plugins written for 'generated'
+    STARTUP_MODULES='ftrack_api,sqlalchemy,MySQLdb',
+    STARTUP_PLUGIN_PATHS='empty,environment,generated',
+    STARTUP_PLUGINS='50'
 )
 
 
@@ -36,571 +177,7557 @@ global_data = dict(
 # Utils
 
 
-def echox(cmd, time_update_char='# -update', verbose=True,
-          print_comments=True):
+class TestContext(object):
     """
-    Print and execute a string command optionally printing the times various
-    chunks of code took to execute.
+    Namespace shared by a test's setup and all of its runs.
 
-    NOTE: all code is executed in the global namespace!
+    ``setup_<backend>(ctx)`` stores whatever its tests need (models, helpers)
+    as attributes, and every ``test_<backend>_<NN>(ctx)`` run gets the same
+    object.
+    """
+
+    def __repr__(self):
+        return '<TestContext {0}>'.format(', '.join(sorted(vars(self))))
+
+
+def sample_runs(func, setup=None, number=1, warmup=0, start_run=None,
+                end_run=None):
+    """
+    Like ``timeit.Timer(stmt, setup).timeit(number)`` but return the time of
+    each run instead of the total.
 
     Parameters
     ----------
-    cmd : str
-        Command to execute. e.g. 'import time; time.sleep(2)'
-    time_update_char : str
-        String found in code to print timing updates.
-    verbose : bool
-        If True, print timing updates at each `time_update_char` found in
-        `cmd`.
-    print_comments : bool
-        Skip over comments lines (ones that begin with '#').
+    func : callable
+        Called with a `TestContext` for every run.
+    setup : callable
+        Called once with the same `TestContext`, before the warmup runs.
+    number : int
+        Number of timed runs.
+    warmup : int
+        Number of runs executed before the timed ones and discarded.
+    start_run : callable
+        Called before each (warmup or timed) run, outside the timed region.
+    end_run : callable
+        Called with the seconds taken after each run, outside the timed
+        region.
+
+    Returns
+    -------
+    list of float
+        Seconds taken by each of the `number` timed runs.
     """
+    ctx = TestContext()
+    if setup is not None:
+        setup(ctx)
+    start_run = start_run or (lambda: None)
+    end_run = end_run or (lambda elapsed: None)
+    timer = timeit.default_timer
+
+    samples = []
+    gcold = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in xrange(warmup + number):
+            start_run()
+            t0 = timer()
+            func(ctx)
+            elapsed = timer() - t0
+            samples.append(elapsed)
+            end_run(elapsed)
+    finally:
+        if gcold:
+            gc.enable()
+    return samples[warmup:]
+
+
+def _empty_test(ctx):
+    pass
+
+
+def calibrate_overhead(repeats=10000, batches=5):
+    """
+    Measure the harness's own cost.
+
+    A single empty run is too quick for the timer to resolve, so each cost
+    is the median over `batches` of the mean of `repeats` calls.
 
-    for chunk in cmd.split(time_update_char):
+    Returns
+    -------
+    tuple
+        (run, phase): seconds every `sample_runs` sample includes on top of
+        the test itself (calling it and reading the timer), and the cost of
+        entering and leaving one `PhaseTimer` phase.
+    """
+    timer = timeit.default_timer
+    ctx = TestContext()
+    spans = PhaseTimer()
+    spans.start_run()
+
+    def cost(body):
+        means = []
+        for _ in xrange(batches):
+            start = timer()
+            for _ in xrange(repeats):
+                body()
+            means.append((timer() - start) / repeats)
+        return percentile(means, 50)
+
+    def empty_phase():
+        with spans('calibrate'):
+            pass
+
+    run = cost(lambda: (timer(), _empty_test(ctx), timer())) - \
+        cost(lambda: timer())
+    span = cost(empty_phase) - cost(lambda: None)
+    return max(run, 0.0), max(span, 0.0)
+
+
+def format_run(label, elapsed, spans):
+    """
+    Return human readable lines for one run and its phase `spans` (list of
+    phase path, seconds), as printed by `run_test` in verbose mode.
+    """
+    lines = ['{0}: {1:0.6f} s'.format(label, elapsed)]
+    for path, seconds in spans:
+        lines.append('  {0:<32} {1:0.6f} s'.format(path, seconds))
+    return '\n'.join(lines)
 
-        chunk = chunk.lstrip().rstrip()
 
-        if verbose:
-            print
-            start = time.time()
+def run_test(func, setup=None, number=1, warmup=0, verbose=False,
+             calibrate=True, profiler=None):
+    """
+    Time `number` runs of the test callable `func`.
 
-        lines = []
-        for line in chunk.split('\n'):
-            if verbose:
-                if not print_comments and line.startswith('#'):
-                    continue
-                print '>>> {0}'.format(line)
-                lines.append(line)
-            else:
-                # remove print statements if we're not in verbose mode
-                if line.startswith('print'):
-                    continue
-                lines.append(line)
+    `setup` and `func` are called directly (see `sample_runs`). Connections
+    are released and memory, phases and sql statements are recorded around
+    every run, outside the timed region.
 
-        exec('\n'.join(lines), globals())
+    Parameters
+    ----------
+    func : callable
+        Test taking a `TestContext`.
+    setup : callable or None
+        Called once with the `TestContext` before the runs.
+    number : int
+        Number of times to run `func`.
+    warmup : int
+        Number of extra, untimed runs of `func` before the timed ones.
+    verbose : bool
+        If True, print the time and phases of every run as it finishes.
+    calibrate : bool
+        If True, subtract the harness overhead measured by
+        `calibrate_overhead` from every sample.
+    profiler : TestProfiler
+        If given, profiles the timed runs (not `setup` or the warmup runs).
 
+    Returns
+    -------
+    tuple
+        (samples, overhead): the seconds of each of the `number` runs, and
+        the (run, phase) overhead in seconds that was measured (zeros
+        without `calibrate`).
+    """
+    overhead = calibrate_overhead() if calibrate else (0.0, 0.0)
+    run_number = [-warmup]
+
+    def start_run():
+        release_connections()
+        phase.start_run()
+        memory.start_run()
+        statements.start_run()
+        ftrack_requests.start_run()
+        if run_number[0] >= 0:
+            traces.start_run()
+        imports.start_run()
+        if profiler is not None:
+            profiler.enabled = run_number[0] >= 0
+
+    def end_run(elapsed):
+        statements.end_run()
+        ftrack_requests.end_run()
+        if run_number[0] >= 0:
+            traces.end_run()
+        memory.end_run()
+        run_number[0] += 1
         if verbose:
-            print '{0:0.6f} s'.format(time.time() - start)
+            spans = sorted(phase.runs[-1].items(),
+                           key=lambda item: phase._order[item[0]])
+            label = 'run {0}'.format(run_number[0]) \
+                if run_number[0] > 0 else 'warmup'
+            print format_run(label, elapsed - overhead[0], spans)
+
+    first_run = len(phase.runs)
+    first_profile = len(memory.type_growth)
+    first_statements = len(statements.runs)
+    first_imports = len(imports.runs)
+    if profiler is not None:
+        func = profiler.wrap(func)
+        phase.profiler = profiler
+    try:
+        samples = sample_runs(func, setup=setup, number=number,
+                              warmup=warmup, start_run=start_run,
+                              end_run=end_run)
+    finally:
+        phase.profiler = None
+    # phases of the warmup runs are discarded like their timings
+    phase.discard(first_run, warmup)
+    memory.discard(first_profile, warmup)
+    statements.discard(first_statements, warmup)
+    imports.discard(first_imports, warmup)
+    return [max(x - overhead[0], 0.0) for x in samples], overhead
+
+
+class PhaseTimer(object):
+    """
+    Records named, possibly nested, phases of each test run.
+
+    Tests wrap the interesting parts of their body in a phase::
+
+        with phase('connect'):
+            with phase('create_engine'):
+                engine = create_engine(global_data['DB_URI'])
+
+    Nested phases are recorded by their path, e.g. 'connect/create_engine'.
+    Each phase only costs a couple of timer calls (see `calibrate_overhead`).
+
+    Other per-run measurements (row counts, memory, ...) can be stored with
+    `record`.
+
+    Attributes
+    ----------
+    runs : list of dict
+        For each run, phase path -> seconds spent in it.
+    values : list of dict
+        For each run, name -> value passed to `record`.
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.values = []
+        # a TestProfiler told when phases start and end, if any
+        self.profiler = None
+        self._stack = []
+        # path -> order in which it was first entered
+        self._order = {}
+
+    def start_run(self):
+        self.runs.append({})
+        self.values.append({})
+        del self._stack[:]
+
+    def discard(self, first, count):
+        """
+        Forget `count` runs starting at index `first`, e.g. warmup runs.
+        """
+        del self.runs[first:first + count]
+        del self.values[first:first + count]
+
+    def record(self, name, value):
+        """
+        Store a measurement `value` for the current run.
+        """
+        if self.values:
+            self.values[-1][name] = value
+
+    def __call__(self, name):
+        return _Phase(self, name)
+
+    def summarize(self, run_mean=None):
+        """
+        Return phase path -> statistics of the time per run spent in it,
+        in the order the phases were first entered.
+
+        Parameters
+        ----------
+        run_mean : float
+            Mean run time, used to compute each phase's share of a run.
+        """
+        import collections
+
+        paths = set()
+        for run in self.runs:
+            paths.update(run)
+
+        result = collections.OrderedDict()
+        for path in sorted(paths, key=self._order.get):
+            values = [run.get(path, 0.0) for run in self.runs]
+            mean = sum(values) / len(values)
+            result[path] = collections.OrderedDict([
+                ('mean', mean),
+                ('median', percentile(values, 50)),
+                ('max', max(values)),
+                ('share', mean / run_mean if run_mean else float('nan')),
+            ])
+        return result
+
+    def summarize_values(self):
+        """
+        Return name -> mean/median/max of the values recorded per run.
+        """
+        import collections
+
+        names = set()
+        for run in self.values:
+            names.update(run)
+
+        result = collections.OrderedDict()
+        for name in sorted(names):
+            values = [run[name] for run in self.values if name in run]
+            result[name] = collections.OrderedDict([
+                ('mean', float(sum(values)) / len(values)),
+                ('median', percentile(values, 50)),
+                ('max', max(values)),
+            ])
+        return result
+
+
+class _Phase(object):
+
+    __slots__ = ('timer', 'name', 'path', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        stack = self.timer._stack
+        stack.append(self.name)
+        self.path = '/'.join(stack)
+        self.timer._order.setdefault(self.path, len(self.timer._order))
+        if self.timer.profiler is not None:
+            self.timer.profiler.enter(self.path)
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *exc_info):
+        elapsed = timeit.default_timer() - self.start
+        self.timer._stack.pop()
+        if self.timer.runs:
+            run = self.timer.runs[-1]
+            run[self.path] = run.get(self.path, 0.0) + elapsed
+        if self.timer.profiler is not None:
+            self.timer.profiler.exit(self.path)
+
+
+# shared by all tests, see `PhaseTimer`
+phase = PhaseTimer()
+
+
+def format_phases(phases):
+    """
+    Return a human readable table of `PhaseTimer.summarize` output.
+    """
+    lines = ['phases (per run):']
+    for path, stats in phases.items():
+        lines.append('  {0:<32} mean {1[mean]:06f} median {1[median]:06f} '
+                     'max {1[max]:06f} {2:5.1f}%'.format(
+                         '  ' * path.count('/') + path.split('/')[-1],
+                         stats, stats['share'] * 100))
+    return '\n'.join(lines)
+
+
+def format_values(values):
+    """
+    Return a human readable table of `PhaseTimer.summarize_values` output.
+    """
+    lines = ['values (per run):']
+    for name, stats in values.items():
+        lines.append('  {0:<32} mean {1[mean]:.6g} median {1[median]:.6g} '
+                     'max {1[max]:.6g}'.format(name, stats))
+    return '\n'.join(lines)
+
+
+def _proc_status():
+    # memory fields of /proc/self/status in kB, empty if unavailable
+    try:
+        with open('/proc/self/status') as f:
+            return dict((line.split(':')[0], int(line.split()[1]))
+                        for line in f if line.startswith('Vm'))
+    except (IOError, ValueError, IndexError):
+        return {}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (VmHWM), where the
+    platform allows it (linux), and return the current RSS in kB or None.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return None
+    return _proc_status().get('VmRSS')
+
+
+def connection_sizes():
+    """
+    Return name -> number of objects held by the connections the current
+    thread acquired: the entities in an ftrack_api session cache.
+
+    A sqlalchemy session identity map only holds weak references, so it is
+    already empty once the test has returned and dropped its rows.
+    """
+    sizes = {}
+    for (backend, _, _, _), pool in _connection_pools.items():
+        conn = pool.current()
+        if conn is not None and backend == 'ftrack':
+            sizes['ftrack_cache_entries'] = len(conn.cache.keys())
+    return sizes
+
+
+class MemoryMonitor(object):
+    """
+    Records the memory use of each run as `PhaseTimer` values.
+
+    Values
+    ------
+    peak_rss_kb
+        Peak resident set size reached during the run, above the RSS at its
+        start.
+    rss_growth_kb
+        RSS at the end of the run minus the RSS at its start.
+    gc_allocations
+        Net number of gc tracked objects (containers) allocated by the run.
+    gc_objects_left
+        Gc tracked objects still alive after the run, e.g. cached entities.
+    gc_cycles_freed
+        Unreachable objects in reference cycles the run left for the
+        collector.
+    ftrack_cache_entries
+        Size of the session cache of the run's ftrack connection.
+
+    Runs are timed with the garbage collector disabled, as ``timeit`` does,
+    so a full collection is made outside the timed region before and after
+    each run.
+
+    Attributes
+    ----------
+    profile : bool
+        Also count the live objects per type before and after each run. This
+        walks every object so is off by default.
+    type_growth : list of dict
+        With `profile`, for each run type name -> growth in live objects.
+    """
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.type_growth = []
+        self._start = None
+
+    @staticmethod
+    def _type_counts():
+        import collections
+        counts = collections.defaultdict(int)
+        for obj in gc.get_objects():
+            counts[type(obj).__name__] += 1
+        return counts
+
+    def start_run(self):
+        gc.collect()
+        self._start = dict(
+            rss=reset_peak_rss(),
+            objects=len(gc.get_objects()),
+            types=self._type_counts() if self.profile else None,
+        )
+        # count allocations from here on
+        gc.collect()
+
+    def end_run(self):
+        start = self._start
+        allocations = gc.get_count()[0]
+        status = _proc_status()
+        if start['rss'] is not None:
+            phase.record('peak_rss_kb', status['VmHWM'] - start['rss'])
+            phase.record('rss_growth_kb', status['VmRSS'] - start['rss'])
+        # the count drops back when the test collects garbage itself
+        phase.record('gc_allocations', allocations)
+        for name, size in connection_sizes().items():
+            phase.record(name, size)
+        phase.record('gc_cycles_freed', gc.collect())
+        phase.record('gc_objects_left',
+                     len(gc.get_objects()) - start['objects'])
+        if self.profile:
+            counts = self._type_counts()
+            types = start['types']
+            self.type_growth.append(dict(
+                (name, counts.get(name, 0) - types.get(name, 0))
+                for name in set(counts) | set(types)
+                if counts.get(name, 0) != types.get(name, 0)))
+
+    def discard(self, first, count):
+        """
+        Forget the type growth of `count` runs from index `first`.
+        """
+        del self.type_growth[first:first + count]
+
+    def summarize_types(self, limit=None):
+        """
+        Return a list of (type name, mean growth per run, total growth) with
+        the largest growth first.
+        """
+        import collections
+        totals = collections.defaultdict(int)
+        for run in self.type_growth:
+            for name, growth in run.items():
+                totals[name] += growth
+        runs = len(self.type_growth) or 1
+        result = sorted(((name, float(total) / runs, total)
+                         for name, total in totals.items() if total),
+                        key=lambda item: -abs(item[2]))
+        return result[:limit]
+
+
+memory = MemoryMonitor()
+
+
+def format_types(types):
+    """
+    Return a human readable table of `MemoryMonitor.summarize_types` output.
+    """
+    lines = ['live objects by type (growth per run):']
+    for name, mean, total in types:
+        lines.append('  {0:<32} {1:+.1f} (total {2:+d})'.format(
+            name, mean, total))
+    return '\n'.join(lines)
+
+
+def write_memory_profile(path, name, types):
+    """
+    Write the per-type growth in live objects of a test to `path` as json.
+    """
+    import json
+    with open(path, 'w') as f:
+        json.dump(dict(test=name, runs=len(memory.type_growth),
+                       types=[dict(type=type_name, per_run=mean, total=total)
+                              for type_name, mean, total in types],
+                       per_run=memory.type_growth),
+                  f, indent=2)
+
+
+class TestProfiler(object):
+    """
+    Profiles the timed runs of a test, per phase.
+
+    `deterministic` profiling uses cProfile, with a separate profile for the
+    code outside any phase and for each phase path, so pstats can be written
+    for the whole test and for every phase. `sampling` profiling reads the
+    stack of the thread running the test every `interval` seconds from a
+    separate thread, which includes time spent waiting on the network, and
+    gives flamegraph ready collapsed stacks.
+
+    Both can be used at once, but the sampled stacks then include
+    cProfile's overhead, which inflates code making many calls.
+
+    Only calls of the function returned by `wrap` are profiled, and only
+    while `enabled`, so setup and warmup runs are left out.
+    """
+
+    def __init__(self, deterministic=True, sampling=True, interval=0.001):
+        import collections
+        self.deterministic = deterministic
+        self.sampling = sampling
+        self.interval = interval
+        self.enabled = False
+        # phase path ('' outside any phase) -> cProfile.Profile
+        self.profiles = {}
+        # (phase path, stack) -> number of samples
+        self.samples = collections.defaultdict(int)
+        self._paths = []
+        self._wrapper = None
+        self._ident = None
+        self._running = None
+
+    def wrap(self, func):
+        """
+        Return `func` wrapped so its calls are profiled while `enabled`.
+        """
+        def profiled(ctx):
+            if not self.enabled:
+                return func(ctx)
+            self._start()
+            try:
+                return func(ctx)
+            finally:
+                self._stop()
+        self._wrapper = profiled.func_code
+        return profiled
+
+    def _profile(self, path):
+        import cProfile
+        if path not in self.profiles:
+            self.profiles[path] = cProfile.Profile()
+        return self.profiles[path]
+
+    def _start(self):
+        import threading
+        self._paths = ['']
+        if self.sampling:
+            self._ident = threading.current_thread().ident
+            if self._running is None:
+                self._running = threading.Event()
+                sampler = threading.Thread(target=self._sample_loop)
+                sampler.daemon = True
+                sampler.start()
+            self._running.set()
+        if self.deterministic:
+            self._profile('').enable()
+
+    def _stop(self):
+        if self.deterministic:
+            self._profile(self._paths[-1]).disable()
+        if self.sampling:
+            self._running.clear()
+        self._paths = []
+
+    def enter(self, path):
+        """
+        Called by `PhaseTimer` when a phase starts.
+        """
+        if not self._paths:
+            return
+        if self.deterministic:
+            self._profile(self._paths[-1]).disable()
+            self._profile(path).enable()
+        self._paths.append(path)
+
+    def exit(self, path):
+        """
+        Called by `PhaseTimer` when a phase ends.
+        """
+        if len(self._paths) < 2:
+            return
+        self._paths.pop()
+        if self.deterministic:
+            self._profile(path).disable()
+            self._profile(self._paths[-1]).enable()
+
+    def _sample_loop(self):
+        import os
+        import sys
+        while True:
+            self._running.wait()
+            frame = sys._current_frames().get(self._ident)
+            path = self._paths[-1] if self._paths else None
+            stack = []
+            while frame is not None and frame.f_code is not self._wrapper:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            del frame
+            # only count samples taken inside the test
+            if path is not None and stack:
+                self.samples[(path, tuple(reversed(stack)))] += 1
+            time.sleep(self.interval)
+
+    def stats(self, path=None):
+        """
+        Return pstats.Stats of the whole test, or of phase `path` including
+        its nested phases, or None if nothing was profiled.
+        """
+        import pstats
+        profiles = []
+        for key, profile in sorted(self.profiles.items()):
+            if path is None or key == path or key.startswith(path + '/'):
+                profile.create_stats()
+                if profile.stats:
+                    profiles.append(profile)
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
+
+    def collapsed(self, path=None):
+        """
+        Return the samples in the collapsed stack format of flamegraph.pl,
+        one 'frame;frame;... count' line per stack.
+
+        For the whole test the phases are the root frames, for a phase
+        `path` (including nested phases) the stacks start at the test.
+        """
+        import collections
+        counts = collections.defaultdict(int)
+        for (key, stack), count in self.samples.items():
+            if path is None:
+                frames = ['[{0}]'.format(part)
+                          for part in key.split('/') if part] + list(stack)
+            elif key == path or key.startswith(path + '/'):
+                frames = list(stack)
+            else:
+                continue
+            counts[';'.join(frames)] += count
+        return ''.join('{0} {1}\n'.format(stack, count)
+                       for stack, count in sorted(counts.items()))
+
+    def hot_functions(self, limit=15):
+        """
+        Return (function, own seconds or samples, calls) of the functions
+        with the most time spent in themselves, from the cProfile stats if
+        there are any and the samples' leaf frames otherwise.
+        """
+        import collections
+        import os
+        stats = self.stats()
+        if stats is not None:
+            rows = [('{2} ({0}:{1})'.format(os.path.basename(func[0]),
+                                            func[1], func[2]), tt, nc)
+                    for func, (cc, nc, tt, ct, callers)
+                    in stats.stats.items()]
+        else:
+            leaves = collections.defaultdict(int)
+            for (_, stack), count in self.samples.items():
+                leaves[stack[-1]] += count
+            rows = [(name, count, None) for name, count in leaves.items()]
+        return sorted(rows, key=lambda row: -row[1])[:limit]
+
+    def write(self, directory, name):
+        """
+        Write '<name>.pstats' and '<name>.collapsed' for the whole test, and
+        '<name>.<phase>.pstats'/'.collapsed' for every phase to `directory`.
+
+        Returns
+        -------
+        list of str
+            The files written.
+        """
+        import os
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = set(self.profiles) | set(key for key, _ in self.samples)
+        paths.discard('')
+        written = []
+        for path in [None] + sorted(paths):
+            base = os.path.join(directory, name if path is None else
+                                '{0}.{1}'.format(name,
+                                                 path.replace('/', '.')))
+            stats = self.stats(path) if self.deterministic else None
+            if stats is not None:
+                stats.dump_stats(base + '.pstats')
+                written.append(base + '.pstats')
+            if self.sampling:
+                with open(base + '.collapsed', 'w') as f:
+                    f.write(self.collapsed(path))
+                written.append(base + '.collapsed')
+        return written
+
+
+def format_hot_functions(rows, sampled=False):
+    """
+    Return a human readable table of `TestProfiler.hot_functions` output.
+    """
+    lines = ['hot functions ({0}):'.format(
+        'samples' if sampled else 'own time, calls')]
+    for name, own, calls in rows:
+        if sampled:
+            lines.append('  {0:>8}  {1}'.format(own, name))
+        else:
+            lines.append('  {0:9.6f}s {1:>8}  {2}'.format(own, calls, name))
+    return '\n'.join(lines)
 
 
-def execx(stmts='pass', setup='pass', number=1, verbose=False,
-          time_update_char='# -update', print_comments=True):
+def percentile(values, q):
     """
-    Entry point for timing a callable. This extracts the source code from the
-    passed `stmt` or `setup` callables and execute it using ``timeit``.
+    Return the `q`th percentile (0-100) of `values`, interpolating linearly
+    between the closest ranks.
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    rank = (len(values) - 1) * q / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
 
-    See ``timeit.Timer`` for more details about timing.
+def bootstrap_ci(values, statistic=None, confidence=95.0, resamples=1000,
+                 seed=0):
+    """
+    Return a (low, high) bootstrap confidence interval of `statistic`.
 
     Parameters
     ----------
-    stmts : callable or 'pass' or iterable of
-        Callables to exceute `number` of times.
-    setup : callable or 'pass'
-        Callable for initial setup. Called once.
-    number : int
-        Number of times to execute `stmt`.
-    verbose : bool
-        If True, print timing updates at each `time_update_char`.
-    time_update_char : str
-        String found in code to print timing updates.
-    print_comments : bool
-        Skip over comments lines (ones that begin with '#'). Only used if
-        `verbose` is True.
+    values : list of float
+    statistic : callable
+        Function of a list of values. Defaults to the median.
+    confidence : float
+        Interval width in percent.
+    resamples : int
+        Number of bootstrap resamples.
+    seed : int
+        Seed for the resampling so reports are reproducible.
+    """
+    import random
+
+    if statistic is None:
+        statistic = lambda x: percentile(x, 50)
+    if len(values) < 2:
+        value = statistic(values) if values else float('nan')
+        return value, value
+    rng = random.Random(seed)
+    n = len(values)
+    estimates = [statistic([values[rng.randrange(n)] for _ in xrange(n)])
+                 for _ in xrange(resamples)]
+    tail = (100.0 - confidence) / 2
+    return percentile(estimates, tail), percentile(estimates, 100 - tail)
+
+
+def summarize_samples(samples):
+    """
+    Return summary statistics for per-run timing `samples`.
+
+    Outliers are the indices of runs outside Tukey's fences (1.5 times the
+    inter-quartile range beyond the quartiles).
 
     Returns
     -------
-    float
-        *Total* time to execute in seconds.
+    collections.OrderedDict
     """
+    import collections
+    import math
+
+    n = len(samples)
+    mean = sum(samples) / n if n else float('nan')
+    stddev = math.sqrt(sum((x - mean) ** 2 for x in samples) / (n - 1)) \
+        if n > 1 else 0.0
+    q1, q3 = percentile(samples, 25), percentile(samples, 75)
+    fence = 1.5 * (q3 - q1)
+    ci_low, ci_high = bootstrap_ci(samples)
+    return collections.OrderedDict([
+        ('runs', n),
+        ('total', sum(samples)),
+        ('mean', mean),
+        ('min', min(samples) if n else float('nan')),
+        ('median', percentile(samples, 50)),
+        ('p90', percentile(samples, 90)),
+        ('p99', percentile(samples, 99)),
+        ('max', max(samples) if n else float('nan')),
+        ('stddev', stddev),
+        ('median_ci_low', ci_low),
+        ('median_ci_high', ci_high),
+        ('outliers', [i for i, x in enumerate(samples)
+                      if x < q1 - fence or x > q3 + fence]),
+    ])
+
+
+def format_summary(name, summary):
+    """
+    Return a one line human readable version of `summarize_samples` output.
+    """
+    return ('{0}: min {1[min]:06f} median {1[median]:06f} '
+            '(95% CI {1[median_ci_low]:06f}-{1[median_ci_high]:06f}) '
+            'p90 {1[p90]:06f} p99 {1[p99]:06f} stddev {1[stddev]:06f} '
+            'outliers {2}'.format(name, summary, len(summary['outliers'])))
 
-    def convert_to_str(func):
-        if isinstance(func, basestring):
-            return func
-        import inspect
 
-        lines = inspect.getsourcelines(func)[0]
+def write_results(path, name, samples, summary, warmup=0, phases=None,
+                  values=None, statements=None, imports=None):
+    """
+    Write the samples and summary of a test to `path`.
 
-        # remove func definition from lines
-        for i, x in enumerate(lines):
-            lines.pop(i)
-            if '):' in x:
-                break
+    A '.csv' path gets one row per run, anything else a json document that
+    also contains the summary, the `phases`, the recorded `values`, the
+    executed sql `statements`, the module `imports` and the global data used.
+    """
+    import json
+
+    outliers = set(summary['outliers'])
+    if path.endswith('.csv'):
+        import csv
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['test', 'run', 'seconds', 'outlier'])
+            for i, sample in enumerate(samples):
+                writer.writerow([name, i, repr(sample), int(i in outliers)])
+        return
+
+    with open(path, 'w') as f:
+        json.dump(dict(test=name, warmup=warmup, samples=samples,
+                       summary=summary, phases=phases or {},
+                       values=values or {},
+                       statements=statements or {},
+                       imports=imports or [],
+                       global_data=_public_global_data()),
+                  f, indent=2)
+
+
+class _LoadSchedule(object):
+    """
+    Iterator handing out runs to the workers of a load test.
 
-        # strip doc strings out
-        if func.__doc__:
-            lines = lines[len(func.__doc__.split('\n')):]
+    Each worker's first ``next`` marks it as ready and blocks until every
+    worker has finished its setup. After that runs are handed out until
+    `duration` seconds have passed or the shared `remaining` count of
+    requests is used up.
+    """
 
-        # fix indentation
-        for line in lines:
-            if line and line != '\n':
-                break
-        indent = len(line) - len(line.lstrip())
-        lines = [x[indent:] if len(x) >= indent else x for x in lines]
-        lines.insert(0, 'from __main__ import global_data\n')
-        return ''.join(lines)
-
-    def wrap(func):
-        if func == 'pass':
-            return func
-        code = convert_to_str(func)
-        if verbose:
-            return lambda cmd=code: \
-                echox(cmd, time_update_char=time_update_char,
-                      print_comments=print_comments)
+    def __init__(self, ready, start, duration=None, remaining=None):
+        self.ready = ready
+        self.start = start
+        self.duration = duration
+        self.remaining = remaining
+        self.deadline = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.deadline is None:
+            self.ready.release()
+            self.start.wait()
+            self.deadline = time.time() + (self.duration or float('inf'))
+        if time.time() >= self.deadline:
+            raise StopIteration
+        if self.remaining is not None:
+            with self.remaining.get_lock():
+                if self.remaining.value <= 0:
+                    raise StopIteration
+                self.remaining.value -= 1
+        return None
+
+
+def run_load(func, setup=None, workers=1, pool='thread', duration=None,
+             requests=None):
+    """
+    Run the test `func` from `workers` concurrent threads or processes.
+
+    Every worker calls `setup` once with its own `TestContext` and then runs
+    `func` in a loop; failed runs are counted instead of stopping the worker.
+    The clock starts when all workers finished their setup and stops after
+    `duration` seconds or once `requests` runs were started in total.
+
+    Parameters
+    ----------
+    func : callable
+    setup : callable or None
+    workers : int
+    pool : {'thread', 'process'}
+    duration : float
+    requests : int
+        Used when no `duration` is given.
+
+    Returns
+    -------
+    collections.OrderedDict
+        workers, requests, errors, elapsed, throughput (requests/s) and
+        latency mean/p50/p90/p99/max in seconds.
+    """
+    import collections
+    import multiprocessing
+    import threading
+
+    ready = multiprocessing.Semaphore(0)
+    start = multiprocessing.Event()
+    remaining = None if duration else multiprocessing.Value('l', requests)
+    queue = multiprocessing.Queue()
+    results = []
+
+    def worker():
+        samples = []
+        errors = []
+        ctx = TestContext()
+        try:
+            if setup is not None:
+                setup(ctx)
+        except Exception as error:
+            # make sure the other workers are not held up
+            errors.append(repr(error))
+            ready.release()
+        else:
+            # the start time of each run is kept to compute throughput
+            for _ in _LoadSchedule(ready, start, duration, remaining):
+                release_connections()
+                traces.start_run()
+                t0 = time.time()
+                try:
+                    func(ctx)
+                except Exception as error:
+                    errors.append(repr(error))
+                    continue
+                finally:
+                    traces.end_run()
+                samples.append((t0, time.time() - t0))
+        if pool == 'process':
+            queue.put((samples, errors))
         else:
-            # use only timeit
-            return code
+            results.append((samples, errors))
+
+    if pool == 'process':
+        runners = [multiprocessing.Process(target=worker)
+                   for _ in range(workers)]
+    else:
+        runners = [threading.Thread(target=worker) for _ in range(workers)]
+    for runner in runners:
+        runner.daemon = True
+        runner.start()
+    for _ in range(workers):
+        ready.acquire()
+    started = time.time()
+    start.set()
+    if pool == 'process':
+        # drain the queue before joining so large results can't block
+        results = [queue.get() for _ in runners]
+    for runner in runners:
+        runner.join()
+
+    samples = [x for result in results for x in result[0]]
+    errors = [x for result in results for x in result[1]]
+    latencies = [x[1] for x in samples]
+    finished = max([x[0] + x[1] for x in samples] or [started])
+    elapsed = max(finished - started, 1e-9)
+    return collections.OrderedDict([
+        ('workers', workers),
+        ('pool', pool),
+        ('requests', len(samples)),
+        ('errors', len(errors)),
+        ('elapsed', elapsed),
+        ('throughput', len(samples) / elapsed),
+        ('mean', sum(latencies) / len(latencies)
+            if latencies else float('nan')),
+        ('p50', percentile(latencies, 50)),
+        ('p90', percentile(latencies, 90)),
+        ('p99', percentile(latencies, 99)),
+        ('max', max(latencies or [float('nan')])),
+        ('first_error', errors[0] if errors else ''),
+    ])
+
+
+def load_curve(name, test_func, setup_func, worker_counts, pool='thread',
+               duration=None, requests=None):
+    """
+    Run a load test of `test_func` for each of `worker_counts`, printing a
+    summary line for each.
 
-    if not isinstance(stmts, (list, tuple)):
-        stmts = [stmts]
+    The test's output is discarded while the load runs.
 
-    setup = wrap(setup)
+    Returns
+    -------
+    list of collections.OrderedDict
+        `run_load` result for each worker count, i.e. the saturation curve.
+    """
+    import os
+    import sys
+
+    curve = []
+    for workers in worker_counts:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            curve.append(run_load(test_func, setup_func, workers=workers,
+                                  pool=pool, duration=duration,
+                                  requests=requests))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print format_load(name, curve[-1])
+    return curve
+
+
+def format_load(name, result):
+    """
+    Return a one line human readable version of a `run_load` result.
+    """
+    line = ('{0}: {1[workers]:>3} workers ({1[pool]}) '
+            '{1[throughput]:9.2f} req/s '
+            '({1[requests]} in {1[elapsed]:.2f}s) p50 {1[p50]:06f} '
+            'p90 {1[p90]:06f} p99 {1[p99]:06f} max {1[max]:06f}'.format(
+                name, result))
+    if result['errors']:
+        line += ' errors {0[errors]} ({0[first_error]})'.format(result)
+    return line
 
-    result = 0.0
-    for stmt in stmts:
-        # wrap the callables in echox; this also makes sure the code is ran
-        # in the global namespace
-        stmt = wrap(stmt)
 
-        # returns the TOTAL time the execute
-        result += timeit.Timer(stmt=stmt, setup=setup).timeit(number=number)
+def write_load_results(path, name, curve):
+    """
+    Write a saturation `curve` from `load_curve` to `path`, as csv (one row
+    per worker count) if it ends in .csv and json otherwise.
+    """
+    import json
+
+    if path.endswith('.csv'):
+        import csv
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['test'] + curve[0].keys())
+            for result in curve:
+                writer.writerow([name] + result.values())
+        return
+
+    with open(path, 'w') as f:
+        json.dump(dict(test=name, curve=curve,
+                       global_data=_public_global_data()),
+                  f, indent=2)
+
+
+# global data that changes the generated dataset
+SIZE_KEYS = ('PROJECTS', 'SEQUENCES_PER_PROJECT', 'SHOTS_PER_SEQUENCES',
+             'TASKS_PER_SHOT')
+
+# model name -> function of the row count, fitted as a + b * f(n)
+SCALING_MODELS = (
+    ('constant', None),
+    ('log n', lambda n: math.log(n)),
+    ('linear', lambda n: float(n)),
+    ('n log n', lambda n: n * math.log(n)),
+    ('quadratic', lambda n: float(n) ** 2),
+)
 
-    return result
 
+def sweep_points(specs):
+    """
+    Return the global data overrides of every point of a sweep, the product
+    of all the values given in `specs`.
 
-# -----------------------------------------------------------------------------
-# Tests
+    Parameters
+    ----------
+    specs : list of str
+        'VAR=value,value,...' items.
 
+    Returns
+    -------
+    list of collections.OrderedDict
+    """
+    import collections
+
+    axes = []
+    for spec in specs:
+        var, values = spec.split('=', 1)
+        assert var in global_data, \
+            "You must provide one of {0}".format(global_data.keys())
+        axes.append([(var, value) for value in values.split(',')])
+    return [collections.OrderedDict(point)
+            for point in itertools.product(*axes)]
 
-def setup_ftrack():
+
+def fit_scaling(xs, ys):
     """
-    Get all shots of a sequence via the ftrack_api.
+    Least squares fit of ``y = a + b * f(x)`` for each of `SCALING_MODELS`.
+
+    Returns
+    -------
+    list of collections.OrderedDict
+        model, a, b, r2 and aic of each model that could be fitted, the best
+        (lowest aic) first.
     """
-    # ----------------------------------------------------------------------
-    # FTrack
+    import collections
+
+    n = len(xs)
+    mean_y = float(sum(ys)) / n
+    total = sum((y - mean_y) ** 2 for y in ys)
+    fits = []
+    for name, func in SCALING_MODELS:
+        if func is None:
+            a, b, params = mean_y, 0.0, 1
+        else:
+            if len(set(xs)) < 3 or min(xs) <= 0:
+                continue
+            fx = [func(x) for x in xs]
+            mean_f = sum(fx) / n
+            var_f = sum((f - mean_f) ** 2 for f in fx)
+            b = sum((f - mean_f) * (y - mean_y)
+                    for f, y in zip(fx, ys)) / var_f
+            a = mean_y - b * mean_f
+            params = 2
+        residual = sum((y - (a + b * (func(x) if func else 0))) ** 2
+                       for x, y in zip(xs, ys))
+        fits.append(collections.OrderedDict([
+            ('model', name),
+            ('a', a),
+            ('b', b),
+            ('r2', 1 - residual / total if total else 1.0),
+            # tiny floor keeps perfect fits comparable
+            ('aic', n * math.log(max(residual / n, 1e-30)) + 2 * params),
+        ]))
+    return sorted(fits, key=lambda fit: fit['aic'])
+
+
+def solve_scaling(fit, y, limit=1e12):
+    """
+    Return the row count at which `fit` predicts latency `y`, or None if it
+    never gets there (within `limit` rows).
+    """
+    func = dict(SCALING_MODELS)[fit['model']]
+    if func is None or fit['b'] <= 0:
+        return None
+
+    def predict(n):
+        return fit['a'] + fit['b'] * func(n)
+
+    low, high = 1.0, limit
+    if predict(high) < y:
+        return None
+    if predict(low) >= y:
+        return low
+    for _ in range(200):
+        mid = (low * high) ** 0.5
+        if predict(mid) < y:
+            low = mid
+        else:
+            high = mid
+    return high
+
 
+def _sweep_local_db(base):
     import os
-    # overwrite this so we don't crawl any directories
-    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+    root, ext = os.path.splitext(base)
+    return '{0}_{1}{2}'.format(
+        root, 'x'.join(str(global_data[key]) for key in SIZE_KEYS), ext)
 
-    import ftrack_api
 
+def run_sweep(tests, specs, number=1, warmup=0, local=False, wan=False):
+    """
+    Run each of `tests` at every point of the sweep `specs` (see
+    `sweep_points`).
+
+    With `local`, every combination of data sizes gets its own local store
+    (LOCAL_DB with the sizes appended), seeded the first time and reused
+    after that. With `wan`, the servers are reached through
+    `start_wan_proxies`, whose WAN_* settings follow the sweep.
+
+    Returns
+    -------
+    list of collections.OrderedDict
+        One per point and test: the test, its backend, the point's values,
+        the dataset and returned row counts and the latency statistics.
+    """
+    import collections
+    import os
+    import sys
 
-def test_ftrack_01():
+    all_tests = gather_tests()
+    base_db = global_data['LOCAL_DB']
+    server = None
+    proxies = None
+    points = []
+    for point in sweep_points(specs):
+        for var, value in point.items():
+            global_data[var] = value
+        if local:
+            path = _sweep_local_db(base_db)
+            if server is None or path != global_data['LOCAL_DB']:
+                if server is not None:
+                    server.terminate()
+                    server.join()
+                global_data['LOCAL_DB'] = path
+                server = start_local_backend()
+                if proxies is not None:
+                    # in front of the new local server
+                    for proxy in proxies:
+                        proxy.terminate()
+                    proxies = None
+        if wan and proxies is None:
+            proxies = start_wan_proxies()
+        configure_wan()
+        sizes = _local_store_sizes()
+        shots = (sizes['PROJECTS'] * sizes['SEQUENCES_PER_PROJECT'] *
+                 sizes['SHOTS_PER_SEQUENCES'])
+
+        for name in tests:
+            test_func, setup_func = all_tests[name]
+            phase.discard(0, len(phase.runs))
+            statements.discard(0, len(statements.runs))
+            memory.discard(0, len(memory.type_growth))
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                samples, _ = run_test(test_func, setup=setup_func,
+                                      number=number, warmup=warmup)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            summary = summarize_samples(samples)
+            values = phase.summarize_values()
+            rows = values.get('rows')
+            peak = values.get('peak_rss_kb')
+            rate = values.get('rows_per_sec')
+            result = collections.OrderedDict([
+                ('test', name), ('backend', name.split('_')[0])])
+            result.update(point)
+            result.update([
+                ('shots', shots),
+                ('rows', rows['mean'] if rows else None),
+                ('mean', summary['mean']),
+                ('median', summary['median']),
+                ('median_ci_low', summary['median_ci_low']),
+                ('median_ci_high', summary['median_ci_high']),
+                ('p90', summary['p90']),
+                ('peak_rss_kb', peak['max'] if peak else None),
+                ('rows_per_sec', rate['median'] if rate else None),
+            ])
+            points.append(result)
+            print format_sweep_point(result, point)
+    if server is not None:
+        server.terminate()
+    for proxy in proxies or ():
+        proxy.terminate()
+    return points
+
+
+def format_sweep_point(result, point):
     """
-    Get all shots of a sequence via the ftrack_api.
+    Return a one line human readable version of a `run_sweep` result.
     """
-    session = ftrack_api.Session(server_url=global_data['FTRACK_SERVER'],
-                                 api_key=global_data['FTRACK_APIKEY'])
-    # -update
+    return '{0[test]}: {1} shots {0[shots]} rows {2} median {0[median]:06f} ' \
+        'p90 {0[p90]:06f} peak {3}kB rate {4} rows/s'.format(
+            result, ' '.join('{0}={1}'.format(*item) for item in point.items()),
+            '-' if result['rows'] is None else int(result['rows']),
+            '-' if result['peak_rss_kb'] is None
+            else int(result['peak_rss_kb']),
+            '-' if result['rows_per_sec'] is None
+            else int(result['rows_per_sec']))
 
-    r = session.query(
-        'select name from Shot where project.name = "{0}" and '
-        'parent.name = "{1}"'.format(global_data['PROJECT_NAME'],
-                                     global_data['SEQUENCE_NAME']))
-    # -update
 
-    if global_data['RESULT_MODE'] == 'all':
-        shots = [x['name'] for x in r.all()]
-        print "num shots:", len(shots)
-    else:
-        print "shot name:", r.first()['name']
+def fit_sweep(points, specs):
+    """
+    Fit the median latency of the `run_sweep` results against row count, for
+    each test and combination of the swept values that don't change the
+    data (e.g. RESULT_MODE).
 
+    Latency is fitted against the rows the test returned where every point
+    recorded them, and against the number of shots in the dataset otherwise.
 
-def test_ftrack_02():
+    Returns
+    -------
+    list of collections.OrderedDict
+        test, the fixed values, x (the row count used), points and `fits`.
     """
-    Test retrieving a all shots.
+    import collections
+
+    fixed = [spec.split('=', 1)[0] for spec in specs
+             if spec.split('=', 1)[0] not in SIZE_KEYS]
+    groups = collections.OrderedDict()
+    for result in points:
+        key = (result['test'],) + tuple(result[var] for var in fixed)
+        groups.setdefault(key, []).append(result)
+
+    curves = []
+    for key, results in groups.items():
+        x = 'rows' if all(r['rows'] for r in results) else 'shots'
+        curves.append(collections.OrderedDict([
+            ('test', key[0]),
+            ('fixed', collections.OrderedDict(zip(fixed, key[1:]))),
+            ('x', x),
+            ('points', len(results)),
+            ('fits', fit_scaling([r[x] for r in results],
+                                 [r['median'] for r in results])),
+        ]))
+    return curves
+
+
+def format_sweep_fits(curves, budget=None):
+    """
+    Return a human readable table of `fit_sweep` output. With a latency
+    `budget` in seconds, also give the row count at which the best fit
+    exceeds it.
     """
-    session = ftrack_api.Session(server_url=global_data['FTRACK_SERVER'],
-                                 api_key=global_data['FTRACK_APIKEY'])
-    # -update
+    lines = ['scaling (median latency = a + b * f(n)):']
+    for curve in curves:
+        label = ' '.join([curve['test']] + [
+            '{0}={1}'.format(*item) for item in curve['fixed'].items()])
+        best = curve['fits'][0]
+        line = '  {0:<32} n={1:<5} best {2[model]:<9} a {2[a]:.3g} ' \
+            'b {2[b]:.3g} r2 {2[r2]:.3f}'.format(label, curve['x'], best)
+        others = ', '.join('{0[model]} {0[r2]:.3f}'.format(fit)
+                           for fit in curve['fits'][1:])
+        if others:
+            line += ' (r2 {0})'.format(others)
+        if budget:
+            limit = solve_scaling(best, budget)
+            if limit is None:
+                line += '; stays under {0}s'.format(budget)
+            else:
+                line += '; {0}s at ~{1:.0f} {2}'.format(budget, limit,
+                                                       curve['x'])
+        lines.append(line)
+    return '\n'.join(lines)
 
-    r = session.query('select name from Shot')
 
-    if global_data['RESULT_MODE'] == 'all':
-        shots = [x['name'] for x in r.all()]
-        print "num shots:", len(shots)
-    else:
-        print "shot name:", r.first()['name']
+def write_sweep_results(path, points, curves):
+    """
+    Write `run_sweep` points and their `fit_sweep` curves to `path`.
+
+    A '.csv' path gets one row per point (plot ready), with the fits written
+    next to it to '<name>_fits.csv'; anything else a json document with both.
+    """
+    import json
+
+    if path.endswith('.csv'):
+        import csv
+        import os
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(points[0].keys())
+            for result in points:
+                writer.writerow(['' if value is None else value
+                                 for value in result.values()])
+        with open(os.path.splitext(path)[0] + '_fits.csv', 'wb') as f:
+            writer = csv.writer(f)
+            fixed = curves[0]['fixed'].keys()
+            writer.writerow(['test'] + fixed +
+                            ['x', 'points', 'model', 'a', 'b', 'r2', 'aic',
+                             'best'])
+            for curve in curves:
+                for i, fit in enumerate(curve['fits']):
+                    writer.writerow([curve['test']] +
+                                    curve['fixed'].values() +
+                                    [curve['x'], curve['points']] +
+                                    fit.values() + [int(i == 0)])
+        return
+
+    with open(path, 'w') as f:
+        json.dump(dict(points=points, curves=curves,
+                       global_data=_public_global_data()),
+                  f, indent=2)
+
+
+def connect_db(url, **options):
+    """
+    Return a dict cursor for the database at `url`.
 
+    MySQL urls are opened with MySQLdb, sqlite urls (as used by the local
+    stand-in backend) with the builtin sqlite3 module. Both cursors return
+    rows that can be indexed by column name.
 
-def setup_sqlalchemy():
+    Parameters
+    ----------
+    url : sqlalchemy.engine.url.URL
+    options
+        Extra MySQLdb.connect arguments, ignored for sqlite.
     """
-    Get all shots of a sequence with sqlalchemy and some quick models.
+    if url.drivername.startswith('sqlite'):
+        import sqlite3
+
+        def dict_factory(cursor, row):
+            return dict((col[0], value)
+                        for col, value in zip(cursor.description, row))
+
+        conn = sqlite3.connect(url.database)
+        conn.row_factory = dict_factory
+        return conn.cursor()
+
+    import MySQLdb
+    import MySQLdb.cursors
+    return MySQLdb.connect(
+        host=url.host,
+        port=url.port or 3306,
+        db=url.database,
+        user=url.username,
+        passwd=url.password,
+        **options).cursor(MySQLdb.cursors.DictCursor)
+
+
+CONNECTION_MODES = ('cold', 'pooled', 'persistent')
+
+
+class ConnectionPool(object):
+    """
+    Hands out connections (or sessions) for one backend.
+
+    Modes
+    -----
+    cold
+        Every `acquire` makes a new connection, closed when released.
+    pooled
+        Up to `size` connections are shared across runs and threads. Released
+        connections are reset and handed out again.
+    persistent
+        Each thread keeps one connection, including any session state, for
+        all of its runs.
+
+    Tests never hand connections back: the harness calls `release` between
+    runs (outside the timed region), and a thread's previous connection is
+    released when it acquires a new one.
     """
-    # ----------------------------------------------------------------------
-    # SQLAlchemy
 
-    from sqlalchemy.orm import Session, relationship, backref
-    from sqlalchemy import (
-        create_engine,
-        Column, String, Date, Boolean, Float,
-        ForeignKey
-    )
-    from sqlalchemy.ext.declarative import declarative_base
-    # -update
+    def __init__(self, connect, mode='cold', size=5, reset=None, close=None):
+        import Queue
+        import threading
+
+        assert mode in CONNECTION_MODES, \
+            "Connection mode must be one of {0}".format(CONNECTION_MODES)
+        self.connect = connect
+        self.mode = mode
+        self.size = size
+        self.reset = reset or (lambda conn: None)
+        self.close = close or (lambda conn: None)
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def acquire(self):
+        self.release()
+        if self.mode == 'persistent':
+            conn = getattr(self._local, 'persistent', None)
+            if conn is None:
+                conn = self._local.persistent = self.connect()
+            return conn
+
+        if self.mode == 'pooled':
+            import Queue
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                with self._lock:
+                    create = self._created < self.size
+                    if create:
+                        self._created += 1
+                # block for a released connection once the pool is full
+                conn = self.connect() if create else self._idle.get()
+        else:
+            conn = self.connect()
+        self._local.current = conn
+        return conn
+
+    def current(self):
+        """
+        Return the connection the current thread acquired, if any.
+        """
+        return (getattr(self._local, 'current', None) or
+                getattr(self._local, 'persistent', None))
+
+    def release(self):
+        conn = getattr(self._local, 'current', None)
+        if conn is None:
+            return
+        self._local.current = None
+        if self.mode == 'pooled':
+            self.reset(conn)
+            self._idle.put(conn)
+        else:
+            self.close(conn)
 
-    Base = declarative_base()
 
-    class Context(Base):
-        __tablename__ = 'context'
+# (backend, mode, size, url) -> ConnectionPool, shared across runs
+_connection_pools = {}
+# shared sqlalchemy engines for the pooled and persistent modes
+_engines = {}
 
-        context_type = Column(String)
-        id = Column(String, primary_key=True)
-        parent_id = Column(String, ForeignKey('context.id'))
-        name = Column(String)
 
-        shot = relationship('Shot', uselist=False)
-        sequence = relationship('Sequence', uselist=False)
-        project = relationship('Project', uselist=False)
+def _sqlalchemy_engine(shared):
+    from sqlalchemy import create_engine
 
-        children = relationship(
-            'Context', backref=backref('parent', remote_side=[id]))
+    url = str(global_data['DB_URI'])
+    if not shared:
+        return create_engine(url)
+    key = (url, int(global_data['POOL_SIZE']))
+    if key not in _engines:
+        from sqlalchemy.pool import QueuePool
+        connect_args = {}
+        if url.startswith('sqlite'):
+            # the pool hands sqlite connections to other threads
+            connect_args['check_same_thread'] = False
+        _engines[key] = create_engine(
+            url, poolclass=QueuePool, pool_size=key[1], max_overflow=0,
+            connect_args=connect_args)
+    return _engines[key]
 
-    class Project(Base):
-        __tablename__ = 'show'
 
-        showid = Column(String, ForeignKey('context.id'), primary_key=True)
-        fullname = Column(String)
-        root = Column(String)
-        startdate = Column(Date)
-        enddate = Column(Date)
-        status = Column(String)
-        diskid = Column(String)
-        projectschemeid = Column(String)
-        thumbid = Column(String)
-        isglobal = Column(Boolean)
+def _sqlalchemy_session(shared):
+    from sqlalchemy.orm import Session
 
-        context = relationship('Context', uselist=False)
+    with phase('create_engine'):
+        engine = _sqlalchemy_engine(shared)
+    with phase('session'):
+        session = Session(engine)
+    with phase('checkout'):
+        # connect now rather than on the first query
+        session.connection()
+    return session
 
-    class _Task(Base):
-        __tablename__ = 'task'
-        _object_type_id = '*'
 
-        taskid = Column(String, ForeignKey('context.id'), primary_key=True)
-        description = Column(String)
-        startdate = Column(Date)
-        enddate = Column(Date)
-        statusid = Column(String)
-        typeid = Column(String)
-        isopen = Column(Boolean)
-        thumbid = Column(String)
-        sort = Column(Float)
-        object_typeid = Column(String, ForeignKey('object_type.typeid'))
-        showid = Column(String, ForeignKey('show.showid'))
-        priorityid = Column(String)
+def _close_sqlalchemy_session(session):
+    engine = session.bind
+    session.close()
+    if engine not in _engines.values():
+        engine.dispose()
 
-        context = relationship('Context', uselist=False)
 
-        __mapper_args__ = {
-            'polymorphic_identity': _object_type_id,
-            'polymorphic_on': object_typeid
-        }
+class StatementRecorder(object):
+    """
+    Records the SQL statements sqlalchemy sends to the database during each
+    run, with the time spent in the driver for each, and the time spent
+    preparing them (compiling, or looking up a cached compilation, and
+    setting up the execution context).
 
-        @property
-        def name(self):
-            return self.context.name
+    Only runs between `start_run` and `end_run` are recorded; statements of
+    the setup and load tests are ignored.
+
+    Attributes
+    ----------
+    runs : list of list
+        For each run, (statement, seconds) per round-trip.
+    """
+
+    def __init__(self):
+        self.runs = []
+        # seconds spent preparing the statements of the current run
+        self.compile_seconds = 0.0
+        self._recording = False
+        self._installed = False
+
+    def install(self):
+        """
+        Listen to the cursor executions of every sqlalchemy engine.
+        """
+        if self._installed:
+            return
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        event.listen(Engine, 'before_execute', self._before_execute)
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+        self._installed = True
+
+    def _before_execute(self, conn, *args):
+        conn.info['execute_start'] = timeit.default_timer()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        now = timeit.default_timer()
+        start = conn.info.pop('execute_start', None)
+        if start is not None and self._recording:
+            self.compile_seconds += now - start
+        conn.info.setdefault('statement_start', []).append(now)
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed = timeit.default_timer() - conn.info['statement_start'].pop()
+        if self._recording:
+            self.runs[-1].append((statement, elapsed))
+
+    def start_run(self):
+        self.runs.append([])
+        self.compile_seconds = 0.0
+        self._recording = True
+
+    def end_run(self):
+        """
+        Stop recording and store the round-trips of the run as `PhaseTimer`
+        values, if there were any.
+        """
+        self._recording = False
+        run = self.runs[-1] if self.runs else []
+        if not run:
+            return
+        counts = {}
+        for statement, _ in run:
+            counts[statement] = counts.get(statement, 0) + 1
+        phase.record('statements', len(run))
+        phase.record('statement_seconds', sum(s for _, s in run))
+        phase.record('compile_seconds', self.compile_seconds)
+        # the same statement once per row is the signature of an N+1 query
+        phase.record('max_statement_repeats', max(counts.values()))
+
+    def discard(self, first, count):
+        """
+        Forget `count` runs starting at index `first`, e.g. warmup runs.
+        """
+        del self.runs[first:first + count]
+
+    def summarize(self):
+        """
+        Return statement -> mean count and seconds per run, the most
+        executed statement first.
+        """
+        import collections
+
+        if not any(self.runs):
+            return collections.OrderedDict()
+        totals = collections.defaultdict(lambda: [0, 0.0])
+        for run in self.runs:
+            for statement, elapsed in run:
+                totals[statement][0] += 1
+                totals[statement][1] += elapsed
+        result = collections.OrderedDict()
+        for statement, (count, elapsed) in sorted(
+                totals.items(), key=lambda item: -item[1][0]):
+            result[statement] = collections.OrderedDict([
+                ('count', float(count) / len(self.runs)),
+                ('seconds', elapsed / len(self.runs)),
+            ])
+        return result
+
+
+statements = StatementRecorder()
+
+
+class FtrackRecorder(object):
+    """
+    Counts the server round-trips of the ftrack_api sessions during each
+    run, the entity lookups their caches answer, and the attributes fetched
+    lazily, one round-trip per entity, when auto-population reads a value
+    that is neither selected nor cached.
+
+    Only runs between `start_run` and `end_run` are recorded. The counts
+    are stored as `PhaseTimer` values.
+    """
+
+    def __init__(self):
+        self.calls = self.hits = self.misses = 0
+        # attribute -> lazy fetches and reads in the current run
+        self.fetches = {}
+        self.reads = {}
+        self._recording = False
+        self._installed = False
+
+    def install(self):
+        """
+        Wrap the requests, population and cache lookups of every
+        ftrack_api session.
+        """
+        if self._installed:
+            return
+        import ftrack_api
+        import ftrack_api.cache
+
+        Session = ftrack_api.Session
+        LayeredCache = ftrack_api.cache.LayeredCache
+        call, populate, get = Session.call, Session.populate, \
+            LayeredCache.get
+        recorder = self
+
+        def counted_call(session, data):
+            if recorder._recording:
+                recorder.calls += 1
+            return call(session, data)
+
+        def counted_populate(session, entities, projections):
+            if recorder._recording:
+                for name in projections.split(','):
+                    name = name.strip()
+                    recorder.fetches[name] = recorder.fetches.get(name, 0) + 1
+            return populate(session, entities, projections)
+
+        def counted_get(cache, key):
+            try:
+                value = get(cache, key)
+            except KeyError:
+                if recorder._recording:
+                    recorder.misses += 1
+                raise
+            if recorder._recording:
+                recorder.hits += 1
+            return value
+
+        Session.call = counted_call
+        Session.populate = counted_populate
+        LayeredCache.get = counted_get
+        self._installed = True
+
+    def read(self, name, count):
+        """
+        Note that a test read attribute `name` of `count` entities.
+        """
+        self.reads[name] = self.reads.get(name, 0) + count
+
+    def start_run(self):
+        self.calls = self.hits = self.misses = 0
+        self.fetches = {}
+        self.reads = {}
+        self._recording = True
+
+    def end_run(self):
+        """
+        Stop recording and store the counts of the run, if it made any
+        requests.
+        """
+        self._recording = False
+        if not self.calls:
+            return
+        phase.record('ftrack_round_trips', self.calls)
+        if self.hits + self.misses:
+            phase.record('ftrack_cache_hit_rate',
+                         float(self.hits) / (self.hits + self.misses))
+        for name, reads in sorted(self.reads.items()):
+            fetched = self.fetches.get(name, 0)
+            phase.record('lazy_fetches_' + name, fetched)
+            # the round-trips a cold, auto-populating session would make
+            phase.record('lazy_fetches_avoided_' + name, reads - fetched)
+
+
+ftrack_requests = FtrackRecorder()
+
+
+# first keywords of the sql statements a trace records as reads
+SQL_READ_KEYWORDS = ('SELECT', 'WITH', 'SHOW', 'EXPLAIN', 'DESCRIBE')
+
+
+class TraceRecorder(object):
+    """
+    Captures the backend operations of the test runs for a workload trace
+    (see `write_trace`): the sql statements of sqlalchemy engines and
+    MySQLdb cursors, and the request batches of ftrack_api sessions.
+
+    Only operations made while `enabled` and a run is in progress (between
+    `start_run` and `end_run`, possibly in several load workers at once)
+    are captured, from any thread, so setups are left out but the threads a
+    test starts are not. The statements of plain sqlite3 cursors (the mysql
+    tests with --local) cannot be hooked.
+
+    Attributes
+    ----------
+    operations : list of tuple
+        (start time, thread, backend, kind, text, params, rows, seconds)
+        per operation. backend is 'sql' or 'ftrack' and kind 'read' or
+        'write'; rows is None when the driver does not report it.
+    """
+
+    def __init__(self):
+        import threading
+        self.operations = []
+        self.enabled = False
+        # runs in progress
+        self._runs = 0
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def install(self):
+        """
+        Hook every sqlalchemy engine, MySQLdb cursor and ftrack_api session.
+        """
+        if self._installed:
+            return
+        import ftrack_api
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        recorder = self
+        timer = timeit.default_timer
+
+        def before(conn, cursor, statement, parameters, context,
+                   executemany):
+            conn.info.setdefault('trace_start', []).append(timer())
+
+        def after(conn, cursor, statement, parameters, context,
+                  executemany):
+            start = conn.info['trace_start'].pop()
+            # MySQLdb cursors are recorded by their own hook
+            if recorder.recording and conn.dialect.driver != 'mysqldb':
+                recorder.add('sql', statement, parameters, cursor.rowcount,
+                             start, executemany)
+
+        event.listen(Engine, 'before_cursor_execute', before)
+        event.listen(Engine, 'after_cursor_execute', after)
+
+        try:
+            import MySQLdb.cursors
+        except ImportError:
+            pass
+        else:
+            Cursor = MySQLdb.cursors.BaseCursor
+            execute, executemany = Cursor.execute, Cursor.executemany
+
+            def traced_execute(cursor, query, args=None):
+                if not recorder.recording:
+                    return execute(cursor, query, args)
+                start = timer()
+                result = execute(cursor, query, args)
+                recorder.add('sql', query, args, cursor.rowcount, start)
+                return result
+
+            def traced_executemany(cursor, query, args):
+                if not recorder.recording:
+                    return executemany(cursor, query, args)
+                start = timer()
+                result = executemany(cursor, query, args)
+                recorder.add('sql', query, args, cursor.rowcount, start,
+                             True)
+                return result
+
+            Cursor.execute = traced_execute
+            Cursor.executemany = traced_executemany
+
+        Session = ftrack_api.Session
+        call = Session.call
+
+        def traced_call(session, data):
+            if not recorder.recording:
+                return call(session, data)
+            # what goes over the wire
+            text = session.encode(
+                data, entity_attribute_strategy='modified_only')
+            start = timer()
+            result = call(session, data)
+            rows = sum(len(x.get('data') or [])
+                       for x in result if isinstance(x, dict) and
+                       x.get('action') == 'query')
+            recorder.add('ftrack', text, None, rows, start)
+            return result
+
+        Session.call = traced_call
+        self._installed = True
+
+    @property
+    def recording(self):
+        return self.enabled and self._runs > 0
+
+    def add(self, backend, text, params, rows, start, many=False):
+        """
+        Capture an operation that started at `start` (timeit clock) and
+        just finished.
+        """
+        import json
+        import re
+        import threading
+
+        seconds = timeit.default_timer() - start
+        if backend == 'sql':
+            # by the first keyword, past any opening parentheses
+            keyword = re.match(r'[\s(]*(\w*)', text).group(1).upper()
+            kind = 'read' if keyword in SQL_READ_KEYWORDS else 'write'
+            params = _trace_params(params, many)
+        else:
+            kind = 'read' if all(x['action'].startswith('query')
+                                 for x in json.loads(text)) else 'write'
+        self.operations.append((
+            time.time() - seconds, threading.current_thread().ident,
+            backend, kind, text,
+            params, rows if rows is None or rows >= 0 else None, seconds))
+
+    def start_run(self):
+        with self._lock:
+            self._runs += 1
+
+    def end_run(self):
+        with self._lock:
+            self._runs -= 1
+
+
+traces = TraceRecorder()
+
+
+def _trace_params(params, many=False):
+    # json safe copy of the parameters of a statement; those of an
+    # executemany are wrapped as {'__many__': [...]}
+    import datetime
+    import decimal
+
+    def value(x):
+        if x is None or isinstance(x, (bool, int, long, float, basestring)):
+            return x
+        if isinstance(x, (datetime.date, datetime.time)):
+            return x.isoformat()
+        if isinstance(x, decimal.Decimal):
+            return float(x)
+        if isinstance(x, dict):
+            return dict((k, value(v)) for k, v in x.items())
+        if isinstance(x, (list, tuple)):
+            return [value(v) for v in x]
+        return str(x)
+
+    if params is None or (not many and not params):
+        return None
+    if many:
+        return {'__many__': [value(x) for x in params]}
+    return value(params)
+
+
+def format_statements(summary, threshold, rows=None):
+    """
+    Return a human readable table of `StatementRecorder.summarize` output,
+    flagging statements executed at least `threshold` times per run and, if
+    the mean number of `rows` per run is known, at least once per row.
+    Batched eager loads (selectin) repeat too, but per batch, not per row.
+    """
+    lines = ['statements (per run):']
+    for statement, stats in summary.items():
+        sql = ' '.join(statement.split())
+        if len(sql) > 72:
+            sql = sql[:69] + '...'
+        lines.append('  {0[count]:8.1f}x {0[seconds]:.6f}s  {1}'.format(
+            stats, sql))
+        if stats['count'] >= max(threshold, rows or 0):
+            lines.append('            possible N+1 query: executed once per '
+                         'row? Consider eager loading.')
+    return '\n'.join(lines)
+
+
+def connection_pool(backend):
+    """
+    Return the `ConnectionPool` for `backend` ('mysql', 'sqlalchemy' or
+    'ftrack') using the current CONNECTION_MODE, POOL_SIZE and urls.
+    """
+    mode = global_data['CONNECTION_MODE']
+    size = int(global_data['POOL_SIZE'])
+    url = str(global_data['DB_URI'] if backend != 'ftrack'
+              else global_data['FTRACK_SERVER'])
+    key = (backend, mode, size, url)
+    if key in _connection_pools:
+        return _connection_pools[key]
+
+    if backend == 'mysql':
+        from sqlalchemy.engine.url import make_url
+        pool = ConnectionPool(
+            lambda: connect_db(make_url(url)), mode, size,
+            close=lambda cursor: cursor.connection.close())
+    elif backend == 'sqlalchemy':
+        statements.install()
+        # the engine's own QueuePool does the pooling; sessions are only
+        # kept between runs in persistent mode
+        shared = mode != 'cold'
+        pool = ConnectionPool(
+            lambda: _sqlalchemy_session(shared),
+            'persistent' if mode == 'persistent' else 'cold', size,
+            close=_close_sqlalchemy_session)
+    elif backend == 'ftrack':
+        ftrack_requests.install()
+        # reset only clears a session's own memory cache, not FTRACK_CACHE
+        pool = ConnectionPool(
+            ftrack_session, mode, size,
+            reset=lambda session: session.reset(),
+            close=lambda session: session.close())
+    else:
+        raise ValueError('Unknown backend {0!r}'.format(backend))
+    _connection_pools[key] = pool
+    return pool
+
+
+def acquire_connection(backend):
+    """
+    Return a connection for `backend` according to CONNECTION_MODE: a MySQL
+    dict cursor, a SQLAlchemy session or an ftrack_api session.
+    """
+    return connection_pool(backend).acquire()
+
+
+def release_connections():
+    """
+    Release the connections acquired by the current thread.
+    """
+    for pool in _connection_pools.values():
+        pool.release()
+
+
+def server_side_cursor(cursor):
+    """
+    Return a cursor on the connection of `cursor` that leaves the result set
+    on the server and transfers rows as they are fetched.
+
+    sqlite cursors already step through results lazily and are returned
+    unchanged.
+    """
+    import sqlite3
+    if isinstance(cursor, sqlite3.Cursor):
+        return cursor
+    import MySQLdb.cursors
+    return cursor.connection.cursor(MySQLdb.cursors.SSDictCursor)
+
+
+def stream_query(cursor, query, size):
+    """
+    Execute `query` with a server side cursor and yield its rows, fetching
+    `size` rows at a time.
+
+    The query is only executed when the first row is requested.
+    """
+    stream = server_side_cursor(cursor)
+    try:
+        stream.execute(query)
+        while True:
+            rows = stream.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        if stream is not cursor:
+            # unread rows of an unbuffered result block the connection
+            stream.close()
+
+
+def ftrack_stream(session, expression, size):
+    """
+    Yield the entities matching `expression` one page of `size` at a time.
+
+    Unlike iterating a `QueryResult` the fetched entities aren't kept, and
+    the session cache is cleared between pages, so memory use is bounded by
+    the page size rather than the number of results.
+    """
+    offset = 0
+    while True:
+        page = session.query('{0} offset {1} limit {2}'.format(
+            expression, offset, size), page_size=size).all()
+        for entity in page:
+            yield entity
+        if len(page) < size:
+            break
+        offset += size
+        del page
+        session.cache.clear()
+
+
+def consume_stream(rows, key=None):
+    """
+    Read every row of the iterable `rows` without keeping them, and return
+    how many there were.
+
+    The time to the first row, the row count and the rate rows were read at
+    are recorded as `first_row`, `rows` and `rows_per_sec` of the current
+    run.
+
+    Parameters
+    ----------
+    rows : iterable
+    key : object
+        If given, the item of each row to read, as a consumer would.
+    """
+    start = timeit.default_timer()
+    count = 0
+    for row in rows:
+        if not count:
+            phase.record('first_row', timeit.default_timer() - start)
+        if key is not None:
+            row[key]
+        count += 1
+    elapsed = timeit.default_timer() - start
+    phase.record('rows', count)
+    if elapsed:
+        phase.record('rows_per_sec', count / elapsed)
+    return count
+
+
+PAGINGS = ('offset', 'keyset')
+
+
+def fetch_pages(backend, conn, fetch_page):
+    """
+    Read the id and name of every row of a query ordered by id, PAGE_SIZE
+    rows at a time, dropping each page before fetching the next, and
+    return the number of rows.
+
+    `fetch_page(conn, size, offset, after, before)` returns up to `size`
+    (id, name) rows ordered by id: from row `offset` with 'offset' PAGING,
+    or from the ids between `after` and `before` (None when unbounded) with
+    'keyset' paging, where `offset` is None.
+
+    With PAGE_WORKERS above one, the other workers fetch pages in threads
+    over their own, untimed, connections to `backend`. Offset pages are
+    handed out in order until one comes back short. Keyset workers each
+    seek through a slice of the id space, the ids being uuids.
+
+    The pages, the slowest page's seconds and the rows read per second are
+    recorded for the run.
+    """
+    import threading
+
+    paging = global_data['PAGING']
+    assert paging in PAGINGS, \
+        "PAGING must be one of {0}".format(PAGINGS)
+    size = int(global_data['PAGE_SIZE'])
+    workers = int(global_data['PAGE_WORKERS'])
+    if paging == 'keyset':
+        # a slice of ids per worker, split on their first hex digit
+        workers = min(workers, 16)
+        bounds = [None] + ['0123456789abcdef'[16 * i // workers]
+                           for i in range(1, workers)] + [None]
+    lock = threading.Lock()
+    state = dict(next=0, end=None, rows=0, pages=0, slowest=0.0)
+
+    def read_page(conn, offset, after, before):
+        start = timeit.default_timer()
+        page = fetch_page(conn, size, offset, after, before)
+        for row in page:
+            row[1]
+        elapsed = timeit.default_timer() - start
+        with lock:
+            state['rows'] += len(page)
+            state['pages'] += 1
+            state['slowest'] = max(state['slowest'], elapsed)
+        return page[-1][0] if page else None, len(page)
+
+    def work(index, conn):
+        if paging == 'keyset':
+            after, before = bounds[index], bounds[index + 1]
+            while True:
+                last, count = read_page(conn, None, after, before)
+                if count < size:
+                    break
+                after = last
+            return
+        while True:
+            with lock:
+                if state['end'] is not None and state['next'] >= state['end']:
+                    return
+                offset = state['next']
+                state['next'] += size
+            _, count = read_page(conn, offset, None, None)
+            if count < size:
+                with lock:
+                    if state['end'] is None or offset + count < state['end']:
+                        state['end'] = offset + count
+
+    if backend == 'mysql':
+        from sqlalchemy.engine.url import make_url
+        connect = lambda: connect_db(make_url(str(global_data['DB_URI'])))
+        close = lambda cursor: cursor.connection.close()
+    elif backend == 'sqlalchemy':
+        from sqlalchemy.orm import Session
+        # the pooled engine lets sqlite connections change threads; its
+        # POOL_SIZE caps the workers fetching at once
+        connect = lambda: Session(_sqlalchemy_engine(True))
+        close = lambda session: session.close()
+    else:
+        connect = ftrack_session
+        close = lambda session: session.close()
+
+    errors = []
+
+    def worker(index):
+        try:
+            conn = connect()
+            try:
+                work(index, conn)
+            finally:
+                close(conn)
+        except Exception as error:
+            errors.append(error)
+
+    start = timeit.default_timer()
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(1, workers)]
+    for thread in threads:
+        thread.start()
+    # the test's own connection may not be usable from other threads
+    try:
+        work(0, conn)
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    elapsed = timeit.default_timer() - start
+    phase.record('rows', state['rows'])
+    phase.record('pages', state['pages'])
+    phase.record('slowest_page', state['slowest'])
+    if elapsed:
+        phase.record('rows_per_sec', state['rows'] / elapsed)
+    return state['rows']
+
+
+# how the 'all' result mode of the mysql and sqlalchemy tests holds its rows
+MATERIALIZE_FORMATS = ('tuple', 'dict', 'orm', 'columnar')
+
+
+def materialize_format(default, allowed=MATERIALIZE_FORMATS):
+    """
+    Return the MATERIALIZE format for a test, or its usual `default` when
+    MATERIALIZE is 'default' or RESULT_MODE is not 'all'.
+    """
+    fmt = global_data['MATERIALIZE']
+    if fmt == 'default' or global_data['RESULT_MODE'] != 'all':
+        return default
+    assert fmt in allowed, \
+        "MATERIALIZE must be 'default' or one of {0}".format(allowed)
+    return fmt
+
+
+def result_cursor(cursor, fmt):
+    """
+    Return `cursor` (a `connect_db` dict cursor), or a tuple cursor on the
+    same connection for the 'tuple' and 'columnar' formats.
+    """
+    if fmt == 'dict':
+        return cursor
+    if _is_sqlite(cursor):
+        plain = cursor.connection.cursor()
+        plain.row_factory = None
+        return plain
+    import MySQLdb.cursors
+    return cursor.connection.cursor(MySQLdb.cursors.Cursor)
+
+
+def query_rows(session, query, fmt):
+    """
+    Return every row of the sqlalchemy `query` in the `fmt` format: the
+    query's own objects or keyed tuples ('orm', 'tuple'), dicts, or a
+    `ColumnarResult` read straight from the result proxy.
+    """
+    if fmt == 'columnar' and hasattr(query, 'statement'):
+        return ColumnarResult.fetch(session.execute(query.statement),
+                                    int(global_data['STREAM_CHUNK_SIZE']))
+    rows = query.all()
+    if fmt == 'columnar':
+        # baked query results can only be read as keyed tuples
+        result = ColumnarResult(rows[0].keys() if rows else [])
+        result.extend(rows)
+        return result
+    if fmt == 'dict':
+        return [row._asdict() for row in rows]
+    return rows
+
+
+def record_result(rows, elapsed):
+    """
+    Record how fast the materialized `rows` were fetched (`rows_per_sec`)
+    and, when MATERIALIZE is set, the memory they hold (`result_kb`,
+    `bytes_per_row`). Sizing large results takes a while; it happens
+    outside the phases but inside the run.
+    """
+    if elapsed and len(rows):
+        phase.record('rows_per_sec', len(rows) / elapsed)
+    if global_data['MATERIALIZE'] == 'default':
+        return
+    if isinstance(rows, ColumnarResult):
+        size = rows.size_bytes()
+    else:
+        size = _deep_sizeof(rows, set())
+    phase.record('result_kb', size / 1024.0)
+    if len(rows):
+        phase.record('bytes_per_row', float(size) / len(rows))
+
+
+# (connection id, name) of the statements PREPAREd on MySQL connections
+_prepared_statements = set()
+
+
+def statement_mode(key, allowed):
+    """
+    Return the statement mode in global_data[key], checked against
+    `allowed`. Streamed results always use the first (default) mode.
+    """
+    mode = global_data[key]
+    assert mode in allowed, "{0} must be one of {1}".format(key, allowed)
+    if global_data['RESULT_MODE'] == 'stream':
+        return allowed[0]
+    return mode
+
+
+def build_statement(cursor, template, values, mode):
+    """
+    Return (query, params) for the sql `template`, in which '{0}', '{1}',
+    ... stand for `values`.
+
+    'literal' quotes the values straight into the text (unescaped, as the
+    tests always did), 'bound' leaves the driver's placeholders and returns
+    the values as parameters, and 'prepared' does the same with the '?'
+    markers of MySQL's PREPARE.
+    """
+    if mode == 'literal':
+        return template.format(*["'{0}'".format(x) for x in values]), None
+    marker = '?' if mode == 'prepared' or _is_sqlite(cursor) else '%s'
+    return template.format(*[marker] * len(values)), list(values)
+
+
+def execute_statement(cursor, name, query, params, mode):
+    """
+    Execute a `build_statement` query, timed as the 'execute' phase.
+
+    In 'prepared' mode the query is PREPAREd as `name` on the server once
+    per connection (the 'prepare' phase) and then run with EXECUTE ...
+    USING. sqlite3 prepares and caches every statement itself, so there it
+    runs like 'bound'.
+    """
+    if mode != 'prepared' or _is_sqlite(cursor):
+        with phase('execute'):
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, params)
+        return
+
+    key = (cursor.connection.thread_id(), name)
+    if key not in _prepared_statements:
+        with phase('prepare'):
+            cursor.execute('PREPARE {0} FROM %s'.format(name), [query])
+        _prepared_statements.add(key)
+    variables = ['@{0}_{1}'.format(name, i) for i in range(len(params))]
+    with phase('execute'):
+        if params:
+            cursor.execute('SET ' + ', '.join(
+                '{0} = %s'.format(x) for x in variables), params)
+        cursor.execute('EXECUTE {0}{1}'.format(
+            name, ' USING ' + ', '.join(variables) if variables else ''))
+
+
+class _Pool(dict):
+    # distinct values of a column -> their index in `values`
+
+    def __init__(self):
+        super(_Pool, self).__init__()
+        self.values = []
+
+    def __missing__(self, value):
+        if type(value) is str:
+            value = intern(value)
+        index = self[value] = len(self.values)
+        self.values.append(value)
+        return index
+
+
+class ColumnarResult(object):
+    """
+    Query result stored a column at a time instead of as a list of row
+    tuples or dicts.
+
+    Float and integer columns are `array.array`s of machine values. Any
+    other column (strings, dates, NULLs) is an array of indexes into a pool
+    holding each distinct value once. A row then costs a few bytes per
+    column, and repeated values such as statuses or types are shared. Rows
+    are read through `__slots__` views that look values up on access.
+
+    Attributes
+    ----------
+    names : list of str
+        Column names, in select order.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._index = dict((name, i) for i, name in enumerate(self.names))
+        self._columns = [None] * len(self.names)
+        # per column, a _Pool or None for numeric columns
+        self._pools = [None] * len(self.names)
+        self._length = 0
+
+    @classmethod
+    def fetch(cls, cursor, size=1000):
+        """
+        Read every row of a DB-API `cursor` (or sqlalchemy result) into a
+        new ColumnarResult, `size` rows at a time.
+        """
+        if hasattr(cursor, 'keys'):
+            names = cursor.keys()
+        else:
+            names = [column[0] for column in cursor.description]
+        result = cls(names)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            result.extend(rows)
+        return result
+
+    def extend(self, rows):
+        """
+        Append `rows`, a sequence of row tuples.
+        """
+        import array
+
+        for i, values in enumerate(zip(*rows)):
+            column = self._columns[i]
+            if column is None:
+                sample = next((x for x in values if x is not None), None)
+                if type(sample) is float:
+                    column = array.array('d')
+                elif type(sample) in (int, long):
+                    column = array.array('l')
+                else:
+                    column = array.array('I')
+                    self._pools[i] = _Pool()
+                self._columns[i] = column
+            if self._pools[i] is not None:
+                column.extend(map(self._pools[i].__getitem__, values))
+                continue
+            length = len(column)
+            try:
+                column.extend(values)
+            except (TypeError, OverflowError):
+                # a NULL or a large number in a numeric column, pool it
+                del column[length:]
+                pool = self._pools[i] = _Pool()
+                column = self._columns[i] = array.array(
+                    'I', map(pool.__getitem__, column))
+                column.extend(map(pool.__getitem__, values))
+        self._length += len(rows)
+
+    def value(self, row, i):
+        """
+        Return the value of column `i` in row `row`.
+        """
+        value = self._columns[i][row]
+        pool = self._pools[i]
+        return value if pool is None else pool.values[value]
+
+    def column(self, name):
+        """
+        Return the values of column `name` as a list.
+        """
+        i = self._index[name]
+        if self._columns[i] is None:
+            return []
+        pool = self._pools[i]
+        if pool is None:
+            return self._columns[i].tolist()
+        return map(pool.values.__getitem__, self._columns[i])
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, row):
+        if not -self._length <= row < self._length:
+            raise IndexError(row)
+        return _RowView(self, row % self._length)
+
+    def __iter__(self):
+        for row in xrange(self._length):
+            yield _RowView(self, row)
+
+    def size_bytes(self):
+        """
+        Return the memory used by the columns and their pooled values.
+        """
+        import sys
+
+        size = sys.getsizeof(self)
+        seen = set()
+        for column, pool in zip(self._columns, self._pools):
+            size += sys.getsizeof(column)
+            if pool is not None:
+                size += _deep_sizeof(pool, seen) + \
+                    _deep_sizeof(pool.values, seen)
+        return size
+
+
+class _RowView(object):
+    # a row of a ColumnarResult, read by column name or position
+
+    __slots__ = ('_result', '_row')
+
+    def __init__(self, result, row):
+        self._result = result
+        self._row = row
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, long)):
+            key = self._result._index[key]
+        return self._result.value(self._row, key)
+
+    def __len__(self):
+        return len(self._result.names)
+
+    def __iter__(self):
+        for i in xrange(len(self._result.names)):
+            yield self._result.value(self._row, i)
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+def normalize_query(query):
+    """
+    Return `query` with runs of whitespace outside quoted literals collapsed
+    to one space, so differently formatted copies of a query compare equal.
+    """
+    import re
+
+    parts = re.split(r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")''', query)
+    # the odd parts are the quoted literals
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part)
+                   for i, part in enumerate(parts)).strip()
+
+
+def _deep_sizeof(obj, seen):
+    # bytes used by `obj` and the containers and strings it holds. For
+    # instances (e.g. ORM objects) the attribute values are included, but
+    # only the shallow size of other objects they refer to (sessions,
+    # instance state, ...)
+    import sys
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(key, seen) + _deep_sizeof(value, seen)
+                    for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        attributes = vars(obj)
+        seen.add(id(attributes))
+        size += sys.getsizeof(attributes)
+        for value in attributes.itervalues():
+            if hasattr(value, '__dict__'):
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+            else:
+                size += _deep_sizeof(value, seen)
+    return size
+
+
+class QueryCache(object):
+    """
+    Read-through cache of query results, shared by any backend and thread.
+
+    Entries are keyed on the backend, the normalized query and its
+    parameters (see `key`), expire `ttl` seconds after they were loaded and
+    the least recently used entry is evicted once there are more than
+    `size`. Each entry can be tagged with the entity types it was read from
+    so writes can `invalidate` it (see `invalidate_on_write`).
+
+    Two threads missing the same key at once both load it.
+
+    Attributes
+    ----------
+    stats : dict
+        Number of 'hits', 'misses', 'expired', 'evicted' and 'invalidated'
+        entries since the last `clear`.
+    """
+
+    def __init__(self, size=128, ttl=60.0):
+        import collections
+        import threading
+
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiry time, tags, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.clear()
+
+    @staticmethod
+    def key(backend, query, params=None):
+        """
+        Return the cache key of `query` run with `params` (a mapping or a
+        sequence) on `backend`.
+        """
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        return backend, normalize_query(query), tuple(params or ())
+
+    def get(self, key):
+        """
+        Return (True, value) if `key` is cached and current, (False, None)
+        otherwise.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] <= timeit.default_timer():
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return True, entry[2]
+
+    def put(self, key, value, tags=()):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (timeit.default_timer() + self.ttl,
+                                  frozenset(tags), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def fetch(self, key, load, tags=()):
+        """
+        Return (value, hit): the cached value of `key`, or the result of
+        calling `load`, which is cached with `tags`.
+        """
+        hit, value = self.get(key)
+        if not hit:
+            value = load()
+            self.put(key, value, tags)
+        return value, hit
+
+    def invalidate(self, tag=None):
+        """
+        Drop the entries tagged with `tag`, or all of them if it is None.
+        """
+        with self._lock:
+            stale = [key for key, (_, tags, _) in self._entries.iteritems()
+                     if tag is None or tag in tags]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidated'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats = dict.fromkeys(
+                ('hits', 'misses', 'expired', 'evicted', 'invalidated'), 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size_bytes(self):
+        """
+        Return the approximate memory used by the cached keys and values.
+        """
+        with self._lock:
+            return _deep_sizeof(self._entries, set())
+
+
+# caches invalidated by ftrack_api writes, see `invalidate_on_write`
+_write_listeners = []
+
+
+def invalidate_on_write(cache):
+    """
+    Invalidate the entries of `cache` tagged with an entity type whenever an
+    ftrack_api session commits the creation or deletion of an entity of that
+    type. This covers every session of the process, including those of the
+    setup and bulk loaders.
+    """
+    import ftrack_api
+
+    _write_listeners.append(cache)
+    Session = ftrack_api.Session
+    if getattr(Session, '_invalidates_caches', False):
+        return
+
+    create, delete, commit = Session.create, Session.delete, Session.commit
+
+    def written(session):
+        # entity types created or deleted since the last commit
+        return session.__dict__.setdefault('_written_types', set())
+
+    def create_and_track(session, entity_type, *args, **kwargs):
+        written(session).add(entity_type)
+        return create(session, entity_type, *args, **kwargs)
+
+    def delete_and_track(session, entity):
+        written(session).add(entity.entity_type)
+        return delete(session, entity)
+
+    def commit_and_invalidate(session):
+        result = commit(session)
+        # only committed changes are visible to the other backends
+        for entity_type in written(session):
+            for listener in _write_listeners:
+                listener.invalidate(entity_type)
+        written(session).clear()
+        return result
+
+    Session._invalidates_caches = True
+    Session.create = create_and_track
+    Session.delete = delete_and_track
+    Session.commit = commit_and_invalidate
+
+
+FTRACK_CACHE_MODES = ('session', 'memory', 'file', 'shared')
+
+# FTRACK_CACHE mode -> cache shared by the sessions using it
+_ftrack_cache_stores = {}
+
+
+def ftrack_cache_store(mode):
+    """
+    Return the cache shared by every ftrack_api session of FTRACK_CACHE
+    `mode`, created on first use, or None for 'session'.
+
+    The 'shared' store is a dict in a `multiprocessing` manager process, so
+    it must be created before any worker process is started.
+    """
+    import ftrack_api.cache
+
+    assert mode in FTRACK_CACHE_MODES, \
+        "FTRACK_CACHE must be one of {0}".format(FTRACK_CACHE_MODES)
+    if mode == 'session':
+        return None
+    if mode not in _ftrack_cache_stores:
+        if mode == 'file':
+            store = ftrack_api.cache.FileCache(
+                global_data['FTRACK_CACHE_PATH'])
+        else:
+            store = ftrack_api.cache.MemoryCache()
+            if mode == 'shared':
+                import multiprocessing
+                store.manager = multiprocessing.Manager()
+                # MemoryCache only indexes, deletes and lists its dict
+                store._cache = store.manager.dict()
+        _ftrack_cache_stores[mode] = store
+    return _ftrack_cache_stores[mode]
+
+
+def ftrack_session():
+    """
+    Return a new ftrack_api session using FTRACK_CACHE and
+    FTRACK_AUTO_POPULATE.
+
+    Entities are stored in the FTRACK_CACHE store serialised, and decoded
+    into whichever session reads them, so sessions never share instances.
+    """
+    import ftrack_api
+    import ftrack_api.cache
+
+    store = ftrack_cache_store(global_data['FTRACK_CACHE'])
+
+    def cache(session):
+        if store is None:
+            return None
+        return ftrack_api.cache.SerialisedCache(
+            store, encode=session.encode, decode=session.decode)
+
+    return ftrack_api.Session(
+        server_url=global_data['FTRACK_SERVER'],
+        api_key=global_data['FTRACK_APIKEY'],
+        auto_populate=global_data['FTRACK_AUTO_POPULATE'] == '1',
+        # only HubEventFeed listens to events
+        auto_connect_event_hub=False,
+        cache=cache)
+
+
+def ftrack_attributes():
+    """
+    Return the FTRACK_ATTRIBUTES the ftrack tests read from each shot, and
+    the projection of their query: only the name when the attributes are
+    left to auto-population.
+    """
+    names = [name.strip()
+             for name in global_data['FTRACK_ATTRIBUTES'].split(',')
+             if name.strip()]
+    projection = ['name']
+    if global_data['FTRACK_AUTO_POPULATE'] != '1':
+        projection.extend(names)
+    return names, ', '.join(projection)
+
+
+def read_attributes(entities, names):
+    """
+    Read the attributes `names` of every entity, as a client listing them
+    would.
+    """
+    for name in names:
+        for entity in entities:
+            entity[name]
+        ftrack_requests.read(name, len(entities))
+
+
+def zipf_pattern(n, count, exponent=1.0, rng=None):
+    """
+    Return `count` indexes into `n` keys, index k drawn with a probability
+    proportional to 1 / (k + 1) ** exponent, as in the skewed access of
+    real clients where a few keys get most of the requests.
+
+    Parameters
+    ----------
+    rng : random.Random
+        Source of randomness; seed it to replay the same pattern.
+    """
+    import bisect
+    import random
+
+    rng = rng or random.Random()
+    cumulative = []
+    total = 0.0
+    for k in xrange(n):
+        total += 1.0 / (k + 1) ** exponent
+        cumulative.append(total)
+    return [min(bisect.bisect_left(cumulative, rng.random() * total), n - 1)
+            for _ in xrange(count)]
+
+
+# how fanout_01/02 issue their per-sequence queries
+FANOUT_MODES = ('sequential', 'threads', 'async')
+
+
+def run_coroutines(coroutines):
+    """
+    Run generator `coroutines` to completion in the calling thread,
+    interleaving them whenever they wait on a socket.
+
+    A coroutine yields (fileno, 'read' or 'write') to be resumed once that
+    file descriptor is ready; all waiting descriptors are multiplexed with
+    a single select. This stands in for an asyncio event loop, which python
+    2 does not have. The first exception raised by a coroutine is raised
+    from here, leaving the others to be closed when collected.
+    """
+    import select
+
+    readers = {}
+    writers = {}
+    ready = list(coroutines)
+    while ready or readers or writers:
+        for coroutine in ready:
+            try:
+                fileno, event = next(coroutine)
+            except StopIteration:
+                continue
+            waiting = readers if event == 'read' else writers
+            waiting[fileno] = coroutine
+        if not readers and not writers:
+            break
+        readable, writable, _ = select.select(list(readers), list(writers),
+                                              [])
+        ready = ([readers.pop(x) for x in readable] +
+                 [writers.pop(x) for x in writable])
+
+
+def mysql_coroutine(url, statement, jobs, done):
+    """
+    Coroutine (see `run_coroutines`) running `statement(key)` for keys
+    taken from the shared iterator `jobs` over its own MySQLdb connection,
+    appending (seconds, rows) for each to `done`.
+
+    Each query is sent with MySQLdb's non-blocking `send_query`, and its
+    result read once the connection's socket turns readable. Connecting
+    blocks.
+    """
+    timer = timeit.default_timer
+    conn = connect_db(url).connection
+    try:
+        for key in jobs:
+            start = timer()
+            conn.send_query(statement(key))
+            yield conn.fileno(), 'read'
+            conn.read_query_result()
+            rows = conn.store_result().fetch_row(0)
+            done.append((timer() - start, len(rows)))
+    finally:
+        conn.close()
+
+
+def ftrack_coroutine(expression, jobs, done):
+    """
+    Coroutine (see `run_coroutines`) posting the query `expression(key)`
+    for keys taken from the shared iterator `jobs` to the JSON api of
+    FTRACK_SERVER, appending (seconds, rows) for each to `done`.
+
+    It talks HTTP/1.1 over one non-blocking keep-alive socket, as
+    ftrack_api's requests session would, reconnecting if the server closes
+    it. Only http:// servers are supported.
+    """
+    import errno
+    import getpass
+    import json
+    import os
+    import socket
+    import urlparse
+    import ftrack_api.exception
+
+    url = urlparse.urlsplit(global_data['FTRACK_SERVER'])
+    assert url.scheme == 'http', \
+        "FANOUT_MODE='async' needs an http:// FTRACK_SERVER"
+    head = '\r\n'.join([
+        'POST {0}/api HTTP/1.1'.format(url.path.rstrip('/')),
+        'Host: {0}'.format(url.netloc),
+        'Content-Type: application/json',
+        'Accept: application/json',
+        'ftrack-api-key: {0}'.format(global_data['FTRACK_APIKEY']),
+        'ftrack-user: {0}'.format(
+            os.environ.get('FTRACK_API_USER') or getpass.getuser()),
+        'Content-Length: {0}', '', ''])
+    timer = timeit.default_timer
+    sock = None
+
+    def receive():
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise socket.error('{0} closed the connection'.format(
+                url.netloc))
+        return chunk
+
+    try:
+        for key in jobs:
+            body = json.dumps([dict(action='query',
+                                    expression=expression(key))])
+            request = head.format(len(body)) + body
+            start = timer()
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                error = sock.connect_ex((url.hostname, url.port or 80))
+                if error not in (0, errno.EINPROGRESS):
+                    raise socket.error(error, os.strerror(error))
+                yield sock.fileno(), 'write'
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise socket.error(error, os.strerror(error))
+                data = ''
+            while request:
+                yield sock.fileno(), 'write'
+                request = request[sock.send(request):]
+
+            while '\r\n\r\n' not in data:
+                yield sock.fileno(), 'read'
+                data += receive()
+            header, data = data.split('\r\n\r\n', 1)
+            lines = header.split('\r\n')
+            status = int(lines[0].split()[1])
+            headers = dict((name.strip().lower(), value.strip())
+                           for name, value in (x.split(':', 1)
+                                               for x in lines[1:]))
+            if headers.get('transfer-encoding') == 'chunked':
+                chunks = []
+                while True:
+                    while '\r\n' not in data:
+                        yield sock.fileno(), 'read'
+                        data += receive()
+                    line, data = data.split('\r\n', 1)
+                    length = int(line.split(';')[0], 16)
+                    while len(data) < length + 2:
+                        yield sock.fileno(), 'read'
+                        data += receive()
+                    chunks.append(data[:length])
+                    data = data[length + 2:]
+                    if not length:
+                        break
+                payload = ''.join(chunks)
+            else:
+                length = int(headers.get('content-length', 0))
+                while len(data) < length:
+                    yield sock.fileno(), 'read'
+                    data += receive()
+                payload, data = data[:length], data[length:]
+            if headers.get('connection', '').lower() == 'close':
+                sock.close()
+                sock = None
+
+            if status != 200:
+                raise ftrack_api.exception.ServerError(
+                    'Server responded with {0}: {1}'.format(status, payload))
+            result = json.loads(payload)
+            if 'exception' in result:
+                raise ftrack_api.exception.ServerError(
+                    'Server reported error: {0}({1})'.format(
+                        result['exception'], result['content']))
+            done.append((timer() - start, len(result[0]['data'])))
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def fan_out_queries(keys, conn, query, connect, close, coroutine,
+                    mode=None):
+    """
+    Run one query per key and return the total number of rows.
+
+    FANOUT_MODE (or `mode`) picks how:
+
+    sequential
+        `query(conn, key)`, returning the rows, for one key after another.
+    threads
+        FANOUT_LIMIT threads, each running `query` over its own
+        `connect()`ion (closed with `close`) for the next key not taken.
+    async
+        FANOUT_LIMIT `coroutine(jobs, done)`s sharing the keys, run in this
+        thread by `run_coroutines`.
+
+    The number of queries and rows, the 50th and 90th percentile and
+    slowest query's seconds and the queries per second are recorded for the
+    run. Per-query times leave out connecting, which the threads and
+    coroutines do inside the run.
+    """
+    import threading
+
+    mode = mode or global_data['FANOUT_MODE']
+    assert mode in FANOUT_MODES, \
+        "FANOUT_MODE must be one of {0}".format(FANOUT_MODES)
+    workers = min(int(global_data['FANOUT_LIMIT']), len(keys))
+    timer = timeit.default_timer
+    # (seconds, rows) per query; list.append is atomic
+    done = []
+    start = timer()
+    if mode == 'sequential':
+        for key in keys:
+            began = timer()
+            rows = query(conn, key)
+            done.append((timer() - began, len(rows)))
+    elif mode == 'threads':
+        jobs = iter(keys)
+        lock = threading.Lock()
+        errors = []
+
+        def worker():
+            try:
+                own = connect()
+                try:
+                    while True:
+                        with lock:
+                            key = next(jobs, None)
+                        if key is None:
+                            return
+                        began = timer()
+                        rows = query(own, key)
+                        done.append((timer() - began, len(rows)))
+                finally:
+                    close(own)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+    else:
+        jobs = iter(keys)
+        run_coroutines([coroutine(jobs, done) for _ in range(workers)])
+    elapsed = timer() - start
+
+    latencies = [x[0] for x in done]
+    rows = sum(x[1] for x in done)
+    phase.record('queries', len(done))
+    phase.record('rows', rows)
+    phase.record('query_p50', percentile(latencies, 50))
+    phase.record('query_p90', percentile(latencies, 90))
+    phase.record('query_max', max(latencies) if latencies else 0.0)
+    if elapsed:
+        phase.record('queries_per_sec', len(done) / elapsed)
+    return rows
+
+
+# -----------------------------------------------------------------------------
+# Tests
+
+
+def setup_ftrack(ctx):
+    """
+    Get all shots of a sequence via the ftrack_api.
+    """
+    # ----------------------------------------------------------------------
+    # FTrack
+
+    import os
+    # overwrite this so we don't crawl any directories
+    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+
+    import ftrack_api
+
+
+def test_ftrack_01(ctx):
+    """
+    Get all shots of a sequence via the ftrack_api.
+    """
+    with phase('connect'):
+        session = acquire_connection('ftrack')
+
+    attributes, projection = ftrack_attributes()
+    expression = (
+        'select {0} from Shot where project.name = "{1}" and '
+        'parent.name = "{2}"'.format(projection,
+                                     global_data['PROJECT_NAME'],
+                                     global_data['SEQUENCE_NAME']))
+    with phase('query'):
+        r = session.query(expression)
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(ftrack_stream(
+                session, expression,
+                int(global_data['STREAM_CHUNK_SIZE'])), 'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x['name'] for x in rows]
+        if attributes:
+            with phase('attributes'):
+                read_attributes(rows, attributes)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row['name']
+
+
+def test_ftrack_02(ctx):
+    """
+    Test retrieving a all shots.
+    """
+    with phase('connect'):
+        session = acquire_connection('ftrack')
+
+    def shot_page(session, size, offset, after, before):
+        seek = ['id {0} "{1}"'.format(op, value)
+                for op, value in (('>', after), ('<', before))
+                if value is not None]
+        expression = 'select id, name from Shot{0} order by id ' \
+            'offset {1} limit {2}'.format(
+                ' where ' + ' and '.join(seek) if seek else '',
+                offset or 0, size)
+        page = [(shot['id'], shot['name']) for shot in
+                session.query(expression, page_size=size).all()]
+        # only the session's own memory cache, not FTRACK_CACHE
+        session.cache.caches[0].clear()
+        return page
+
+    if global_data['RESULT_MODE'] == 'paged':
+        with phase('pages'):
+            num = fetch_pages('ftrack', session, shot_page)
+        print "num shots:", num
+        return
+
+    attributes, projection = ftrack_attributes()
+    expression = 'select {0} from Shot'.format(projection)
+    with phase('query'):
+        r = session.query(expression)
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(ftrack_stream(
+                session, expression,
+                int(global_data['STREAM_CHUNK_SIZE'])), 'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x['name'] for x in rows]
+        if attributes:
+            with phase('attributes'):
+                read_attributes(rows, attributes)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row['name']
+
+
+def setup_sqlalchemy(ctx):
+    """
+    Get all shots of a sequence with sqlalchemy and some quick models.
+    """
+    # ----------------------------------------------------------------------
+    # SQLAlchemy
+
+    from sqlalchemy.orm import (
+        Session, relationship, backref,
+        lazyload, joinedload, subqueryload, selectinload
+    )
+    from sqlalchemy import (
+        create_engine,
+        Column, String, Date, Boolean, Float,
+        ForeignKey
+    )
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.ext import baked
+
+    Base = declarative_base()
+
+    class Context(Base):
+        __tablename__ = 'context'
+
+        context_type = Column(String)
+        id = Column(String, primary_key=True)
+        parent_id = Column(String, ForeignKey('context.id'))
+        name = Column(String)
+
+        shot = relationship('Shot', uselist=False)
+        sequence = relationship('Sequence', uselist=False)
+        project = relationship('Project', uselist=False)
+
+        children = relationship(
+            'Context', backref=backref('parent', remote_side=[id]))
+
+    class Project(Base):
+        __tablename__ = 'show'
+
+        showid = Column(String, ForeignKey('context.id'), primary_key=True)
+        fullname = Column(String)
+        root = Column(String)
+        startdate = Column(Date)
+        enddate = Column(Date)
+        status = Column(String)
+        diskid = Column(String)
+        projectschemeid = Column(String)
+        thumbid = Column(String)
+        isglobal = Column(Boolean)
+
+        context = relationship('Context', uselist=False)
+
+    class ObjectType(Base):
+        # only declared so the task.object_typeid foreign key resolves
+        __tablename__ = 'object_type'
+
+        typeid = Column(String, primary_key=True)
+
+    class _Task(Base):
+        __tablename__ = 'task'
+        _object_type_id = '*'
+
+        taskid = Column(String, ForeignKey('context.id'), primary_key=True)
+        description = Column(String)
+        startdate = Column(Date)
+        enddate = Column(Date)
+        statusid = Column(String)
+        typeid = Column(String)
+        isopen = Column(Boolean)
+        thumbid = Column(String)
+        sort = Column(Float)
+        object_typeid = Column(String, ForeignKey('object_type.typeid'))
+        showid = Column(String, ForeignKey('show.showid'))
+        priorityid = Column(String)
+
+        context = relationship('Context', uselist=False)
+
+        __mapper_args__ = {
+            'polymorphic_identity': _object_type_id,
+            'polymorphic_on': object_typeid
+        }
+
+        @property
+        def name(self):
+            return self.context.name
+
+    class Sequence(_Task):
+        _object_type_id = 'e5139355-61da-4c8f-9db4-3abc870166bc'
+
+        __mapper_args__ = {
+            'polymorphic_identity': _object_type_id
+        }
+
+        project = relationship('Project', uselist=False)
+
+    class Shot(_Task):
+        _object_type_id = 'bad911de-3bd6-47b9-8b46-3476e237cb36'
+
+        __mapper_args__ = {
+            'polymorphic_identity': _object_type_id
+        }
+
+    # cached query construction and compilation for SQLALCHEMY_STATEMENTS
+    ctx.bakery = baked.bakery()
+    ctx.Base = Base
+    ctx.Context = Context
+    ctx.Project = Project
+    ctx.Sequence = Sequence
+    ctx.Shot = Shot
+    # SQLALCHEMY_LOADING -> loader option for relationships read per row
+    ctx.loaders = dict(lazy=lazyload, joined=joinedload,
+                       subquery=subqueryload, selectin=selectinload)
+
+
+def test_sqlalchemy_01(ctx):
+    """
+    Get all shots of a sequence with sqlalchemy and some quick models.
+    """
+    fmt = materialize_format('tuple')
+    mode = statement_mode('SQLALCHEMY_STATEMENTS', ('construct', 'baked'))
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    def shots_query(session, sequence_name, project_name):
+        # FIXME: probably am not doing this as efficiently as we could be...
+        subq = session.query(ctx.Context)\
+            .filter(ctx.Context.sequence)\
+            .filter(ctx.Context.name == sequence_name)\
+            .join(ctx.Project,
+                  ctx.Project.showid == ctx.Context.parent_id)\
+            .filter(ctx.Project.fullname == project_name)\
+            .subquery()
+
+        return session.query(ctx.Context if fmt == 'orm'
+                             else ctx.Context.name)\
+            .filter(ctx.Context.shot)\
+            .join(subq, subq.c.id == ctx.Context.parent_id)
+
+    with phase('query'):
+        if mode == 'baked':
+            from sqlalchemy import bindparam
+            # built and compiled once per format, then only bound
+            r = ctx.bakery(lambda session: shots_query(
+                session, bindparam('sequence'), bindparam('project')),
+                fmt)(session).params(
+                    sequence=global_data['SEQUENCE_NAME'],
+                    project=global_data['PROJECT_NAME'])
+        else:
+            r = shots_query(session, global_data['SEQUENCE_NAME'],
+                            global_data['PROJECT_NAME'])
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])), 0)
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        start = timeit.default_timer()
+        with phase('execute'):
+            rows = query_rows(session, r, fmt)
+        with phase('materialize'):
+            if fmt == 'orm':
+                shots = [x.name for x in rows]
+            else:
+                key = 0 if fmt == 'tuple' else 'name'
+                shots = [x[key] for x in rows]
+        record_result(rows, timeit.default_timer() - start)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row[0]
+
+
+def test_sqlalchemy_02(ctx):
+    """
+    Test retrieving all shots.
+    """
+    fmt = materialize_format('orm')
+    mode = statement_mode('SQLALCHEMY_STATEMENTS', ('construct', 'baked'))
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    def shots_query(session):
+        if fmt == 'orm':
+            return session.query(ctx.Shot)
+        # only the names, not full Shot objects
+        return session.query(ctx.Context.name)\
+            .join(ctx.Shot, ctx.Shot.taskid == ctx.Context.id)
+
+    def shot_page(session, size, offset, after, before):
+        query = session.query(ctx.Context.id, ctx.Context.name)\
+            .join(ctx.Shot, ctx.Shot.taskid == ctx.Context.id)
+        if after is not None:
+            query = query.filter(ctx.Context.id > after)
+        if before is not None:
+            query = query.filter(ctx.Context.id < before)
+        return query.order_by(ctx.Context.id).offset(offset).limit(size)\
+            .all()
+
+    if global_data['RESULT_MODE'] == 'paged':
+        with phase('pages'):
+            num = fetch_pages('sqlalchemy', session, shot_page)
+        print "num shots:", num
+        return
+
+    with phase('query'):
+        if mode == 'baked':
+            r = ctx.bakery(shots_query, fmt)(session)
+        else:
+            r = shots_query(session)
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])))
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        start = timeit.default_timer()
+        with phase('execute'):
+            rows = query_rows(session, r, fmt)
+        with phase('materialize'):
+            if fmt == 'orm':
+                shots = list(rows)
+            else:
+                key = 0 if fmt == 'tuple' else 'name'
+                shots = [x[key] for x in rows]
+        record_result(rows, timeit.default_timer() - start)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row
+
+
+def sqlalchemy_loader(ctx):
+    """
+    Return the loader option for SQLALCHEMY_LOADING.
+
+    Subquery eager loading needs the whole result up front, so sqlalchemy
+    refuses to combine it with the yield_per of RESULT_MODE='stream'.
+    """
+    loading = global_data['SQLALCHEMY_LOADING']
+    assert not (loading == 'subquery' and
+                global_data['RESULT_MODE'] == 'stream'), \
+        "SQLALCHEMY_LOADING='subquery' can not stream, use 'selectin' " \
+        "or RESULT_MODE='all'"
+    return ctx.loaders[loading]
+
+
+def test_sqlalchemy_03(ctx):
+    """
+    Test retrieving all shots with their names, loading the context of each
+    shot according to SQLALCHEMY_LOADING.
+    """
+    load = sqlalchemy_loader(ctx)
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    with phase('query'):
+        r = session.query(ctx.Shot).options(load(ctx.Shot.context))
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                x.name for x in
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])))
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x.name for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row.name
+
+
+def test_sqlalchemy_04(ctx):
+    """
+    Get the shots of a sequence with their names, loading the context of each
+    shot according to SQLALCHEMY_LOADING.
+    """
+    load = sqlalchemy_loader(ctx)
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    with phase('query'):
+        subq = session.query(ctx.Context)\
+            .filter(ctx.Context.sequence)\
+            .filter_by(name=global_data['SEQUENCE_NAME'])\
+            .join(ctx.Project,
+                  ctx.Project.showid == ctx.Context.parent_id)\
+            .filter(ctx.Project.fullname == global_data['PROJECT_NAME'])\
+            .subquery()
+
+        r = session.query(ctx.Shot)\
+            .join(ctx.Context, ctx.Context.id == ctx.Shot.taskid)\
+            .join(subq, subq.c.id == ctx.Context.parent_id)\
+            .options(load(ctx.Shot.context))
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                x.name for x in
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])))
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x.name for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row.name
+
+
+def setup_mysql(ctx):
+    """
+    Get all shots of a sequence using MySQLdb directly.
+    """
+    # ----------------------------------------------------------------------
+    # MYSQL
+
+    from sqlalchemy.engine.url import make_url
+    global_data['DB_URI'] = make_url(global_data['DB_URI'])
+
+
+def test_mysql_01(ctx):
+    """
+    Get all shots of a sequence using MySQLdb directly.
+    """
+    with phase('connect'):
+        session = acquire_connection('mysql')
+
+    mode = statement_mode('MYSQL_STATEMENTS',
+                          ('literal', 'bound', 'prepared'))
+    with phase('build'):
+        query, params = build_statement(session, '''
+            SELECT context.name FROM task, context
+            JOIN (
+                SELECT * FROM context
+                JOIN `show` ON `show`.showid = context.parent_id
+                WHERE context.name = {0}
+                AND show.fullname = {1}
+            ) AS anon_1 ON anon_1.id = context.parent_id
+            WHERE task.taskid = context.id
+            AND task.object_typeid IN ('bad911de-3bd6-47b9-8b46-3476e237cb36')
+            ''', [global_data['SEQUENCE_NAME'], global_data['PROJECT_NAME']],
+            mode)
+
+    fmt = materialize_format('dict', ('tuple', 'dict', 'columnar'))
+    r = result_cursor(session, fmt)
+    if global_data['RESULT_MODE'] != 'stream':
+        execute_statement(r, 'shots_of_sequence', query, params, mode)
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(stream_query(
+                session, query, int(global_data['STREAM_CHUNK_SIZE'])),
+                'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        start = timeit.default_timer()
+        with phase('fetch'):
+            if fmt == 'columnar':
+                rows = ColumnarResult.fetch(
+                    r, int(global_data['STREAM_CHUNK_SIZE']))
+            else:
+                rows = r.fetchall()
+        with phase('materialize'):
+            key = 0 if fmt == 'tuple' else 'name'
+            shots = [x[key] for x in rows]
+        record_result(rows, timeit.default_timer() - start)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('fetch'):
+            row = r.fetchone()
+        print row['name']
+
+
+def test_mysql_02(ctx):
+    """
+    Test retrieving all shots.
+    """
+    with phase('connect'):
+        session = acquire_connection('mysql')
+
+    def shot_page(cursor, size, offset, after, before):
+        values = ['bad911de-3bd6-47b9-8b46-3476e237cb36']
+        seek = ''
+        for op, value in (('>', after), ('<', before)):
+            if value is not None:
+                seek += ' AND context.id {0} {{{1}}}'.format(op, len(values))
+                values.append(value)
+        query, params = build_statement(cursor, '''
+            SELECT context.id, context.name FROM task, context
+            WHERE context.id = task.taskid
+            AND task.object_typeid = {0}''' + seek, values, 'bound')
+        page = result_cursor(cursor, 'tuple')
+        page.execute(query + ' ORDER BY context.id LIMIT {0} OFFSET {1}'
+                     .format(size, offset or 0), params)
+        return page.fetchall()
+
+    if global_data['RESULT_MODE'] == 'paged':
+        with phase('pages'):
+            num = fetch_pages('mysql', session, shot_page)
+        print "num shots:", num
+        return
+
+    mode = statement_mode('MYSQL_STATEMENTS',
+                          ('literal', 'bound', 'prepared'))
+    with phase('build'):
+        query, params = build_statement(session, '''
+            SELECT context.name FROM task, context
+            WHERE context.id = task.taskid
+            AND task.object_typeid IN ({0})
+            ''', ['bad911de-3bd6-47b9-8b46-3476e237cb36'], mode)
+
+    fmt = materialize_format('dict', ('tuple', 'dict', 'columnar'))
+    r = result_cursor(session, fmt)
+    if global_data['RESULT_MODE'] != 'stream':
+        execute_statement(r, 'all_shots', query, params, mode)
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(stream_query(
+                session, query, int(global_data['STREAM_CHUNK_SIZE'])),
+                'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        start = timeit.default_timer()
+        with phase('fetch'):
+            if fmt == 'columnar':
+                rows = ColumnarResult.fetch(
+                    r, int(global_data['STREAM_CHUNK_SIZE']))
+            else:
+                rows = r.fetchall()
+        with phase('materialize'):
+            key = 0 if fmt == 'tuple' else 'name'
+            shots = [x[key] for x in rows]
+        record_result(rows, timeit.default_timer() - start)
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('fetch'):
+            row = r.fetchone()
+        print "shot name:", row['name']
+
+
+def setup_closure(ctx):
+    """
+    Find shots through the context_closure hierarchy index (see
+    `build_hierarchy_index`), with MySQLdb (closure_01/02) or sqlalchemy
+    (closure_03/04). The index is built first if missing or stale.
+    """
+    from sqlalchemy import Column, String, Integer, ForeignKey
+
+    setup_sqlalchemy(ctx)
+    setup_mysql(ctx)
+    ensure_hierarchy_index()
+
+    class ContextClosure(ctx.Base):
+        __tablename__ = 'context_closure'
+
+        ancestor_id = Column(String, ForeignKey('context.id'),
+                             primary_key=True)
+        descendant_id = Column(String, ForeignKey('context.id'),
+                               primary_key=True)
+        depth = Column(Integer)
+        object_typeid = Column(String)
+
+    ctx.ContextClosure = ContextClosure
+
+
+def test_closure_01(ctx):
+    """
+    Get all shots of a sequence using MySQLdb and the hierarchy index.
+    """
+    with phase('connect'):
+        session = acquire_connection('mysql')
+
+    query = '''
+        SELECT context.name FROM `show`
+        JOIN context_closure AS seq_link
+            ON seq_link.ancestor_id = `show`.showid
+            AND seq_link.object_typeid = '{2}'
+        JOIN context AS sequence ON sequence.id = seq_link.descendant_id
+        JOIN context_closure AS shot_link
+            ON shot_link.ancestor_id = sequence.id
+            AND shot_link.object_typeid = '{3}'
+        JOIN context ON context.id = shot_link.descendant_id
+        WHERE `show`.fullname = '{1}'
+        AND sequence.name = '{0}'
+        '''.format(global_data['SEQUENCE_NAME'], global_data['PROJECT_NAME'],
+                   ctx.Sequence._object_type_id, ctx.Shot._object_type_id)
+
+    if global_data['RESULT_MODE'] != 'stream':
+        with phase('execute'):
+            session.execute(query)
+    r = session
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(stream_query(
+                session, query, int(global_data['STREAM_CHUNK_SIZE'])),
+                'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('fetch'):
+            rows = r.fetchall()
+        with phase('materialize'):
+            shots = [x['name'] for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('fetch'):
+            row = r.fetchone()
+        print row['name']
+
+
+def test_closure_02(ctx):
+    """
+    Test retrieving all shots of every project using MySQLdb and the
+    hierarchy index.
+    """
+    with phase('connect'):
+        session = acquire_connection('mysql')
+
+    query = '''
+        SELECT context.name FROM `show`
+        JOIN context_closure AS shot_link
+            ON shot_link.ancestor_id = `show`.showid
+            AND shot_link.object_typeid = '{0}'
+        JOIN context ON context.id = shot_link.descendant_id
+        '''.format(ctx.Shot._object_type_id)
+
+    if global_data['RESULT_MODE'] != 'stream':
+        with phase('execute'):
+            session.execute(query)
+    r = session
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(stream_query(
+                session, query, int(global_data['STREAM_CHUNK_SIZE'])),
+                'name')
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('fetch'):
+            rows = r.fetchall()
+        with phase('materialize'):
+            shots = [x['name'] for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('fetch'):
+            row = r.fetchone()
+        print "shot name:", row['name']
+
+
+def test_closure_03(ctx):
+    """
+    Get all shots of a sequence with sqlalchemy and the hierarchy index.
+    """
+    from sqlalchemy.orm import aliased
+
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    with phase('query'):
+        sequence = aliased(ctx.Context)
+        seq_link = aliased(ctx.ContextClosure)
+        shot_link = aliased(ctx.ContextClosure)
+        r = session.query(ctx.Context.name)\
+            .join(shot_link, shot_link.descendant_id == ctx.Context.id)\
+            .join(sequence, sequence.id == shot_link.ancestor_id)\
+            .join(seq_link, seq_link.descendant_id == sequence.id)\
+            .join(ctx.Project, ctx.Project.showid == seq_link.ancestor_id)\
+            .filter(shot_link.object_typeid == ctx.Shot._object_type_id)\
+            .filter(seq_link.object_typeid == ctx.Sequence._object_type_id)\
+            .filter(sequence.name == global_data['SEQUENCE_NAME'])\
+            .filter(ctx.Project.fullname == global_data['PROJECT_NAME'])
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])), 0)
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x[0] for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row[0]
+
+
+def test_closure_04(ctx):
+    """
+    Test retrieving all shots of every project with sqlalchemy and the
+    hierarchy index.
+    """
+    with phase('connect'):
+        session = acquire_connection('sqlalchemy')
+
+    with phase('query'):
+        r = session.query(ctx.Context.name)\
+            .join(ctx.ContextClosure,
+                  ctx.ContextClosure.descendant_id == ctx.Context.id)\
+            .join(ctx.Project,
+                  ctx.Project.showid == ctx.ContextClosure.ancestor_id)\
+            .filter(ctx.ContextClosure.object_typeid ==
+                    ctx.Shot._object_type_id)
+
+    if global_data['RESULT_MODE'] == 'stream':
+        with phase('stream'):
+            num = consume_stream(
+                r.yield_per(int(global_data['STREAM_CHUNK_SIZE'])), 0)
+        print "num shots:", num
+    elif global_data['RESULT_MODE'] == 'all':
+        with phase('execute'):
+            rows = r.all()
+        with phase('materialize'):
+            shots = [x[0] for x in rows]
+        phase.record('rows', len(shots))
+        print "num shots:", len(shots)
+    else:
+        with phase('execute'):
+            row = r.first()
+        print "shot name:", row[0]
+
+
+def setup_cache(ctx):
+    """
+    Replay a Zipf distributed stream of "shots of project X / sequence Y"
+    requests through a QueryCache in front of QUERY_CACHE_BACKEND.
+    """
+    import os
+    import random
+
+    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+    backend = global_data['QUERY_CACHE_BACKEND']
+    assert backend in ('ftrack', 'sqlalchemy', 'mysql'), \
+        "QUERY_CACHE_BACKEND must be 'ftrack', 'sqlalchemy' or 'mysql'"
+    if backend == 'sqlalchemy':
+        setup_sqlalchemy(ctx)
+    elif backend == 'mysql':
+        setup_mysql(ctx)
+
+    ctx.cache = QueryCache(int(global_data['QUERY_CACHE_SIZE']),
+                           float(global_data['QUERY_CACHE_TTL']))
+    if global_data['QUERY_CACHE_INVALIDATE'] == '1':
+        invalidate_on_write(ctx.cache)
+
+    # the same pattern for every run (and every worker) of a given seed
+    sizes = _local_store_sizes()
+    rng = random.Random(int(global_data['QUERY_CACHE_SEED']))
+    ctx.keys = [('perf_test_{0}'.format(project), 'seq_{0}'.format(sequence))
+                for project in range(1, sizes['PROJECTS'] + 1)
+                for sequence in range(1, sizes['SEQUENCES_PER_PROJECT'] + 1)]
+    rng.shuffle(ctx.keys)
+    requests = int(global_data['QUERY_CACHE_REQUESTS'])
+    ctx.pattern = zipf_pattern(len(ctx.keys), requests,
+                               float(global_data['QUERY_CACHE_ZIPF']), rng)
+    ctx.writes = frozenset(rng.sample(
+        xrange(requests),
+        int(requests * float(global_data['QUERY_CACHE_WRITES']))))
+    print 'replaying {0} requests over {1} sequences, {2} writes'.format(
+        requests, len(ctx.keys), len(ctx.writes))
+
+    if ctx.writes:
+        import ftrack_api
+        session = ftrack_api.Session(
+            server_url=global_data['FTRACK_SERVER'],
+            api_key=global_data['FTRACK_APIKEY'],
+            auto_connect_event_hub=False)
+        ctx.shot_status_id = session.query(
+            'ProjectSchema').first().get_statuses('Shot')[0]['id']
+        session.close()
+
+
+def _cache_request(ctx, session, project, sequence):
+    # (key, load) of the shots of a sequence query on QUERY_CACHE_BACKEND
+    backend = global_data['QUERY_CACHE_BACKEND']
+    if backend == 'ftrack':
+        expression = (
+            'select name from Shot where project.name = "{0}" and '
+            'parent.name = "{1}"'.format(project, sequence))
+        return (QueryCache.key(backend, expression),
+                lambda: [x['name'] for x in session.query(expression).all()])
+
+    if backend == 'sqlalchemy':
+        subq = session.query(ctx.Context)\
+            .filter(ctx.Context.sequence)\
+            .filter_by(name=sequence)\
+            .join(ctx.Project,
+                  ctx.Project.showid == ctx.Context.parent_id)\
+            .filter(ctx.Project.fullname == project)\
+            .subquery()
+        query = session.query(ctx.Context.name)\
+            .filter(ctx.Context.shot)\
+            .join(subq, subq.c.id == ctx.Context.parent_id)
+        compiled = query.statement.compile()
+        return (QueryCache.key(backend, str(compiled), compiled.params),
+                lambda: [x[0] for x in query.all()])
+
+    query = '''
+        SELECT context.name FROM task, context
+        JOIN (
+            SELECT * FROM context
+            JOIN `show` ON `show`.showid = context.parent_id
+            WHERE context.name = '{0}'
+            AND show.fullname = '{1}'
+        ) AS anon_1 ON anon_1.id = context.parent_id
+        WHERE task.taskid = context.id
+        AND task.object_typeid IN ('bad911de-3bd6-47b9-8b46-3476e237cb36')
+        '''.format(sequence, project)
+
+    def load():
+        session.execute(query)
+        return [x['name'] for x in session.fetchall()]
+    return QueryCache.key(backend, query), load
+
+
+def _write_probe_shot(session, project, sequence, status_id):
+    # create and delete a shot through the api, as a pipeline tool would
+    parent = session.query(
+        'Sequence where name = "{0}" and project.name = "{1}"'.format(
+            sequence, project)).first()
+    shot = session.create('Shot', {
+        'name': 'cache_probe',
+        'parent': parent,
+        'status': session.get('Status', status_id)
+    })
+    session.commit()
+    session.delete(shot)
+    session.commit()
+
+
+def test_cache_01(ctx):
+    """
+    Replay the request pattern through the cache, starting empty, and
+    record the hit rate, the mean hit and miss latency and the memory used
+    by the cached results.
+    """
+    backend = global_data['QUERY_CACHE_BACKEND']
+    with phase('connect'):
+        session = acquire_connection(backend)
+        writer = None
+        if ctx.writes:
+            # a second acquire from the same pool would release the first
+            writer = session if backend == 'ftrack' \
+                else acquire_connection('ftrack')
+
+    ctx.cache.clear()
+    timer = timeit.default_timer
+    latency = {True: 0.0, False: 0.0}
+    for i, index in enumerate(ctx.pattern):
+        project, sequence = ctx.keys[index]
+        if i in ctx.writes:
+            with phase('write'):
+                _write_probe_shot(writer, project, sequence,
+                                  ctx.shot_status_id)
+            continue
+        start = timer()
+        key, load = _cache_request(ctx, session, project, sequence)
+        _, hit = ctx.cache.fetch(key, load, tags=('Shot',))
+        latency[hit] += timer() - start
+
+    stats = ctx.cache.stats
+    for name in ('hits', 'misses', 'expired', 'evicted', 'invalidated'):
+        phase.record('cache_' + name, stats[name])
+    hit_rate = float(stats['hits']) / max(stats['hits'] + stats['misses'], 1)
+    phase.record('cache_hit_rate', hit_rate)
+    if stats['hits']:
+        phase.record('cache_hit_seconds', latency[True] / stats['hits'])
+    if stats['misses']:
+        phase.record('cache_miss_seconds', latency[False] / stats['misses'])
+    phase.record('cache_entries', len(ctx.cache))
+    phase.record('cache_kb', ctx.cache.size_bytes() / 1024.0)
+    print "hit rate: {0:.1%}".format(hit_rate)
+
+
+def setup_fanout(ctx):
+    """
+    Get the shots of every sequence of a project, one query per sequence,
+    one after another or FANOUT_LIMIT at a time (see FANOUT_MODE).
+    """
+    import ftrack_api
+
+    setup_ftrack(ctx)
+    setup_mysql(ctx)
+    mode = global_data['FANOUT_MODE']
+    assert mode in FANOUT_MODES, \
+        "FANOUT_MODE must be one of {0}".format(FANOUT_MODES)
+    # sqlite has no non-blocking api to multiplex
+    ctx.mysql_mode = mode
+    if mode == 'async' and \
+            global_data['DB_URI'].drivername.startswith('sqlite'):
+        print "fanout_01 runs FANOUT_MODE='threads' on sqlite"
+        ctx.mysql_mode = 'threads'
+
+    session = ftrack_api.Session(
+        server_url=global_data['FTRACK_SERVER'],
+        api_key=global_data['FTRACK_APIKEY'],
+        auto_connect_event_hub=False)
+    ctx.sequences = sorted(x['name'] for x in session.query(
+        'select name from Sequence where project.name = "{0}"'.format(
+            global_data['PROJECT_NAME'])))
+    session.close()
+    print 'looking up the shots of {0} sequences'.format(len(ctx.sequences))
+
+
+def test_fanout_01(ctx):
+    """
+    Get the shots of every sequence of a project using MySQLdb directly.
+    """
+    import functools
+
+    url = global_data['DB_URI']
+
+    def statement(sequence):
+        return '''
+            SELECT context.name FROM task, context
+            JOIN (
+                SELECT * FROM context
+                JOIN `show` ON `show`.showid = context.parent_id
+                WHERE context.name = '{0}'
+                AND show.fullname = '{1}'
+            ) AS anon_1 ON anon_1.id = context.parent_id
+            WHERE task.taskid = context.id
+            AND task.object_typeid IN ('bad911de-3bd6-47b9-8b46-3476e237cb36')
+            '''.format(sequence, global_data['PROJECT_NAME'])
+
+    def query(cursor, sequence):
+        cursor.execute(statement(sequence))
+        return cursor.fetchall()
+
+    session = None
+    if ctx.mysql_mode == 'sequential':
+        with phase('connect'):
+            session = acquire_connection('mysql')
+    with phase('fanout'):
+        num = fan_out_queries(
+            ctx.sequences, session, query,
+            lambda: connect_db(url),
+            lambda cursor: cursor.connection.close(),
+            functools.partial(mysql_coroutine, url, statement),
+            ctx.mysql_mode)
+    print "num shots:", num
+
+
+def test_fanout_02(ctx):
+    """
+    Get the shots of every sequence of a project via the ftrack_api, or
+    its JSON api directly for FANOUT_MODE='async'.
+    """
+    import functools
+
+    def expression(sequence):
+        return ('select name from Shot where project.name = "{0}" and '
+                'parent.name = "{1}"'.format(global_data['PROJECT_NAME'],
+                                             sequence))
+
+    def query(session, sequence):
+        return session.query(expression(sequence)).all()
+
+    session = None
+    if global_data['FANOUT_MODE'] == 'sequential':
+        with phase('connect'):
+            session = acquire_connection('ftrack')
+    with phase('fanout'):
+        num = fan_out_queries(
+            ctx.sequences, session, query, ftrack_session,
+            lambda session: session.close(),
+            functools.partial(ftrack_coroutine, expression))
+    print "num shots:", num
+
+
+def setup_mirror(ctx):
+    """
+    Load the read mirror of the project and follow its events.
+    """
+    setup_ftrack(ctx)
+    if getattr(ctx, 'mirror', None) is not None:
+        ctx.mirror.stop()
+
+    session = ftrack_session()
+    # listen first, so no write between the load and the feed is missed
+    feed = event_feed()
+    ctx.mirror = ReadMirror(global_data['MIRROR_DB'],
+                            global_data['PROJECT_NAME'])
+    start = timeit.default_timer()
+    count = ctx.mirror.load(session)
+    elapsed = timeit.default_timer() - start
+    session.close()
+    print 'mirrored {0} contexts in {1:.2f}s ({2:.0f}/s)'.format(
+        count, elapsed, count / elapsed if elapsed else 0.0)
+    ctx.mirror.follow(feed)
+    ctx.storm_shots = ctx.mirror.all_shots()[
+        :int(global_data['MIRROR_STORM'])]
+
+
+def test_mirror_01(ctx):
+    """
+    Get all shots of a sequence from the read mirror.
+    """
+    with phase('query'):
+        shots = ctx.mirror.shots(global_data['SEQUENCE_NAME'])
+    phase.record('rows', len(shots))
+    print "num shots:", len(shots)
+
+
+def test_mirror_02(ctx):
+    """
+    Get all shots of the project from the read mirror.
+    """
+    with phase('query'):
+        shots = [x[1] for x in ctx.mirror.all_shots()]
+    phase.record('rows', len(shots))
+    print "num shots:", len(shots)
+
+
+def test_mirror_03(ctx):
+    """
+    Rename MIRROR_STORM shots and back through the api, MIRROR_STORM_BATCH
+    renames per commit, and wait for the read mirror to catch up.
+
+    Records the changes and events of the storm, the changes applied per
+    second from its start until the mirror caught up, how long that took
+    after the last commit, and the 50th/90th percentile and largest lag
+    of the events.
+    """
+    with phase('connect'):
+        session = acquire_connection('ftrack')
+
+    batch = int(global_data['MIRROR_STORM_BATCH'])
+    renames = ([(id, name + '_storm') for id, name in ctx.storm_shots] +
+               [(id, name) for id, name in ctx.storm_shots])
+    expected = ctx.mirror.applied + len(renames)
+    ctx.mirror.take_lags()
+
+    start = timeit.default_timer()
+    with phase('storm'):
+        for i in range(0, len(renames), batch):
+            session.call([
+                dict(action='update', entity_type='Shot', entity_key=[id],
+                     entity_data={'__entity_type__': 'Shot', 'name': name})
+                for id, name in renames[i:i + batch]])
+    committed = timeit.default_timer()
+    with phase('catch_up'):
+        ctx.mirror.wait_for(expected)
+    caught_up = timeit.default_timer()
+    elapsed = caught_up - start
+
+    lags = ctx.mirror.take_lags()
+    phase.record('storm_changes', len(renames))
+    phase.record('storm_events', (len(renames) + batch - 1) // batch)
+    phase.record('changes_per_sec', len(renames) / elapsed)
+    phase.record('catch_up_seconds', caught_up - committed)
+    if lags:
+        phase.record('lag_p50', percentile(lags, 50))
+        phase.record('lag_p90', percentile(lags, 90))
+        phase.record('lag_max', max(lags))
+    print "applied {0} changes".format(len(renames))
+
+
+def setup_replay(ctx):
+    """
+    Replay the workload trace TRACE_PATH.
+    """
+    setup_ftrack(ctx)
+    setup_mysql(ctx)
+    sql = global_data['TRACE_SQL']
+    assert sql in ('mysql', 'sqlalchemy'), \
+        "TRACE_SQL must be 'mysql' or 'sqlalchemy'"
+    ctx.backends = dict(ftrack='ftrack', sql=sql)
+    ctx.engine = None
+    if sql == 'sqlalchemy':
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import NullPool
+        # a connection per stream, however many streams there are
+        ctx.engine = create_engine(str(global_data['DB_URI']),
+                                   poolclass=NullPool)
+
+    ctx.header, operations = read_trace(global_data['TRACE_PATH'])
+    ctx.labels = [trace_label(backend, text)
+                  for backend, _, text in ctx.header['texts']]
+    ctx.streams = {}
+    for operation in operations:
+        ctx.streams.setdefault(operation[1], []).append(operation)
+    speed = float(global_data['TRACE_SPEED'])
+    print ('replaying {0} operations of {1} from {2} streams, {3:.1f}s as '
+           'recorded, at {4}'.format(
+               len(operations), ctx.header['source'], len(ctx.streams),
+               operations[-1][0] if operations else 0.0,
+               '{0:g}x'.format(speed) if speed else 'full speed'))
+
+
+def test_replay_01(ctx):
+    """
+    Play the trace, each stream from its own thread and connections, with
+    every operation started at its recorded offset divided by TRACE_SPEED
+    (or when the stream's previous operation ends, if later). TRACE_SPEED
+    '0' runs the streams as fast as they go.
+
+    Records the operations, failed operations, rows and operations per
+    second, the most an operation started behind schedule, and the 50th,
+    90th and 99th percentile latency overall and per class of operation
+    (see `trace_label`).
+    """
+    import re
+    import threading
+
+    speed = float(global_data['TRACE_SPEED'])
+    texts = ctx.header['texts']
+    timer = timeit.default_timer
+    ready = threading.Semaphore(0)
+    go = threading.Event()
+    clock = {}
+    # (text index, seconds, seconds behind schedule, rows or None if failed)
+    done = []
+    errors = []
+
+    def stream(operations):
+        conns = {}
+        try:
+            try:
+                for backend in set(ctx.backends[texts[x[2]][0]]
+                                   for x in operations):
+                    conns[backend] = _trace_connect(backend, ctx.engine)
+            finally:
+                ready.release()
+            go.wait()
+            start = clock['start']
+            for offset, _, index, params, _, _ in operations:
+                due = start + offset / speed if speed else timer()
+                if due > timer():
+                    time.sleep(due - timer())
+                began = timer()
+                backend = ctx.backends[texts[index][0]]
+                try:
+                    rows = _trace_execute(conns[backend], backend,
+                                          texts[index][1], texts[index][2],
+                                          params)
+                except Exception:
+                    rows = None
+                done.append((index, timer() - began, max(began - due, 0.0),
+                             rows))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            for backend, conn in conns.items():
+                _trace_close(backend, conn)
+
+    threads = [threading.Thread(target=stream, args=(operations,))
+               for _, operations in sorted(ctx.streams.items())]
+    with phase('connect'):
+        for thread in threads:
+            thread.start()
+        for _ in threads:
+            ready.acquire()
+    with phase('replay'):
+        clock['start'] = timer()
+        go.set()
+        for thread in threads:
+            thread.join()
+        elapsed = timer() - clock['start']
+    if errors:
+        raise errors[0]
+
+    latencies = {}
+    for index, seconds, _, rows in done:
+        if rows is not None:
+            latencies.setdefault(ctx.labels[index], []).append(seconds)
+    succeeded = [x[1] for x in done if x[3] is not None]
+    phase.record('operations', len(done))
+    phase.record('errors', len(done) - len(succeeded))
+    phase.record('rows', sum(x[3] for x in done if x[3] is not None))
+    if elapsed:
+        phase.record('ops_per_sec', len(done) / elapsed)
+    phase.record('behind_max', max([x[2] for x in done] or [0.0]))
+    for name, values in [('op', succeeded)] + sorted(latencies.items()):
+        name = re.sub(r'\W+', '_', name)
+        for q in (50, 90, 99):
+            phase.record('{0}_p{1}'.format(name, q), percentile(values, q))
+    print "replayed {0} operations".format(len(done))
+
+
+# def setup_luma():
+#     """
+#     Get all shots of a sequence using MySQLdb directly.
+#     """
+#     # ----------------------------------------------------------------------
+#     # MYSQL
+#
+#     import MySQLdb
+#
+#
+# def test_luma_01():
+#     """
+#     Get all shots of a sequence using MySQLdb directly.
+#     """
+#     session = MySQLdb.connect(
+#         host='lumadb',
+#         db='luma',
+#         user='internal',
+#         passwd='dbConnect76').cursor(MySQLdb.cursors.DictCursor)
+#     # -update
+#
+#     query = '''SELECT shots.shot_name AS name FROM shots
+#     LEFT JOIN projects USING (id_project)
+#     WHERE projects.id_project = "boxcars" AND shots.prefix = "AF"'''
+#
+#     session.execute(query)
+#     r = session
+#     # -update
+#     if global_data['RESULT_MODE'] == 'all':
+#         shots = [x['name'] for x in r.fetchall()]
+#         print "num shots:", len(shots)
+#     else:
+#         print r.fetchone()['name']
+
+# -----------------------------------------------------------------------------
+# Setup
+
+
+def setup_ftrack_create(ctx):
+    """
+    Create test project, sequences and shots using the ftrack_api.
+    """
+    import os
+
+    # Remove any of our custom stuff from the plugin path.
+    # NOTE: Without this we get an additional overhead of ~1 second between
+    #       importing the api and constructing the session.
+    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+
+    import ftrack_api
+
+
+def test_ftrack_create(ctx):
+    """
+    Create test project, sequences and shots using the ftrack_api.
+
+    Projects are created by BULK_WORKERS sessions at once (see `fan_out`),
+    committing every BULK_BATCH_SIZE entities. A project that already exists,
+    e.g. half created by a failed attempt, is deleted and created again.
+    """
+    import ftrack_api
+
+    num_projects = int(global_data['PROJECTS'])
+    sequences_per_project = int(global_data['SEQUENCES_PER_PROJECT'])
+    shots_per_sequence = int(global_data['SHOTS_PER_SEQUENCES'])
+    tasks_per_shot = int(global_data['TASKS_PER_SHOT'])
+
+    print "creating a total of {} projects, {} sequences, {} shots, {} tasks".format(
+        num_projects,
+        num_projects * sequences_per_project,
+        num_projects * sequences_per_project * shots_per_sequence,
+        num_projects * sequences_per_project * shots_per_sequence * tasks_per_shot,
+    )
+
+    session = ftrack_api.Session(
+        server_url=global_data['FTRACK_SERVER'],
+        api_key=global_data['FTRACK_APIKEY'],
+        auto_connect_event_hub=False)
+    # Choose project schema and its default types.
+    schema_ids = default_schema_ids(session.query('ProjectSchema').first())
+    session.close()
+
+    def create(session, batcher, project_name):
+        project = session.query(
+            'Project where name = "{0}"'.format(project_name)).first()
+        if project is not None:
+            print "Recreating project '{0}'".format(project_name)
+            session.delete(project)
+            session.commit()
+        statuses = dict(
+            (key, session.get(entity_type, entity_id))
+            for key, (entity_type, entity_id) in schema_ids.items())
+        # Create the project with the chosen schema.
+        project = session.create('Project', {
+            'name': project_name,
+            'full_name': project_name,
+            'project_schema': statuses['project_schema']
+        })
+        batcher.add()
+        created = 1
+        # Create sequences, shots and tasks.
+        for sequence_number in range(1, sequences_per_project + 1):
+            created += create_sequence(session, batcher, project,
+                                       'seq_{0}'.format(sequence_number),
+                                       statuses)
+        return created
+
+    fan_out(['perf_test_{0}'.format(number)
+             for number in range(1, num_projects + 1)], create,
+            num_projects * _hierarchy_size(_local_store_sizes()))
+
+
+def get_sequence(project):
+    import ftrack_api
+
+    session = ftrack_api.Session(
+        server_url=global_data['FTRACK_SERVER'],
+        api_key=global_data['FTRACK_APIKEY'],
+        auto_connect_event_hub=False)
+
+    seq = session.query('select name from Sequence where project.name = '
+                        '"{0}"'.format(project)).first()
+    return seq['name']
+
+
+def cleanup_ftrack_project(ctx):
+    """
+    Delete the test projects, BULK_WORKERS sessions at once (see `fan_out`).
+
+    Each project is deleted in a commit of its own, the server removing its
+    whole hierarchy, so a failure only retries that project.
+    """
+    num_projects = int(global_data['PROJECTS'])
+    # expected entities below (and including) each project, for progress;
+    # the counts reported are those of the projects as they are
+    expected = _hierarchy_size(_local_store_sizes())
+
+    def delete(session, batcher, project_name):
+        print project_name
+        project = session.query('Project where name = '
+                                '"{0}"'.format(project_name)).first()
+        if project is None:
+            return 0
+        entities = 1 + len(session.query(
+            'select id from TypedContext where project.name is '
+            '"{0}"'.format(project_name)).all())
+        print "Deleting project '{0}' ({1} entities)".format(project_name,
+                                                             entities)
+        session.delete(project)
+        batcher.add(entities)
+        return entities
+
+    fan_out(['perf_test_{0}'.format(number)
+             for number in range(1, num_projects + 1)], delete,
+            num_projects * expected, verb='deleted')
+
+
+# -----------------------------------------------------------------------------
+# Local backend
+#
+# A self-contained stand-in for sv-sql03 and the ftrack server. The store is a
+# sqlite file with the `context`/`show`/`task`/`object_type` tables modelled in
+# `setup_sqlalchemy`, and a small HTTP server answers the subset of the
+# ftrack_api JSON protocol used by the tests (query, create, update, delete).
+# Ids are derived from entity names so reseeding gives identical data.
+
+LOCAL_NAMESPACE = 'a0b1a1f2-4e0c-4c3e-9d8e-6f1c2b7d9e10'
+
+LOCAL_OBJECT_TYPES = (
+    ('Sequence', 'e5139355-61da-4c8f-9db4-3abc870166bc'),
+    ('Shot', 'bad911de-3bd6-47b9-8b46-3476e237cb36'),
+    ('Task', '11c137c0-ee7e-4f9c-91c5-8c77cec22b2c'),
+)
+
+LOCAL_STORE_DDL = '''
+CREATE TABLE object_type (
+    typeid VARCHAR(36) PRIMARY KEY,
+    name VARCHAR(255),
+    sort INTEGER
+);
+CREATE TABLE context (
+    id VARCHAR(36) PRIMARY KEY,
+    context_type VARCHAR(32),
+    parent_id VARCHAR(36) REFERENCES context (id),
+    name VARCHAR(255)
+);
+CREATE INDEX context_parent_id ON context (parent_id);
+CREATE INDEX context_name ON context (name);
+CREATE TABLE `show` (
+    showid VARCHAR(36) PRIMARY KEY REFERENCES context (id),
+    fullname VARCHAR(255),
+    root VARCHAR(255),
+    startdate DATE,
+    enddate DATE,
+    status VARCHAR(32),
+    diskid VARCHAR(36),
+    projectschemeid VARCHAR(36),
+    thumbid VARCHAR(36),
+    isglobal BOOLEAN
+);
+CREATE INDEX show_fullname ON `show` (fullname);
+CREATE TABLE task (
+    taskid VARCHAR(36) PRIMARY KEY REFERENCES context (id),
+    description TEXT,
+    startdate DATE,
+    enddate DATE,
+    statusid VARCHAR(36),
+    typeid VARCHAR(36),
+    isopen BOOLEAN,
+    thumbid VARCHAR(36),
+    sort FLOAT,
+    object_typeid VARCHAR(36) REFERENCES object_type (typeid),
+    showid VARCHAR(36) REFERENCES `show` (showid),
+    priorityid VARCHAR(36)
+);
+CREATE INDEX task_object_typeid ON task (object_typeid);
+CREATE INDEX task_showid ON task (showid);
+CREATE TABLE local_meta (
+    key VARCHAR(64) PRIMARY KEY,
+    value VARCHAR(255)
+);
+'''
+
+# attribute name -> (table, column) for the sql backed entity types. The
+# table is 'c' (context), 's' (show) or 't' (task).
+_LOCAL_CONTEXT_COLUMNS = {
+    'id': ('c', 'id'),
+    'name': ('c', 'name'),
+    'parent_id': ('c', 'parent_id'),
+    'context_type': ('c', 'context_type'),
+}
+_LOCAL_PROJECT_COLUMNS = dict(
+    _LOCAL_CONTEXT_COLUMNS,
+    full_name=('s', 'fullname'),
+    root=('s', 'root'),
+    status=('s', 'status'),
+    disk_id=('s', 'diskid'),
+    project_schema_id=('s', 'projectschemeid'),
+    is_global=('s', 'isglobal'),
+)
+_LOCAL_TASK_COLUMNS = dict(
+    _LOCAL_CONTEXT_COLUMNS,
+    description=('t', 'description'),
+    status_id=('t', 'statusid'),
+    type_id=('t', 'typeid'),
+    is_open=('t', 'isopen'),
+    sort=('t', 'sort'),
+    object_type_id=('t', 'object_typeid'),
+    project_id=('t', 'showid'),
+    priority_id=('t', 'priorityid'),
+)
+_LOCAL_TASK_REFERENCES = {
+    'parent': ('parent_id', 'Context'),
+    'project': ('project_id', 'Project'),
+    'status': ('status_id', 'Status'),
+    'type': ('type_id', 'Type'),
+    'object_type': ('object_type_id', 'ObjectType'),
+}
+
+
+def _local_types():
+    """
+    Return the entity types known to the local ftrack server.
+
+    Each type has `attributes`, `references` (name -> (key attribute, type))
+    and `collections` (name -> (type, key attribute on the other side, or None
+    if the ids are stored in the record itself)). Sql backed types also have
+    `columns` and an optional `context_type`/`object_type_id` filter.
+    """
+    types = {
+        'Context': dict(
+            columns=_LOCAL_CONTEXT_COLUMNS,
+            references={'parent': ('parent_id', 'Context')}),
+        'Project': dict(
+            columns=_LOCAL_PROJECT_COLUMNS,
+            context_type='show',
+            references={
+                'project_schema': ('project_schema_id', 'ProjectSchema')}),
+        'TypedContext': dict(
+            columns=_LOCAL_TASK_COLUMNS,
+            context_type='task',
+            references=_LOCAL_TASK_REFERENCES),
+        'ProjectSchema': dict(
+            attributes=['id', 'name'],
+            references={
+                '_task_workflow': ('_task_workflow_id', 'WorkflowSchema'),
+                '_version_workflow': ('_version_workflow_id',
+                                      'WorkflowSchema'),
+                '_task_type_schema': ('_task_type_schema_id',
+                                      'TaskTypeSchema')},
+            collections={
+                '_schemas': ('Schema', 'project_schema_id'),
+                '_overrides': ('ProjectSchemaOverride', 'project_schema_id')}),
+        'ProjectSchemaOverride': dict(
+            attributes=['id', 'project_schema_id', 'type_id',
+                        'workflow_schema_id'],
+            references={
+                'workflow_schema': ('workflow_schema_id', 'WorkflowSchema')}),
+        'WorkflowSchema': dict(
+            attributes=['id', 'name'],
+            collections={'statuses': ('Status', None)}),
+        'TaskTypeSchema': dict(
+            attributes=['id', 'name'],
+            collections={'types': ('Type', None)}),
+        'Schema': dict(
+            attributes=['id', 'type_id', 'project_schema_id']),
+        'SchemaStatus': dict(
+            primary_key=['schema_id', 'task_status_id'],
+            attributes=['schema_id', 'task_status_id', 'sort'],
+            references={'task_status': ('task_status_id', 'Status')}),
+        'SchemaType': dict(
+            primary_key=['schema_id', 'type_id'],
+            attributes=['schema_id', 'type_id', 'sort'],
+            references={'task_type': ('type_id', 'Type')}),
+        'Status': dict(attributes=['id', 'name', 'sort', 'color']),
+        'Type': dict(attributes=['id', 'name', 'sort', 'color']),
+        'ObjectType': dict(attributes=['id', 'name', 'sort']),
+        'Location': dict(attributes=['id', 'name', 'label', 'description']),
+    }
+    for name, object_type_id in LOCAL_OBJECT_TYPES:
+        types[name] = dict(types['TypedContext'],
+                           object_type_id=object_type_id)
+    for name in ('Context', 'Project', 'TypedContext') + tuple(
+            name for name, _ in LOCAL_OBJECT_TYPES):
+        types[name]['collections'] = {'children': ('Context', 'parent_id')}
+    for spec in types.values():
+        spec.setdefault('primary_key', ['id'])
+        spec.setdefault('references', {})
+        spec.setdefault('collections', {})
+        if 'columns' in spec:
+            spec['attributes'] = sorted(spec['columns'])
+    return types
+
+
+def _local_id(*parts):
+    """
+    Return a stable uuid for the entity identified by `parts`.
+    """
+    import uuid
+    return str(uuid.uuid5(uuid.UUID(LOCAL_NAMESPACE), '/'.join(parts)))
+
+
+def _local_static_entities():
+    """
+    Return the non-hierarchical entities served by the local ftrack server:
+    a single project schema with its workflows, statuses and types.
+
+    Returns
+    -------
+    dict
+        entity type -> list of records
+    """
+    statuses = [dict(id=_local_id('status', name), name=name, sort=i,
+                     color='#ffffff')
+                for i, name in enumerate(
+                    ['Not started', 'In progress', 'Approved'])]
+    task_types = [dict(id=_local_id('type', name), name=name, sort=i,
+                       color='#ffffff')
+                  for i, name in enumerate(
+                      ['Generic', 'Animation', 'Compositing'])]
+    status_ids = [x['id'] for x in statuses]
+    project_schema_id = _local_id('project_schema', 'default')
+    workflow = dict(id=_local_id('workflow_schema', 'default'),
+                    name='default', statuses=status_ids)
+    type_schema = dict(id=_local_id('task_type_schema', 'default'),
+                       name='default', types=[x['id'] for x in task_types])
+    schemas = []
+    schema_statuses = []
+    for name, object_type_id in LOCAL_OBJECT_TYPES:
+        schema_id = _local_id('schema', name)
+        schemas.append(dict(id=schema_id, type_id=object_type_id,
+                            project_schema_id=project_schema_id))
+        schema_statuses.extend(
+            dict(schema_id=schema_id, task_status_id=status_id, sort=i)
+            for i, status_id in enumerate(status_ids))
+    return {
+        'ProjectSchema': [dict(
+            id=project_schema_id, name='default',
+            _task_workflow_id=workflow['id'],
+            _version_workflow_id=workflow['id'],
+            _task_type_schema_id=type_schema['id'])],
+        'ProjectSchemaOverride': [],
+        'WorkflowSchema': [workflow],
+        'TaskTypeSchema': [type_schema],
+        'Schema': schemas,
+        'SchemaStatus': schema_statuses,
+        'SchemaType': [],
+        'Status': statuses,
+        'Type': task_types,
+        'ObjectType': [dict(id=object_type_id, name=name, sort=i)
+                       for i, (name, object_type_id)
+                       in enumerate(LOCAL_OBJECT_TYPES)],
+        'Location': [],
+    }
+
+
+def _local_store_sizes():
+    return dict((key, int(global_data[key]))
+                for key in ('PROJECTS', 'SEQUENCES_PER_PROJECT',
+                            'SHOTS_PER_SEQUENCES', 'TASKS_PER_SHOT'))
+
+
+def local_store_is_current(path):
+    """
+    Return whether the local store at `path` exists and was built with the
+    current PROJECTS/SEQUENCES_PER_PROJECT/SHOTS_PER_SEQUENCES/TASKS_PER_SHOT.
+    """
+    import os
+    import sqlite3
+    if not os.path.exists(path):
+        return False
+    conn = sqlite3.connect(path)
+    try:
+        meta = dict(conn.execute('SELECT key, value FROM local_meta'))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conn.close()
+    return all(meta.get(key) == str(value)
+               for key, value in _local_store_sizes().items())
+
+
+def seed_local_store(path, hierarchy=True):
+    """
+    (Re)create the local store at `path`.
+
+    Parameters
+    ----------
+    path : str
+        sqlite database file. Any existing file is replaced.
+    hierarchy : bool
+        If True, generate the full project/sequence/shot/task hierarchy from
+        PROJECTS, SEQUENCES_PER_PROJECT, SHOTS_PER_SEQUENCES and
+        TASKS_PER_SHOT. If False, only create the schema so the data can be
+        created through the ftrack api (i.e. the `setup` test).
+
+    Returns
+    -------
+    int
+        Number of context rows created.
+    """
+    import os
+    import sqlite3
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    static = _local_static_entities()
+    sizes = _local_store_sizes()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(LOCAL_STORE_DDL)
+    conn.executemany(
+        'INSERT INTO object_type VALUES (?, ?, ?)',
+        [(x['id'], x['name'], x['sort']) for x in static['ObjectType']])
+    conn.executemany(
+        'INSERT INTO local_meta VALUES (?, ?)',
+        [(key, str(value)) for key, value in sizes.items()] +
+        [('source', 'seed' if hierarchy else 'api')])
+
+    num_contexts = 0
+    if hierarchy:
+        for _, rows in iter_hierarchy_rows(sizes):
+            for table, _ in HIERARCHY_COLUMNS:
+                insert_rows(conn, table, rows[table])
+            num_contexts += len(rows['context'])
+    conn.commit()
+    conn.close()
+    return num_contexts
+
+
+class LocalQueryError(Exception):
+    """
+    Raised for expressions the local ftrack server cannot answer.
+    """
+
+
+def _parse_local_query(expression):
+    """
+    Parse an ftrack query `expression`.
+
+    Supports ``[select a, b.c from] Type [where ...] [order by ...]
+    [offset N] [limit N]`` where conditions may be combined with
+    and/or/not and parentheses, and use is, is_not, =, !=, <, >, <=, >=,
+    like, not_like, in and not_in.
+
+    Returns
+    -------
+    dict
+        with `projections`, `entity_type`, `where`, `order_by`, `offset` and
+        `limit` keys. `where` is None or a nested tuple of
+        ('and'|'or', [nodes]), ('not', node) or ('cmp', path, op, value).
+    """
+    import re
+
+    tokens = re.findall(
+        r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|<=|>=|!=|[(),=<>]|[^\s(),=<>!"\']+',
+        expression)
+    position = [0]
+
+    def peek(offset=0):
+        index = position[0] + offset
+        return tokens[index] if index < len(tokens) else None
+
+    def take(expected=None):
+        token = peek()
+        if token is None or (expected and token.lower() != expected):
+            raise LocalQueryError(
+                'Expected {0!r} at {1!r} in {2!r}'.format(
+                    expected, token, expression))
+        position[0] += 1
+        return token
+
+    def value(token):
+        if token[0] in '"\'':
+            return token[1:-1].replace('\\' + token[0], token[0])
+        if token.lower() in ('none', 'null'):
+            return None
+        if token.lower() in ('true', 'false'):
+            return token.lower() == 'true'
+        return token
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() and peek().lower() == 'or':
+            take()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek() and peek().lower() == 'and':
+            take()
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not():
+        if peek() and peek().lower() == 'not':
+            take()
+            return ('not', parse_not())
+        if peek() == '(':
+            take()
+            node = parse_or()
+            take(')')
+            return node
+        path = take()
+        op = take().lower()
+        if op in ('in', 'not_in'):
+            take('(')
+            values = []
+            while peek() != ')':
+                values.append(value(take()))
+                if peek() == ',':
+                    take()
+            take(')')
+            return ('cmp', path, op, values)
+        if op in ('has', 'any'):
+            raise LocalQueryError(
+                '{0!r} is not supported by the local server'.format(op))
+        return ('cmp', path, op, value(take()))
+
+    query = dict(projections=None, where=None, order_by=[], offset=0,
+                 limit=None)
+    if peek() and peek().lower() == 'select':
+        take()
+        query['projections'] = []
+        while peek().lower() != 'from':
+            token = take()
+            if token != ',':
+                query['projections'].append(token)
+        take('from')
+    query['entity_type'] = take()
+    while peek() is not None:
+        keyword = take().lower()
+        if keyword == 'where':
+            query['where'] = parse_or()
+        elif keyword == 'order':
+            take('by')
+            while peek() and peek().lower() not in ('offset', 'limit'):
+                token = take()
+                if token == ',':
+                    continue
+                if peek() and peek().lower() in ('ascending', 'descending'):
+                    query['order_by'].append(
+                        (token, take().lower() == 'descending'))
+                else:
+                    query['order_by'].append((token, False))
+        elif keyword == 'offset':
+            query['offset'] = int(take())
+        elif keyword == 'limit':
+            query['limit'] = int(take())
+        else:
+            raise LocalQueryError(
+                'Unexpected {0!r} in {1!r}'.format(keyword, expression))
+    return query
+
+
+class LocalFtrackBackend(object):
+    """
+    Answers ftrack_api batches against the local store.
+
+    Hierarchy entities (Project, Sequence, Shot, Task, ...) live in the sqlite
+    store and are queried with sql; the remaining entities needed to satisfy
+    the api (project schemas, statuses, types) are held in memory.
+    """
+
+    SQL_OPERATORS = {
+        'is': '=', '=': '=', 'is_not': '!=', '!=': '!=', '<': '<', '>': '>',
+        '<=': '<=', '>=': '>=', 'like': 'LIKE', 'not_like': 'NOT LIKE',
+        'in': 'IN', 'not_in': 'NOT IN'
+    }
+
+    def __init__(self, path):
+        import threading
+        self.path = path
+        self.types = _local_types()
+        self.static = dict(
+            (entity_type, dict((self._key(entity_type, record), record)
+                               for record in records))
+            for entity_type, records in _local_static_entities().items())
+        self.object_types = dict(
+            (object_type_id, name) for name, object_type_id
+            in LOCAL_OBJECT_TYPES)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # ftrack.update events of the writes, see `publish`
+        self.events = []
+        self._published = threading.Condition()
+
+    @property
+    def connection(self):
+        import sqlite3
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._local.connection = conn
+        return conn
+
+    def _key(self, entity_type, record):
+        return tuple(record[x] for x in self.types[entity_type]['primary_key'])
+
+    def is_sql(self, entity_type):
+        return 'columns' in self.types[entity_type]
+
+    # -- protocol ------------------------------------------------------------
+
+    def call(self, batch):
+        """
+        Return the results for a list of ftrack_api operations.
+        """
+        results = []
+        changes = []
+        for operation in batch:
+            action = operation['action']
+            if action == 'query_server_information':
+                results.append(dict(version='dev',
+                                    schema_hash=self.schema_hash()))
+            elif action == 'query_schemas':
+                results.append(self.schemas())
+            elif action == 'query':
+                data, metadata = self.query(operation['expression'])
+                results.append(dict(action='query', data=data,
+                                    metadata=metadata))
+            elif action in ('create', 'update', 'delete'):
+                with self._write_lock:
+                    try:
+                        result = getattr(self, action)(
+                            operation['entity_type'],
+                            operation.get('entity_key'),
+                            operation.get('entity_data'))
+                    except Exception:
+                        self.connection.rollback()
+                        raise
+                    self.connection.commit()
+                results.append(dict(action=action, data=result))
+                if self.is_sql(operation['entity_type']):
+                    changes.append(self._change(
+                        action, operation['entity_type'],
+                        operation.get('entity_key'),
+                        operation.get('entity_data')))
+            else:
+                raise LocalQueryError(
+                    'Unsupported action {0!r}'.format(action))
+        if changes:
+            self.publish(changes)
+        return results
+
+    # -- events --------------------------------------------------------------
+
+    def _change(self, action, entity_type, entity_key, entity_data):
+        # the entry of a write in an ftrack.update event
+        spec = self.types[entity_type]
+        values = {}
+        if action != 'delete':
+            values = self._resolve_data(entity_type, entity_data)
+        return dict(
+            action=dict(create='add', update='update',
+                        delete='remove')[action],
+            entityType='show' if spec.get('context_type') == 'show'
+            else 'task',
+            entityId=values.get('id') or entity_key[0],
+            objectTypeId=values.get('object_type_id',
+                                    spec.get('object_type_id')),
+            changes=dict((name, dict(new=value, old=None))
+                         for name, value in values.items()
+                         if name in ('name', 'parent_id')))
+
+    def publish(self, entities):
+        """
+        Journal an ftrack.update event for the hierarchy `entities`
+        written by one batch, as the real server publishes one per commit.
+        Events are numbered from 1 and kept for the life of the server.
+        """
+        with self._published:
+            self.events.append(dict(
+                id=len(self.events) + 1, topic='ftrack.update',
+                sent=time.time(), data=dict(entities=entities)))
+            self._published.notify_all()
+
+    def events_after(self, after, wait=0.0, limit=1000):
+        """
+        Return up to `limit` events numbered above `after`, waiting up to
+        `wait` seconds for one if there are none yet.
+        """
+        deadline = time.time() + wait
+        with self._published:
+            while len(self.events) <= after:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._published.wait(remaining)
+            return self.events[after:after + limit]
+
+    def schemas(self):
+        """
+        Return json schemas for all known entity types.
+        """
+        schemas = []
+        for entity_type, spec in sorted(self.types.items()):
+            properties = {}
+            for name in spec['attributes']:
+                if name in ('sort',):
+                    properties[name] = {'type': 'number'}
+                elif name.startswith('is_'):
+                    properties[name] = {'type': 'boolean'}
+                else:
+                    properties[name] = {'type': 'string'}
+            if 'object_type_id' in spec:
+                properties['object_type_id']['default'] = \
+                    spec['object_type_id']
+            if spec.get('context_type'):
+                properties['context_type']['default'] = spec['context_type']
+            if spec['primary_key'] == ['id']:
+                properties['id']['default'] = '{uid}'
+            for name, (_, target) in spec['references'].items():
+                properties[name] = {'$ref': target}
+            for name, (target, _) in spec['collections'].items():
+                properties[name] = {'type': 'array',
+                                    'items': {'$ref': target}}
+            default_projections = [
+                x for x in ('id', 'name', 'full_name')
+                if x in spec['attributes']] or spec['primary_key']
+            schemas.append({
+                'id': entity_type,
+                'type': 'object',
+                'primary_key': spec['primary_key'],
+                'properties': properties,
+                'required': [],
+                'immutable': list(spec['primary_key']),
+                'computed': [],
+                'default_projections': default_projections,
+            })
+        return schemas
+
+    def schema_hash(self):
+        import hashlib
+        import json
+        return hashlib.md5(
+            json.dumps(self.schemas(), sort_keys=True)).hexdigest()
+
+    # -- reading ---------------------------------------------------------------
+
+    def query(self, expression):
+        """
+        Return (data, metadata) for `expression` as the ftrack server would.
+        """
+        query = _parse_local_query(expression)
+        entity_type = query['entity_type']
+        if entity_type not in self.types:
+            raise LocalQueryError(
+                'Unknown entity type {0!r}'.format(entity_type))
+        limit = query['limit']
+        if self.is_sql(entity_type):
+            records = self._sql_select(
+                entity_type, query['where'], query['order_by'],
+                query['offset'], None if limit is None else limit + 1)
+        else:
+            records = [(entity_type, record) for record in self._static_select(
+                entity_type, query['where'], query['order_by'])]
+            records = records[query['offset']:]
+            if limit is not None:
+                records = records[:limit + 1]
+
+        next_offset = None
+        if limit is not None and len(records) > limit:
+            records = records[:limit]
+            next_offset = query['offset'] + limit
+
+        projections = query['projections'] or \
+            self.types[entity_type]['primary_key']
+        cache = {}
+        data = [self._project(concrete_type, record, projections, cache)
+                for concrete_type, record in records]
+        return data, {'next': {'offset': next_offset}}
+
+    def _concrete_type(self, record):
+        if record['context_type'] == 'show':
+            return 'Project'
+        return self.object_types.get(record['_object_type_id'],
+                                     'TypedContext')
+
+    def _sql_select(self, entity_type, where, order_by=(), offset=0,
+                    limit=None, params=None):
+        """
+        Return [(concrete type, record dict)] for a sql backed entity type.
+        """
+        spec = self.types[entity_type]
+        joins = []
+        params = [] if params is None else params
+
+        def table(alias, spec, key):
+            # return the sql alias holding column table `key` for `alias`
+            if key == 'c':
+                return alias
+            name = '{0}_{1}'.format(alias, key)
+            if name not in joined:
+                joined.add(name)
+                if key == 't':
+                    joins.append('LEFT JOIN task AS {0} ON {0}.taskid = '
+                                 '{1}.id'.format(name, alias))
+                else:
+                    joins.append('LEFT JOIN `show` AS {0} ON {0}.showid = '
+                                 '{1}.id'.format(name, alias))
+            return name
+
+        def column(alias, spec, attribute):
+            if attribute not in spec['columns']:
+                raise LocalQueryError(
+                    'Unknown attribute {0!r}'.format(attribute))
+            key, name = spec['columns'][attribute]
+            return '{0}.{1}'.format(table(alias, spec, key), name)
+
+        def resolve(alias, spec, path):
+            # walk a dotted path joining referenced contexts; returns
+            # (alias, spec, attribute) or raises for static references
+            parts = path.split('.')
+            for index, part in enumerate(parts[:-1]):
+                if part not in spec['references']:
+                    raise LocalQueryError(
+                        'Cannot filter on {0!r}'.format(path))
+                key_attribute, target = spec['references'][part]
+                if not self.is_sql(target):
+                    return (alias, spec, key_attribute, target,
+                            '.'.join(parts[index + 1:]))
+                name = '{0}_{1}'.format(alias, part)
+                if name not in joined:
+                    joined.add(name)
+                    joins.append('LEFT JOIN context AS {0} ON {0}.id = '
+                                 '{1}'.format(
+                                     name, column(alias, spec, key_attribute)))
+                alias, spec = name, self.types[target]
+            return alias, spec, parts[-1], None, None
+
+        def compile_node(node):
+            kind = node[0]
+            if kind in ('and', 'or'):
+                return '({0})'.format(' {0} '.format(kind.upper()).join(
+                    compile_node(x) for x in node[1]))
+            if kind == 'not':
+                return 'NOT ({0})'.format(compile_node(node[1]))
+            _, path, op, value = node
+            alias, node_spec, attribute, target, rest = resolve(
+                'c', spec, path)
+            sql_column = column(alias, node_spec, attribute)
+            if target is not None:
+                # condition on an in-memory entity; resolve to matching ids
+                ids = [record['id'] for record in self._static_select(
+                    target, ('cmp', rest, op, value))]
+                params.extend(ids)
+                return '{0} IN ({1})'.format(
+                    sql_column, ', '.join('?' * len(ids)) or 'NULL')
+            sql_op = self.SQL_OPERATORS.get(op)
+            if sql_op is None:
+                raise LocalQueryError('Unknown operator {0!r}'.format(op))
+            if op in ('in', 'not_in'):
+                params.extend(value)
+                return '{0} {1} ({2})'.format(
+                    sql_column, sql_op, ', '.join('?' * len(value)) or 'NULL')
+            if value is None and sql_op in ('=', '!='):
+                return '{0} IS {1}NULL'.format(
+                    sql_column, 'NOT ' if sql_op == '!=' else '')
+            params.append(value)
+            return '{0} {1} ?'.format(sql_column, sql_op)
+
+        joined = set()
+        conditions = []
+        if spec.get('context_type'):
+            conditions.append('c.context_type = ?')
+            params.append(spec['context_type'])
+        if spec.get('object_type_id'):
+            conditions.append('{0}.object_typeid = ?'.format(
+                table('c', spec, 't')))
+            params.append(spec['object_type_id'])
+        if where is not None:
+            conditions.append(compile_node(where))
+
+        selected = ['{0} AS {1}'.format(column('c', spec, x), x)
+                    for x in spec['attributes']]
+        selected.append('{0}.object_typeid AS _object_type_id'.format(
+            table('c', spec, 't')))
+        order = ['{0}{1}'.format(
+            column(*resolve('c', spec, path)[:3]),
+            ' DESC' if descending else '') for path, descending in order_by]
+
+        sql = 'SELECT {0} FROM context AS c {1}'.format(
+            ', '.join(selected), ' '.join(joins))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if order:
+            sql += ' ORDER BY ' + ', '.join(order)
+        if limit is not None or offset:
+            sql += ' LIMIT {0} OFFSET {1}'.format(
+                -1 if limit is None else int(limit), int(offset))
+
+        rows = self.connection.execute(sql, params).fetchall()
+        return [(self._concrete_type(row), dict(zip(row.keys(), row)))
+                for row in rows]
+
+    def _static_select(self, entity_type, where, order_by=()):
+        """
+        Return the in-memory records of `entity_type` matching `where`.
+        """
+        records = [x for x in self.static[entity_type].values()
+                   if where is None or self._matches(entity_type, x, where)]
+        for path, descending in reversed(order_by):
+            records.sort(key=lambda x: x.get(path), reverse=descending)
+        return records
+
+    def _matches(self, entity_type, record, node):
+        kind = node[0]
+        if kind == 'and':
+            return all(self._matches(entity_type, record, x) for x in node[1])
+        if kind == 'or':
+            return any(self._matches(entity_type, record, x) for x in node[1])
+        if kind == 'not':
+            return not self._matches(entity_type, record, node[1])
+        _, path, op, value = node
+        spec = self.types[entity_type]
+        head, _, rest = path.partition('.')
+        if rest:
+            if head not in spec['references']:
+                raise LocalQueryError('Cannot filter on {0!r}'.format(path))
+            key_attribute, target = spec['references'][head]
+            other = self.static[target].get((record.get(key_attribute),))
+            return other is not None and self._matches(
+                target, other, ('cmp', rest, op, value))
+
+        actual = record.get(path)
+        if op in ('in', 'not_in'):
+            result = unicode(actual) in [unicode(x) for x in value]
+            return result if op == 'in' else not result
+        if op in ('is', '=', 'is_not', '!='):
+            if value is None or actual is None:
+                result = actual is value
+            else:
+                result = unicode(actual) == unicode(value)
+            return result if op in ('is', '=') else not result
+        if op in ('like', 'not_like'):
+            import fnmatch
+            result = fnmatch.fnmatchcase(
+                unicode(actual), unicode(value).replace('%', '*'))
+            return result if op == 'like' else not result
+        try:
+            actual, value = float(actual), float(value)
+        except (TypeError, ValueError):
+            pass
+        return {'<': actual < value, '>': actual > value,
+                '<=': actual <= value, '>=': actual >= value}[op]
+
+    def _get(self, entity_type, entity_id, cache):
+        """
+        Return (concrete type, record) for a single entity or None.
+        """
+        key = (entity_type, entity_id)
+        if key not in cache:
+            if self.is_sql(entity_type):
+                records = self._sql_select(
+                    entity_type, ('cmp', 'id', 'is', entity_id))
+                cache[key] = records[0] if records else None
+            else:
+                record = self.static[entity_type].get((entity_id,))
+                cache[key] = None if record is None else (entity_type, record)
+        return cache[key]
+
+    def _project(self, entity_type, record, projections, cache):
+        """
+        Return the json data for `record` including the dotted
+        `projections`.
+        """
+        spec = self.types[entity_type]
+        data = {'__entity_type__': entity_type}
+        for key in spec['primary_key']:
+            data[key] = record[key]
+
+        nested = {}
+        for path in projections:
+            head, _, rest = path.partition('.')
+            nested.setdefault(head, [])
+            if rest:
+                nested[head].append(rest)
+
+        for name, rest in nested.items():
+            if name in spec['attributes']:
+                data[name] = record.get(name)
+            elif name in spec['references']:
+                key_attribute, target = spec['references'][name]
+                found = self._get(target, record.get(key_attribute), cache)
+                data[name] = None if found is None else self._project(
+                    found[0], found[1], rest, cache)
+            elif name in spec['collections']:
+                target, key_attribute = spec['collections'][name]
+                if key_attribute is None:
+                    found = [self._get(target, x, cache)
+                             for x in record.get(name, [])]
+                elif self.is_sql(target):
+                    found = self._sql_select(
+                        target, ('cmp', key_attribute, 'is', record['id']))
+                else:
+                    found = [(target, x) for x in self._static_select(
+                        target, ('cmp', key_attribute, 'is', record['id']))]
+                data[name] = [self._project(x[0], x[1], rest, cache)
+                              for x in found if x is not None]
+            else:
+                raise LocalQueryError('{0} has no attribute {1!r}'.format(
+                    entity_type, name))
+        return data
+
+    # -- writing ---------------------------------------------------------------
+
+    def _resolve_data(self, entity_type, data):
+        # flatten entity references to their key attribute
+        spec = self.types[entity_type]
+        values = {}
+        for name, value in (data or {}).items():
+            if name == '__entity_type__':
+                continue
+            if name in spec['references']:
+                name = spec['references'][name][0]
+                value = value['id'] if isinstance(value, dict) else value
+            elif name in spec['collections']:
+                if spec['collections'][name][1] is not None:
+                    continue
+                value = [x['id'] if isinstance(x, dict) else x
+                         for x in value]
+            elif name not in spec['attributes']:
+                continue
+            values[name] = value
+        return values
+
+    def create(self, entity_type, entity_key, entity_data):
+        spec = self.types[entity_type]
+        values = self._resolve_data(entity_type, entity_data)
+        if not self.is_sql(entity_type):
+            self.static[entity_type][self._key(entity_type, values)] = values
+            return self._project(entity_type, values, spec['attributes'], {})
+
+        values.setdefault('context_type', spec.get('context_type', 'task'))
+        if 'object_type_id' in spec:
+            values.setdefault('object_type_id', spec['object_type_id'])
+        if entity_type != 'Project' and values.get('parent_id'):
+            # tasks always know their project, even when only given a parent
+            parent = self._get('Context', values['parent_id'], {})
+            if parent is not None:
+                values.setdefault(
+                    'project_id', parent[1]['id'] if parent[0] == 'Project'
+                    else self._get(parent[0], parent[1]['id'], {})[1].get(
+                        'project_id'))
+        if entity_type == 'Project':
+            values.setdefault('status', 'active')
+        self._insert(spec, values)
+        cursor = self.connection.cursor()
+        if _has_table(cursor, 'context_closure'):
+            # the new context under every ancestor of its parent, and itself
+            object_type_id = values.get('object_type_id')
+            cursor.execute('''
+                INSERT INTO context_closure
+                SELECT ancestor_id, ?, depth + 1, ? FROM context_closure
+                WHERE descendant_id = ?''',
+                [values['id'], object_type_id, values.get('parent_id')])
+            cursor.execute('INSERT INTO context_closure VALUES (?, ?, 0, ?)',
+                           [values['id'], values['id'], object_type_id])
+        concrete_type, record = self._get(entity_type, values['id'], {})
+        return self._project(concrete_type, record,
+                             self.types[concrete_type]['attributes'], {})
+
+    def _insert(self, spec, values):
+        tables = {}
+        for name, value in values.items():
+            if name in spec['columns']:
+                key, column = spec['columns'][name]
+                tables.setdefault(key, {})[column] = value
+        tables.setdefault('c', {})
+        if spec.get('context_type') == 'show':
+            tables.setdefault('s', {})['showid'] = values['id']
+        else:
+            tables.setdefault('t', {})['taskid'] = values['id']
+        for key, table in (('c', 'context'), ('s', '`show`'), ('t', 'task')):
+            if key in tables:
+                columns = sorted(tables[key])
+                self.connection.execute(
+                    'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                        table, ', '.join(columns),
+                        ', '.join('?' * len(columns))),
+                    [tables[key][x] for x in columns])
+
+    def update(self, entity_type, entity_key, entity_data):
+        spec = self.types[entity_type]
+        values = self._resolve_data(entity_type, entity_data)
+        if not self.is_sql(entity_type):
+            record = self.static[entity_type][tuple(entity_key)]
+            record.update(values)
+            return self._project(entity_type, record, values.keys(), {})
+
+        for name, value in values.items():
+            key, column = spec['columns'][name]
+            table, id_column = dict(
+                c=('context', 'id'), s=('`show`', 'showid'),
+                t=('task', 'taskid'))[key]
+            self.connection.execute(
+                'UPDATE {0} SET {1} = ? WHERE {2} = ?'.format(
+                    table, column, id_column), [value, entity_key[0]])
+        cursor = self.connection.cursor()
+        if 'parent_id' in values and _has_table(cursor, 'context_closure'):
+            # moves are rare, reindex everything
+            build_hierarchy_index(cursor)
+        concrete_type, record = self._get(entity_type, entity_key[0], {})
+        return self._project(concrete_type, record, values.keys(), {})
+
+    def delete(self, entity_type, entity_key, entity_data):
+        if not self.is_sql(entity_type):
+            self.static[entity_type].pop(tuple(entity_key), None)
+            return True
+
+        # like ftrack, deleting a context removes everything below it
+        subtree = '''
+            WITH RECURSIVE subtree(id) AS (
+                SELECT ?
+                UNION ALL
+                SELECT context.id FROM context
+                JOIN subtree ON context.parent_id = subtree.id
+            ) SELECT id FROM subtree'''
+        tables = [('task', 'taskid'), ('`show`', 'showid'), ('context', 'id')]
+        if _has_table(self.connection.cursor(), 'context_closure'):
+            tables.insert(0, ('context_closure', 'descendant_id'))
+        for table, column in tables:
+            self.connection.execute(
+                'DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                    table, column, subtree), [entity_key[0]])
+        return True
+
+
+def serve_local_backend(path, port):
+    """
+    Serve the local store at `path` over the ftrack_api JSON protocol on
+    `port` until interrupted.
+    """
+    import json
+    import traceback
+    import urlparse
+    import BaseHTTPServer
+    import SocketServer
+
+    backend = LocalFtrackBackend(path)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # keep-alive like the real server; requests.Session reuses sockets
+        protocol_version = 'HTTP/1.1'
+        # send each reply in one segment: written a header line at a time,
+        # Nagle's algorithm holds the rest until the client's delayed ACK,
+        # about 40ms per request on a kept-alive connection
+        disable_nagle_algorithm = True
+        wbufsize = -1
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/api':
+                return self.send_error(404)
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+            try:
+                result = backend.call(json.loads(body))
+            except Exception as error:
+                traceback.print_exc()
+                result = dict(exception=type(error).__name__,
+                              content=str(error))
+            self._reply(200, json.dumps(result))
+
+        def do_GET(self):
+            # no event hub; ftrack_api logs the failed connection and moves
+            # on. The event journal is long-polled by LocalEventFeed
+            url = urlparse.urlsplit(self.path)
+            if url.path.rstrip('/') != '/events':
+                return self._reply(404, '')
+            query = urlparse.parse_qs(url.query)
+            events = backend.events_after(int(query.get('after', ['0'])[0]),
+                                          float(query.get('wait', ['0'])[0]))
+            self._reply(200, json.dumps(dict(last=len(backend.events),
+                                             events=events)))
+
+        def _reply(self, status, payload):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server(('127.0.0.1', int(port)), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def start_local_backend(hierarchy=True):
+    """
+    Make sure the local store exists for the current sizes, start the local
+    ftrack server in a separate process and point DB_URI and FTRACK_SERVER at
+    them.
+
+    Parameters
+    ----------
+    hierarchy : bool
+        Passed to `seed_local_store`. When False the store is always rebuilt
+        empty so it can be populated through the api.
+
+    Returns
+    -------
+    multiprocessing.Process
+        The server process. It is a daemon and exits with this process.
+    """
+    import os
+    import socket
+    import multiprocessing
+
+    path = os.path.abspath(global_data['LOCAL_DB'])
+    port = int(global_data['LOCAL_PORT'])
+    if not hierarchy or not local_store_is_current(path):
+        print "Seeding local store {0}".format(path)
+        print "created {0} contexts".format(
+            seed_local_store(path, hierarchy=hierarchy))
+
+    process = multiprocessing.Process(target=serve_local_backend,
+                                      args=(path, port))
+    process.daemon = True
+    process.start()
+
+    # wait for the server to accept connections
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+    else:
+        process.terminate()
+        raise RuntimeError(
+            'Local backend did not start on port {0}'.format(port))
+
+    for var, value in (('DB_URI', 'sqlite:///' + path),
+                       ('FTRACK_SERVER', 'http://127.0.0.1:{0}'.format(port)),
+                       ('MIRROR_EVENTS', 'local')):
+        print "Overriding {0} with {1}".format(var, value)
+        global_data[var] = value
+    return process
+
+
+def local_seed(ctx):
+    """
+    Rebuild the local stand-in store from the current global data.
+    """
+    print "created {0} contexts".format(
+        seed_local_store(global_data['LOCAL_DB']))
+
+
+def local_serve(ctx):
+    """
+    Serve the local stand-in store until interrupted.
+    """
+    print "serving {0} on port {1}".format(global_data['LOCAL_DB'],
+                                          global_data['LOCAL_PORT'])
+    serve_local_backend(global_data['LOCAL_DB'], global_data['LOCAL_PORT'])
+
+
+# -----------------------------------------------------------------------------
+# WAN simulation
+#
+# Remote studios reach the servers over WAN links, where every round-trip
+# costs tens of milliseconds. With --wan the harness talks to DB_URI (MySQL)
+# and FTRACK_SERVER through local TCP proxies that delay, throttle and lose
+# the traffic, so paths making many round-trips (lazy loads, per-entity
+# commits) can be compared with single query ones.
+
+# order of the settings in the array shared with the proxy processes
+WAN_SETTINGS = ('WAN_LATENCY_MS', 'WAN_JITTER_MS', 'WAN_BANDWIDTH_KBPS',
+                'WAN_LOSS', 'WAN_RTO_MS')
+# TCP segment size used to count lost segments
+WAN_SEGMENT = 1460
+# the multiprocessing.Array read by the running proxies, if any
+_wan_settings = []
+
+
+def configure_wan():
+    """
+    Pass the current WAN_* values to the running proxies, e.g. for each
+    point of a sweep.
+    """
+    for settings in _wan_settings:
+        for i, name in enumerate(WAN_SETTINGS):
+            settings[i] = float(global_data[name])
+
+
+def _wan_pipe(source, target, settings, rng):
+    """
+    Relay the bytes read from socket `source` to `target` as a WAN link
+    would deliver them, until `source` closes.
+
+    Each chunk waits for the link to be free, takes its size over the
+    bandwidth to send, then arrives after the latency (plus jitter), and
+    the retransmission timeout for every segment lost on the way. Chunks
+    are delivered in order by a second thread, so several can be in flight.
+    """
+    import Queue
+    import socket
+    import threading
+
+    queue = Queue.Queue()
+
+    def deliver():
+        while True:
+            due, data = queue.get()
+            if data is None:
+                break
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                target.sendall(data)
+            except socket.error:
+                break
+        try:
+            target.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    thread = threading.Thread(target=deliver)
+    thread.daemon = True
+    thread.start()
+    free = last = 0.0
+    while True:
+        try:
+            data = source.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            break
+        latency, jitter, bandwidth, loss, rto = settings[:]
+        now = time.time()
+        free = max(now, free)
+        if bandwidth:
+            free += len(data) / (bandwidth * 1024.0)
+        due = free + max(latency + rng.uniform(-jitter, jitter), 0) / 1000.0
+        if loss:
+            lost = sum(rng.random() < loss for _ in xrange(
+                (len(data) + WAN_SEGMENT - 1) // WAN_SEGMENT))
+            due += lost * rto / 1000.0
+        # TCP hands data over in order
+        last = max(due, last)
+        queue.put((last, data))
+    queue.put((None, None))
+    thread.join()
+
+
+def serve_wan_proxy(listener, upstream, settings):
+    """
+    Accept connections on the listening socket `listener` and relay each to
+    the (host, port) `upstream` through a simulated WAN link in each
+    direction (see `_wan_pipe`), until interrupted.
+
+    `settings` holds the WAN_SETTINGS values and may change at any time.
+    """
+    import random
+    import socket
+    import threading
+
+    def relay(client):
+        try:
+            server = socket.create_connection(upstream)
+        except socket.error:
+            client.close()
+            return
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sending = threading.Thread(
+            target=_wan_pipe, args=(client, server, settings, random.Random()))
+        sending.daemon = True
+        sending.start()
+        _wan_pipe(server, client, settings, random.Random())
+        sending.join()
+        client.close()
+        server.close()
+
+    try:
+        while True:
+            client, _ = listener.accept()
+            thread = threading.Thread(target=relay, args=(client,))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+def start_wan_proxies():
+    """
+    Start a `serve_wan_proxy` process in front of the MySQL server of DB_URI
+    and another in front of FTRACK_SERVER, and point both at their proxy.
+
+    sqlite databases are files and are left alone, as are https servers,
+    whose certificate would not match the proxy's address.
+
+    Returns
+    -------
+    list of multiprocessing.Process
+    """
+    import multiprocessing
+    import socket
+    import urlparse
+    from sqlalchemy.engine.url import make_url
+
+    settings = multiprocessing.Array('d', len(WAN_SETTINGS))
+    _wan_settings[:] = [settings]
+    configure_wan()
+    processes = []
+
+    def start(host, port):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        process = multiprocessing.Process(
+            target=serve_wan_proxy, args=(listener, (host, port), settings))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        # the proxy process has its own copy of the socket
+        port = listener.getsockname()[1]
+        listener.close()
+        return port
+
+    overrides = []
+    url = make_url(str(global_data['DB_URI']))
+    if url.drivername.startswith('sqlite'):
+        print 'DB_URI is a sqlite file, not proxied'
+    else:
+        url.port = start(url.host, url.port or 3306)
+        url.host = '127.0.0.1'
+        overrides.append(('DB_URI', str(url)))
+    server = urlparse.urlsplit(global_data['FTRACK_SERVER'])
+    if server.scheme != 'http':
+        print 'FTRACK_SERVER is not plain http, not proxied'
+    else:
+        overrides.append(('FTRACK_SERVER', 'http://127.0.0.1:{0}{1}'.format(
+            start(server.hostname, server.port or 80), server.path)))
+    for var, value in overrides:
+        print "Overriding {0} with {1}".format(var, value)
+        global_data[var] = value
+    return processes
+
+
+# -----------------------------------------------------------------------------
+# Bulk fixtures
+#
+# Production sized hierarchies (e.g. 100 projects x 50 sequences x 200 shots x
+# 10 tasks) take days to build one `session.create` at a time. `bulk_seed`
+# writes the rows straight into the DB_URI tables and `bulk_setup` spreads the
+# api calls over several sessions. Both work a project (or sequence) at a time
+# and skip what a previous, interrupted, run already completed.
+
+# table -> columns filled by the generated hierarchy, in insert order
+HIERARCHY_COLUMNS = (
+    ('context', ('id', 'context_type', 'parent_id', 'name')),
+    ('show', ('showid', 'fullname', 'status', 'projectschemeid',
+              'isglobal')),
+    ('task', ('taskid', 'statusid', 'typeid', 'isopen', 'object_typeid',
+              'showid')),
+)
+
+
+def iter_hierarchy_rows(sizes, skip=()):
+    """
+    Generate the rows of the project/sequence/shot/task hierarchy one project
+    at a time, so memory use doesn't grow with the number of projects.
+
+    Ids are derived from the entity names (see `_local_id`) so the same
+    sizes always give the same rows.
+
+    Parameters
+    ----------
+    sizes : dict
+        PROJECTS, SEQUENCES_PER_PROJECT, SHOTS_PER_SEQUENCES and
+        TASKS_PER_SHOT as ints.
+    skip : container of str
+        Names of projects not to generate.
+
+    Yields
+    ------
+    tuple
+        (project name, table -> list of row tuples) with the columns of
+        `HIERARCHY_COLUMNS`.
+    """
+    static = _local_static_entities()
+    project_schema_id = static['ProjectSchema'][0]['id']
+    shot_status_id = static['Status'][0]['id']
+    task_status_id = static['Status'][0]['id']
+    task_type_id = static['Type'][0]['id']
+    object_type_ids = dict(LOCAL_OBJECT_TYPES)
+
+    for project_number in range(1, sizes['PROJECTS'] + 1):
+        project_name = 'perf_test_{0}'.format(project_number)
+        if project_name in skip:
+            continue
+        project_id = _local_id(project_name)
+        contexts = [(project_id, 'show', None, project_name)]
+        shows = [(project_id, project_name, 'active', project_schema_id,
+                  False)]
+        tasks = []
+
+        def add_task(context_id, parent_id, name, object_type, status_id,
+                     type_id=None):
+            contexts.append((context_id, 'task', parent_id, name))
+            tasks.append((context_id, status_id, type_id, True,
+                          object_type_ids[object_type], project_id))
+
+        for sequence_number in range(1, sizes['SEQUENCES_PER_PROJECT'] + 1):
+            sequence_name = 'seq_{0}'.format(sequence_number)
+            sequence_id = _local_id(project_name, sequence_name)
+            add_task(sequence_id, project_id, sequence_name, 'Sequence',
+                     shot_status_id)
+            for shot_number in range(1, sizes['SHOTS_PER_SEQUENCES'] + 1):
+                shot_name = 'shot_{0:03d}'.format(shot_number)
+                shot_id = _local_id(project_name, sequence_name, shot_name)
+                add_task(shot_id, sequence_id, shot_name, 'Shot',
+                         shot_status_id)
+                for task_number in range(1, sizes['TASKS_PER_SHOT'] + 1):
+                    task_name = 'task_{0}'.format(task_number)
+                    add_task(_local_id(project_name, sequence_name,
+                                       shot_name, task_name),
+                             shot_id, task_name, 'Task', task_status_id,
+                             task_type_id)
+
+        yield project_name, dict(context=contexts, show=shows, task=tasks)
+
+
+def _is_sqlite(cursor):
+    import sqlite3
+    return isinstance(cursor, (sqlite3.Cursor, sqlite3.Connection))
+
+
+def insert_rows(cursor, table, rows, batch_size=5000):
+    """
+    Insert `rows` into `table` (one of `HIERARCHY_COLUMNS`) with
+    ``executemany`` calls of up to `batch_size` rows.
+
+    MySQLdb sends each batch as a single multi-row ``INSERT ... VALUES``.
+    """
+    columns = dict(HIERARCHY_COLUMNS)[table]
+    placeholder = '?' if _is_sqlite(cursor) else '%s'
+    statement = 'INSERT INTO `{0}` ({1}) VALUES ({2})'.format(
+        table, ', '.join(columns), ', '.join([placeholder] * len(columns)))
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(statement, rows[start:start + batch_size])
+
+
+def load_rows(cursor, table, rows):
+    """
+    Insert `rows` into the MySQL `table` (one of `HIERARCHY_COLUMNS`) by
+    writing them to a temporary file and importing it with
+    ``LOAD DATA LOCAL INFILE``.
+
+    The connection must allow it (``local_infile=1``), as must the server.
+    """
+    import os
+    import tempfile
+
+    def field(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return str(int(value))
+        return str(value)
+
+    fd, path = tempfile.mkstemp(suffix='.tsv')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for row in rows:
+                f.write('\t'.join(field(value) for value in row))
+                f.write('\n')
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE '{0}' INTO TABLE `{1}` ({2})".format(
+                path.replace('\\', '/'), table,
+                ', '.join(dict(HIERARCHY_COLUMNS)[table])))
+    finally:
+        os.remove(path)
+
+
+class BulkProgress(object):
+    """
+    Prints how far a bulk load got, its rate and the estimated time left.
+    """
+
+    def __init__(self, total, unit='rows', verb='loaded'):
+        import threading
+        self.total = total
+        self.unit = unit
+        self.verb = verb
+        self.done = 0
+        self.start = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    def update(self, name, count):
+        with self._lock:
+            self.done += count
+            elapsed = timeit.default_timer() - self.start
+            rate = self.done / elapsed if elapsed else 0.0
+            left = (self.total - self.done) / rate if rate else 0.0
+            print '{0}: {1}/{2} {3} ({4:.0f} {3}/s, {5:.0f}s left)'.format(
+                name, self.done, self.total, self.unit, rate, left)
+
+    def finish(self):
+        elapsed = timeit.default_timer() - self.start
+        print '{4} {0} {1} in {2:.1f}s ({3:.0f} {1}/s)'.format(
+            self.done, self.unit, elapsed,
+            self.done / elapsed if elapsed else 0.0, self.verb)
+
+
+class CommitBatcher(object):
+    """
+    Commits an ftrack_api session once `size` entities are pending.
+
+    With a `size` of 'auto' the session's round-trip time is measured first
+    (the quickest of a few server information requests), and every commit
+    sizes the next batch from its own timing so that the round-trip is
+    about BULK_RTT_SHARE of the commit: big batches for a distant server,
+    smaller ones where each entity costs the server more than the trip.
+    """
+
+    def __init__(self, session, size):
+        self.session = session
+        self.auto = size == 'auto'
+        self.size = 100 if self.auto else int(size)
+        self.pending = 0
+        self.round_trip = None
+        if self.auto:
+            times = []
+            for _ in range(3):
+                start = timeit.default_timer()
+                session.call([{'action': 'query_server_information'}])
+                times.append(timeit.default_timer() - start)
+            self.round_trip = min(times)
+
+    def add(self, count=1):
+        self.pending += count
+        if self.pending >= self.size:
+            self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        start = timeit.default_timer()
+        self.session.commit()
+        elapsed = timeit.default_timer() - start
+        if self.auto:
+            share = float(global_data['BULK_RTT_SHARE'])
+            # seconds of server work per entity, on top of the round-trip
+            per_entity = max(elapsed - self.round_trip, 1e-6) / self.pending
+            self.size = int(min(max(
+                self.round_trip * (1 - share) / (share * per_entity), 10),
+                10000))
+        self.pending = 0
+
+    def discard(self):
+        """
+        Forget the pending entities, dropped by a session reset.
+        """
+        self.pending = 0
+
+
+def fan_out(units, work, total, verb='created'):
+    """
+    Run `work(session, batcher, unit)` for every unit name in `units` on
+    BULK_WORKERS threads, each with its own ftrack_api session and
+    `CommitBatcher`, and return the (unit, error) of those still failing
+    after BULK_RETRIES retries.
+
+    `work` returns the number of entities it created or deleted, out of the
+    expected `total`. Whatever it leaves pending is committed when it
+    returns. A unit that raises is tried again, after its session dropped
+    the uncommitted changes, so `work` must cope with what an earlier
+    attempt committed.
+
+    The entities/s of every worker and overall are printed, and recorded as
+    the `rows` and `rows_per_sec` of the run.
+    """
+    import Queue
+    import threading
+    import ftrack_api
+
+    workers = int(global_data['BULK_WORKERS'])
+    retries = int(global_data['BULK_RETRIES'])
+    queue = Queue.Queue()
+    for unit in units:
+        queue.put((unit, 0))
+    progress = BulkProgress(total, unit='entities', verb=verb)
+    # per worker: entities, seconds, last batch size
+    done = [[0, 0.0, None] for _ in range(workers)]
+    failed = []
+
+    def worker(index):
+        start = timeit.default_timer()
+        session = ftrack_api.Session(
+            server_url=global_data['FTRACK_SERVER'],
+            api_key=global_data['FTRACK_APIKEY'],
+            auto_connect_event_hub=False)
+        batcher = CommitBatcher(session, global_data['BULK_BATCH_SIZE'])
+        try:
+            while True:
+                try:
+                    unit, attempt = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    count = work(session, batcher, unit)
+                    batcher.commit()
+                except Exception as error:
+                    session.reset()
+                    batcher.discard()
+                    if attempt < retries:
+                        print 'retrying {0}: {1!r}'.format(unit, error)
+                        queue.put((unit, attempt + 1))
+                    else:
+                        failed.append((unit, repr(error)))
+                    continue
+                # drop the entities of the unit so memory stays flat
+                session.reset()
+                done[index][0] += count
+                progress.update(unit, count)
+        finally:
+            session.close()
+            done[index][1] = timeit.default_timer() - start
+            done[index][2] = batcher.size
+
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for index, (count, elapsed, size) in enumerate(done):
+        print ('worker {0}: {1} entities in {2:.1f}s ({3:.0f} entities/s, '
+               'batches of {4})'.format(index + 1, count, elapsed,
+                                        count / elapsed if elapsed else 0.0,
+                                        size))
+    progress.finish()
+    elapsed = timeit.default_timer() - progress.start
+    phase.record('rows', progress.done)
+    if elapsed:
+        phase.record('rows_per_sec', progress.done / elapsed)
+    for unit, error in failed:
+        print 'failed {0}: {1}'.format(unit, error)
+    return failed
+
+
+def default_schema_ids(project_schema):
+    """
+    Return name -> (entity type, id) of the `project_schema` and its first
+    shot status, task type and task status, as used for the test projects.
+
+    Entities are passed to the `fan_out` workers by id, each has its own
+    session.
+    """
+    task_type = project_schema.get_types('Task')[0]
+    return dict(
+        project_schema=('ProjectSchema', project_schema['id']),
+        shot_status=('Status', project_schema.get_statuses('Shot')[0]['id']),
+        task_status=('Status', project_schema.get_statuses(
+            'Task', task_type['id'])[0]['id']),
+        task_type=('Type', task_type['id']))
+
+
+def create_sequence(session, batcher, project, sequence_name, statuses):
+    """
+    Create the sequence `sequence_name` of `project` with its shots and
+    tasks, and return the number of entities created.
+
+    `statuses` maps the `default_schema_ids` names to entities of `session`.
+    """
+    shots_per_sequence = int(global_data['SHOTS_PER_SEQUENCES'])
+    tasks_per_shot = int(global_data['TASKS_PER_SHOT'])
+
+    sequence = session.create('Sequence', {
+        'name': sequence_name, 'parent': project})
+    batcher.add()
+    for shot_number in range(1, shots_per_sequence + 1):
+        shot = session.create('Shot', {
+            'name': 'shot_{0:03d}'.format(shot_number),
+            'parent': sequence,
+            'status': statuses['shot_status']})
+        for task_number in range(1, tasks_per_shot + 1):
+            session.create('Task', {
+                'name': 'task_{0}'.format(task_number),
+                'parent': shot,
+                'status': statuses['task_status'],
+                'type': statuses['task_type']})
+        batcher.add(1 + tasks_per_shot)
+    return 1 + shots_per_sequence * (1 + tasks_per_shot)
+
+
+def _hierarchy_size(sizes):
+    # context rows of a single project
+    sequences = sizes['SEQUENCES_PER_PROJECT']
+    shots = sequences * sizes['SHOTS_PER_SEQUENCES']
+    return 1 + sequences + shots + shots * sizes['TASKS_PER_SHOT']
+
+
+def bulk_seed(ctx):
+    """
+    Write the generated hierarchy straight into the DB_URI tables (MySQL or
+    sqlite) with batched inserts, a transaction per project.
+
+    Projects already in the `show` table were committed by an earlier run and
+    are skipped, so an interrupted load can simply be restarted. Rows use
+    the ids of the local stand-in schema (statuses, types), so data meant to
+    be read through the ftrack server should be created with `bulk_setup`.
+
+    BULK_METHOD is 'executemany' (multi-row inserts of BULK_BATCH_SIZE rows)
+    or, for MySQL, 'load_data' (LOAD DATA LOCAL INFILE per table).
+    """
+    from sqlalchemy.engine.url import make_url
+
+    sizes = _local_store_sizes()
+    batch_size = int(global_data['BULK_BATCH_SIZE'])
+    method = global_data['BULK_METHOD']
+    assert method in ('executemany', 'load_data'), \
+        "BULK_METHOD must be 'executemany' or 'load_data'"
+
+    cursor = connect_db(make_url(str(global_data['DB_URI'])),
+                        **({'local_infile': 1} if method == 'load_data'
+                           else {}))
+    if _is_sqlite(cursor):
+        assert method == 'executemany', 'sqlite only supports executemany'
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = 'context'")
+        if not cursor.fetchall():
+            cursor.executescript(LOCAL_STORE_DDL)
+
+    cursor.execute('SELECT fullname FROM `show`')
+    done = set(row['fullname'] for row in cursor.fetchall()) & set(
+        'perf_test_{0}'.format(number)
+        for number in range(1, sizes['PROJECTS'] + 1))
+    todo = sizes['PROJECTS'] - len(done)
+    if done:
+        print 'skipping {0} projects loaded earlier'.format(len(done))
+
+    progress = BulkProgress(todo * _hierarchy_size(sizes) * 2)
+    for project_name, rows in iter_hierarchy_rows(sizes, skip=done):
+        for table, _ in HIERARCHY_COLUMNS:
+            if method == 'load_data':
+                load_rows(cursor, table, rows[table])
+            else:
+                insert_rows(cursor, table, rows[table], batch_size)
+        cursor.connection.commit()
+        # context + show/task row per entity
+        progress.update(project_name,
+                        len(rows['context']) + len(rows['show']) +
+                        len(rows['task']))
+    progress.finish()
+    if _has_table(cursor, 'context_closure'):
+        print 'reindexed the hierarchy: {0} closure rows'.format(
+            build_hierarchy_index(cursor))
+        cursor.connection.commit()
+    cursor.connection.close()
+
+
+def bulk_setup(ctx):
+    """
+    Create the test projects through the ftrack_api like `setup`, with
+    BULK_WORKERS sessions creating a sequence (with its shots and tasks) each
+    and committing every BULK_BATCH_SIZE entities (see `fan_out`).
+
+    Existing projects are reused and sequences that already have all their
+    shots are skipped, so an interrupted setup can be restarted; a partly
+    created sequence is deleted and created again.
+    """
+    import os
+
+    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+    import ftrack_api
+
+    num_projects = int(global_data['PROJECTS'])
+    sequences_per_project = int(global_data['SEQUENCES_PER_PROJECT'])
+    shots_per_sequence = int(global_data['SHOTS_PER_SEQUENCES'])
+    tasks_per_shot = int(global_data['TASKS_PER_SHOT'])
+
+    session = ftrack_api.Session(
+        server_url=global_data['FTRACK_SERVER'],
+        api_key=global_data['FTRACK_APIKEY'],
+        auto_connect_event_hub=False)
+    project_schema = session.query('ProjectSchema').first()
+    schema_ids = default_schema_ids(project_schema)
+
+    units = []
+    for project_number in range(1, num_projects + 1):
+        project_name = 'perf_test_{0}'.format(project_number)
+        if session.query('Project where name = "{0}"'.format(
+                project_name)).first() is None:
+            session.create('Project', {
+                'name': project_name,
+                'full_name': project_name,
+                'project_schema': project_schema})
+            session.commit()
+        for sequence_number in range(1, sequences_per_project + 1):
+            units.append('{0}/seq_{1}'.format(project_name, sequence_number))
+    session.close()
+
+    def create(session, batcher, unit):
+        project_name, sequence_name = unit.split('/')
+        project = session.query(
+            'Project where name = "{0}"'.format(project_name)).one()
+        sequence = session.query(
+            'select children from Sequence where project.name = '
+            '"{0}" and name = "{1}"'.format(
+                project_name, sequence_name)).first()
+        if sequence is not None:
+            if len(sequence['children']) == shots_per_sequence:
+                return 0
+            # interrupted half way: start the sequence over
+            session.delete(sequence)
+            session.commit()
 
-    class Sequence(_Task):
-        _object_type_id = 'e5139355-61da-4c8f-9db4-3abc870166bc'
+        statuses = dict(
+            (key, session.get(entity_type, entity_id))
+            for key, (entity_type, entity_id) in schema_ids.items())
+        return create_sequence(session, batcher, project, sequence_name,
+                               statuses)
 
-        __mapper_args__ = {
-            'polymorphic_identity': _object_type_id
-        }
+    if fan_out(units, create, num_projects * sequences_per_project *
+               (1 + shots_per_sequence * (1 + tasks_per_shot))):
+        print 'run bulk_setup again to retry the failed sequences'
 
-        project = relationship('Project', uselist=False)
 
-    class Shot(_Task):
-        _object_type_id = 'bad911de-3bd6-47b9-8b46-3476e237cb36'
+# -----------------------------------------------------------------------------
+# Hierarchy index
+#
+# `context` only links each row to its parent, so finding the shots of a
+# sequence of a project joins one level at a time. The closure table holds a
+# row for every (ancestor, descendant) pair, including every context with
+# itself at depth 0, with the descendant's `task.object_typeid` (NULL for
+# projects) as type discriminator. Any ancestry lookup is then one indexed
+# join, however deep the hierarchy. The closure_* tests build it on demand and
+# the local server keeps it up to date.
+
+HIERARCHY_INDEX_DDL = '''
+CREATE TABLE context_closure (
+    ancestor_id VARCHAR(36) NOT NULL,
+    descendant_id VARCHAR(36) NOT NULL,
+    depth INTEGER NOT NULL,
+    object_typeid VARCHAR(36),
+    PRIMARY KEY (ancestor_id, descendant_id)
+);
+CREATE INDEX context_closure_lookup
+    ON context_closure (ancestor_id, object_typeid, depth);
+CREATE INDEX context_closure_descendant ON context_closure (descendant_id);
+'''
+
+
+def _has_table(cursor, table):
+    if _is_sqlite(cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                       "AND name = '{0}'".format(table))
+    else:
+        cursor.execute("SHOW TABLES LIKE '{0}'".format(table))
+    return bool(cursor.fetchall())
 
-        __mapper_args__ = {
-            'polymorphic_identity': _object_type_id
-        }
+
+def hierarchy_index_is_current(cursor):
+    """
+    Return whether the closure table exists and indexes every context.
+    """
+    if not _has_table(cursor, 'context_closure'):
+        return False
+    cursor.execute('SELECT COUNT(*) AS n FROM context_closure WHERE depth = 0')
+    indexed = cursor.fetchone()['n']
+    cursor.execute('SELECT COUNT(*) AS n FROM context')
+    return indexed == cursor.fetchone()['n']
 
 
-def test_sqlalchemy_01():
+def build_hierarchy_index(cursor):
     """
-    Get all shots of a sequence with sqlalchemy and some quick models.
+    Create, or empty, the closure table and fill it from `context.parent_id`
+    a level at a time. The caller commits.
+
+    Returns
+    -------
+    int
+        Number of closure rows.
     """
-    engine = create_engine(global_data['DB_URI'])
-    # -update
-    session = Session(engine)
-    # -update
-
-    # FIXME: probably am not doing this as efficiently as we could be...
-    subq = session.query(Context)\
-        .filter(Context.sequence)\
-        .filter_by(name=global_data['SEQUENCE_NAME'])\
-        .join(Project, Project.showid == Context.parent_id)\
-        .filter(Project.fullname == global_data['PROJECT_NAME']).subquery()
-
-    r = session.query(Context.name)\
-        .filter(Context.shot)\
-        .join(subq, subq.c.id == Context.parent_id)
-    # -update
-
-    if global_data['RESULT_MODE'] == 'all':
-        shots = [x[0] for x in r.all()]
-        print "num shots:", len(shots)
+    if _has_table(cursor, 'context_closure'):
+        cursor.execute('DELETE FROM context_closure')
     else:
-        print "shot name:", r.first()[0]
+        for statement in HIERARCHY_INDEX_DDL.split(';'):
+            if statement.strip():
+                cursor.execute(statement)
+
+    columns = 'ancestor_id, descendant_id, depth, object_typeid'
+    cursor.execute('''
+        INSERT INTO context_closure ({0})
+        SELECT context.id, context.id, 0, task.object_typeid
+        FROM context LEFT JOIN task ON task.taskid = context.id
+        '''.format(columns))
+    total = cursor.rowcount
+    depth = 0
+    while True:
+        # extend every path ending at depth `depth` by one child
+        cursor.execute('''
+            INSERT INTO context_closure ({0})
+            SELECT closure.ancestor_id, context.id, closure.depth + 1,
+                   task.object_typeid
+            FROM context_closure AS closure
+            JOIN context ON context.parent_id = closure.descendant_id
+            LEFT JOIN task ON task.taskid = context.id
+            WHERE closure.depth = {1}
+            '''.format(columns, depth))
+        if cursor.rowcount <= 0:
+            break
+        total += cursor.rowcount
+        depth += 1
+    return total
+
+
+def ensure_hierarchy_index():
+    """
+    Build the closure table on DB_URI unless it is already current.
+    """
+    from sqlalchemy.engine.url import make_url
+
+    cursor = connect_db(make_url(str(global_data['DB_URI'])))
+    try:
+        if not hierarchy_index_is_current(cursor):
+            start = timeit.default_timer()
+            rows = build_hierarchy_index(cursor)
+            cursor.connection.commit()
+            print 'indexed the hierarchy: {0} closure rows in {1:.1f}s'.format(
+                rows, timeit.default_timer() - start)
+    finally:
+        cursor.connection.close()
 
 
-def test_sqlalchemy_02():
+# -----------------------------------------------------------------------------
+# Read mirror
+#
+# A sqlite copy of the project/sequence/shot/task hierarchy of PROJECT_NAME,
+# bulk loaded through the api once and then kept current from the
+# `ftrack.update` events that every commit publishes. Reads then never leave
+# the machine; the price is the lag between a commit and its event being
+# applied. Events come from the event hub of FTRACK_SERVER or, with --local,
+# from the journal the local server keeps of its writes (see
+# `LocalFtrackBackend.publish`).
+
+MIRROR_DDL = '''
+CREATE TABLE mirror_context (
+    id VARCHAR(36) PRIMARY KEY,
+    type VARCHAR(32),
+    name VARCHAR(255),
+    parent_id VARCHAR(36)
+);
+CREATE INDEX mirror_context_parent_id ON mirror_context (parent_id);
+CREATE INDEX mirror_context_type_name ON mirror_context (type, name);
+'''
+
+# where the read mirror gets its events from
+MIRROR_EVENT_SOURCES = ('hub', 'local')
+
+
+class LocalEventFeed(object):
     """
-    Test retrieving all shots.
+    `ftrack.update` events from the journal of the local server, long-polled
+    over http from the position it had when the feed was made.
     """
-    engine = create_engine(global_data['DB_URI'])
-    # -update
-    session = Session(engine)
-    # -update
 
-    r = session.query(Shot)
-    # -update
+    def __init__(self):
+        import requests
+        self.url = global_data['FTRACK_SERVER'].rstrip('/') + '/events'
+        self.http = requests.Session()
+        self.after = self._get(0, 0)['last']
 
-    if global_data['RESULT_MODE'] == 'all':
-        shots = list(r.all())
-        print "num shots:", len(shots)
-    else:
-        print "shot name:", r.first()
+    def _get(self, after, wait):
+        response = self.http.get(self.url, params=dict(after=after,
+                                                       wait=wait))
+        response.raise_for_status()
+        return response.json()
+
+    def poll(self, timeout):
+        """
+        Return the next events, waiting up to `timeout` seconds for one.
+        """
+        events = self._get(self.after, timeout)['events']
+        if events:
+            self.after = events[-1]['id']
+        return events
 
+    def close(self):
+        self.http.close()
 
-def setup_mysql():
+
+class HubEventFeed(object):
     """
-    Get all shots of a sequence using MySQLdb directly.
+    `ftrack.update` events pushed by the event hub of FTRACK_SERVER,
+    received by a session waiting on the hub in a thread.
     """
-    # ----------------------------------------------------------------------
-    # MYSQL
 
-    import MySQLdb
-    from sqlalchemy.engine.url import make_url
-    global_data['DB_URI'] = make_url(global_data['DB_URI'])
+    def __init__(self):
+        import Queue
+        import threading
+        import ftrack_api
+
+        self.queue = Queue.Queue()
+        self.session = ftrack_api.Session(
+            server_url=global_data['FTRACK_SERVER'],
+            api_key=global_data['FTRACK_APIKEY'],
+            auto_connect_event_hub=True)
+        self.session.event_hub.subscribe('topic=ftrack.update',
+                                         self.queue.put)
+        self._stopping = threading.Event()
+        self.thread = threading.Thread(target=self._listen)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            self.session.event_hub.wait(0.5)
+
+    def poll(self, timeout):
+        """
+        Return the next events, waiting up to `timeout` seconds for one.
+        """
+        import Queue
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except Queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return events
+
+    def close(self):
+        self._stopping.set()
+        self.thread.join()
+        self.session.close()
+
+
+def event_feed():
+    """
+    Return a feed of `ftrack.update` events from MIRROR_EVENTS.
+    """
+    source = global_data['MIRROR_EVENTS']
+    assert source in MIRROR_EVENT_SOURCES, \
+        "MIRROR_EVENTS must be one of {0}".format(MIRROR_EVENT_SOURCES)
+    if source == 'local':
+        return LocalEventFeed()
+    return HubEventFeed()
 
 
-def test_mysql_01():
+class ReadMirror(object):
     """
-    Get all shots of a sequence using MySQLdb directly.
+    Local sqlite copy of the hierarchy of one project.
+
+    `load` fills it through the api, `follow` then applies the events of a
+    feed in a thread: added contexts whose parent is mirrored are inserted,
+    renames and moves updated and removed contexts deleted with everything
+    below them. Other changes are ignored. Readers use their own
+    connection.
+
+    Attributes
+    ----------
+    applied : int
+        Context changes applied from events.
+    lags : list of float
+        For each applied event, seconds between it being sent and applied.
+        The local server and this process share a clock; hub events are
+        skipped unless they carry a numeric `sent` time.
     """
-    session = MySQLdb.connect(
-        host=global_data['DB_URI'].host,
-        db=global_data['DB_URI'].database,
-        user=global_data['DB_URI'].username,
-        passwd=global_data['DB_URI'].password).cursor(MySQLdb.cursors.DictCursor)
-    # -update
 
-    query = '''
-        SELECT context.name FROM task, context
-        JOIN (
-            SELECT * FROM context
-            JOIN `show` ON `show`.showid = context.parent_id
-            WHERE context.name = '{0}'
-            AND show.fullname = '{1}'
-        ) AS anon_1 ON anon_1.id = context.parent_id
-        WHERE task.taskid = context.id
-        AND task.object_typeid IN ('bad911de-3bd6-47b9-8b46-3476e237cb36')
-        '''.format(global_data['SEQUENCE_NAME'], global_data['PROJECT_NAME'])
+    def __init__(self, path, project):
+        import os
+        import threading
+
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+        self.path = path
+        self.project = project
+        self.object_types = {}
+        self.applied = 0
+        self.lags = []
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        self._stopping = threading.Event()
+        self._error = None
+        self._thread = None
+        self._feed = None
+        conn = self.connection
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(MIRROR_DDL)
+
+    @property
+    def connection(self):
+        import sqlite3
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self._local.connection = conn
+        return conn
+
+    def load(self, session, page=5000):
+        """
+        Copy the project and all contexts below it, `page` at a time, with
+        raw queries through `session` (no entities are built). Return the
+        number of contexts.
+        """
+        def query(expression):
+            return session.call([dict(action='query',
+                                      expression=expression)])[0]['data']
+
+        self.object_types = dict(
+            (x['id'], x['name'])
+            for x in query('select id, name from ObjectType'))
+        rows = [(x['id'], 'Project', x['name'], None) for x in query(
+            'select id, name from Project where name is "{0}"'.format(
+                self.project))]
+        offset = 0
+        while True:
+            data = query(
+                'select id, name, parent_id, object_type_id from '
+                'TypedContext where project.name is "{0}" order by id '
+                'offset {1} limit {2}'.format(self.project, offset, page))
+            rows.extend((x['id'],
+                         self.object_types.get(x['object_type_id'],
+                                               'TypedContext'),
+                         x['name'], x['parent_id']) for x in data)
+            if len(data) < page:
+                break
+            offset += page
+
+        conn = self.connection
+        conn.executemany('INSERT OR REPLACE INTO mirror_context '
+                         'VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+        return len(rows)
+
+    def apply(self, events):
+        """
+        Apply a batch of `ftrack.update` events in one transaction and
+        return the number of context changes applied.
+        """
+        conn = self.connection
+        applied = 0
+        for event in events:
+            for entity in event['data'].get('entities', []):
+                applied += self._apply_entity(conn, entity)
+        conn.commit()
+
+        now = time.time()
+        with self._changed:
+            self.applied += applied
+            self.lags.extend(now - x['sent'] for x in events
+                             if isinstance(x.get('sent'), (int, float)))
+            self._changed.notify_all()
+        return applied
+
+    def _apply_entity(self, conn, entity):
+        changes = dict((name.lower(), change['new'])
+                       for name, change in (entity.get('changes') or
+                                            {}).items()
+                       if isinstance(change, dict) and 'new' in change)
+        if 'parentid' in changes:
+            changes['parent_id'] = changes.pop('parentid')
+        entity_id = entity.get('entityId')
+        action = entity.get('action')
+
+        if action == 'remove':
+            cursor = conn.execute('''
+                DELETE FROM mirror_context WHERE id IN (
+                    WITH RECURSIVE subtree(id) AS (
+                        SELECT ?
+                        UNION ALL
+                        SELECT mirror_context.id FROM mirror_context
+                        JOIN subtree ON mirror_context.parent_id = subtree.id
+                    ) SELECT id FROM subtree)''', [entity_id])
+            return 1 if cursor.rowcount > 0 else 0
+
+        if action == 'add':
+            parent_id = changes.get('parent_id') or entity.get('parentId')
+            if entity.get('entityType') == 'show' or not conn.execute(
+                    'SELECT 1 FROM mirror_context WHERE id = ?',
+                    [parent_id]).fetchone():
+                # another project, or below one
+                return 0
+            conn.execute(
+                'INSERT OR REPLACE INTO mirror_context VALUES (?, ?, ?, ?)',
+                [entity_id,
+                 self.object_types.get(entity.get('objectTypeId'),
+                                       'TypedContext'),
+                 changes.get('name'), parent_id])
+            return 1
+
+        columns = [x for x in ('name', 'parent_id') if x in changes]
+        if not columns:
+            return 0
+        cursor = conn.execute(
+            'UPDATE mirror_context SET {0} WHERE id = ?'.format(
+                ', '.join('{0} = ?'.format(x) for x in columns)),
+            [changes[x] for x in columns] + [entity_id])
+        return cursor.rowcount
+
+    def follow(self, feed):
+        """
+        Apply the events of `feed` in a thread until `stop`.
+        """
+        import threading
+
+        def run():
+            try:
+                while not self._stopping.is_set():
+                    events = feed.poll(0.5)
+                    if events:
+                        self.apply(events)
+            except Exception as error:
+                with self._changed:
+                    self._error = error
+                    self._changed.notify_all()
+
+        self._feed = feed
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait_for(self, applied, timeout=60.0):
+        """
+        Wait until `applied` context changes have been applied in total.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            while self.applied < applied and self._error is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError(
+                        'The read mirror applied {0} of {1} changes in '
+                        '{2}s'.format(self.applied, applied, timeout))
+                self._changed.wait(remaining)
+            if self._error is not None:
+                raise self._error
+
+    def take_lags(self):
+        """
+        Return and forget the lags recorded so far.
+        """
+        with self._changed:
+            lags, self.lags = self.lags, []
+        return lags
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._feed.close()
+            self._thread = None
+
+    def shots(self, sequence):
+        """
+        Return the names of the shots of `sequence`.
+        """
+        return [x[0] for x in self.connection.execute('''
+            SELECT shot.name FROM mirror_context AS shot
+            JOIN mirror_context AS sequence ON sequence.id = shot.parent_id
+            WHERE shot.type = 'Shot' AND sequence.name = ?''', [sequence])]
+
+    def all_shots(self):
+        """
+        Return the (id, name) of every shot.
+        """
+        return self.connection.execute(
+            "SELECT id, name FROM mirror_context WHERE type = 'Shot'"
+        ).fetchall()
 
-    session.execute(query)
-    r = session
-    # -update
-    if global_data['RESULT_MODE'] == 'all':
-        shots = [x['name'] for x in r.fetchall()]
-        print "num shots:", len(shots)
-    else:
-        print r.fetchone()['name']
 
+# -----------------------------------------------------------------------------
+# Workload traces
+#
+# A trace is a sequence of backend operations, as sent: sql statements with
+# their parameters and ftrack_api request batches, each with its start time
+# relative to the first and the client (stream) that made it. Traces are
+# captured from the runs of any test with --trace or generated by
+# trace_generate, and replay_01 plays one back with its timing and
+# concurrency. sql operations replay on the kind of database they were
+# written for, through raw cursors or sqlalchemy (TRACE_SQL).
+
+TRACE_VERSION = 1
 
-def test_mysql_02():
+
+def write_trace(path, operations, source):
     """
-    Test retrieving all shots.
+    Write `operations` (as in `TraceRecorder.operations`) to the gzip
+    compressed trace file `path` and return how many there were.
+
+    The first line is a json header with the distinct [backend, kind, text]
+    of the operations; every other line is one operation, the json array
+    [seconds since the first operation started, stream, text index, params,
+    rows, seconds taken]. Threads become streams numbered in order of their
+    first operation.
     """
-    session = MySQLdb.connect(
-        host=global_data['DB_URI'].host,
-        db=global_data['DB_URI'].database,
-        user=global_data['DB_URI'].username,
-        passwd=global_data['DB_URI'].password).cursor(MySQLdb.cursors.DictCursor)
-    # -update
+    import contextlib
+    import gzip
+    import json
+
+    operations = sorted(operations, key=lambda x: x[0])
+    first = operations[0][0] if operations else 0.0
+    texts = {}
+    streams = {}
+    lines = []
+    for started, thread, backend, kind, text, params, rows, seconds \
+            in operations:
+        index = texts.setdefault((backend, kind, text), len(texts))
+        lines.append([round(started - first, 6),
+                      streams.setdefault(thread, len(streams)), index,
+                      params, rows,
+                      None if seconds is None else round(seconds, 6)])
+    header = dict(version=TRACE_VERSION, source=source,
+                  streams=len(streams),
+                  texts=[list(x) for x in sorted(texts, key=texts.get)])
+    with contextlib.closing(gzip.open(path, 'wb')) as f:
+        f.write(json.dumps(header) + '\n')
+        for line in lines:
+            f.write(json.dumps(line, separators=(',', ':')) + '\n')
+    return len(lines)
 
-    query = '''
-        SELECT context.name FROM task, context
-        WHERE context.id = task.taskid
-        AND task.object_typeid IN ('bad911de-3bd6-47b9-8b46-3476e237cb36')
-        '''.format(global_data['PROJECT_NAME'])
 
-    session.execute(query)
-    r = session
-    # -update
-    if global_data['RESULT_MODE'] == 'all':
-        shots = [x['name'] for x in r.fetchall()]
-        print "num shots:", len(shots)
+def read_trace(path):
+    """
+    Return the header and operations of the trace file `path` (see
+    `write_trace`).
+    """
+    import contextlib
+    import gzip
+    import json
+
+    with contextlib.closing(gzip.open(path, 'rb')) as f:
+        header = json.loads(f.readline())
+        assert header.get('version') == TRACE_VERSION, \
+            '{0} is not a version {1} trace'.format(path, TRACE_VERSION)
+        operations = [json.loads(line) for line in f]
+    return header, operations
+
+
+def trace_label(backend, text):
+    """
+    Return the class of a trace operation its latencies are reported under:
+    the verb and first table of a statement, e.g. 'select_task', or the
+    actions and entity types of an ftrack batch, e.g. 'query_Shot'.
+    """
+    import json
+    import re
+
+    if backend == 'sql':
+        verb = re.match(r'\s*(\w*)', text).group(1).lower()
+        table = re.search(r'\b(?:from|into|update)\s+`?(\w+)', text, re.I)
+        return verb + ('_' + table.group(1) if table else '')
+    labels = []
+    for operation in json.loads(text):
+        entity_type = operation.get('entity_type')
+        if 'expression' in operation:
+            try:
+                entity_type = _parse_local_query(
+                    operation['expression'])['entity_type']
+            except LocalQueryError:
+                pass
+        labels.append(operation['action'] +
+                      ('_' + entity_type if entity_type else ''))
+    return '+'.join(labels)
+
+
+def generate_trace(backend, project, sequences, shots, count, rate, streams,
+                   writes, exponent, rng):
+    """
+    Return `count` synthetic operations (as in `TraceRecorder.operations`)
+    on `project` for `backend` ('ftrack' or 'sql').
+
+    Operations arrive as a Poisson process of `rate` per second, each from
+    one of `streams` clients at random. A `writes` fraction renames a random
+    shot of `shots` ((id, name) pairs) to its own name, which goes through
+    the whole write path without changing the data. The others get the
+    shots of one of `sequences`, skewed by `exponent` (see `zipf_pattern`).
+    """
+    import json
+
+    assert backend in ('ftrack', 'sql'), \
+        "TRACE_BACKEND must be 'ftrack' or 'sql'"
+    assert sequences and shots, \
+        'project {0} has no sequences or shots'.format(project)
+    sequences = list(sequences)
+    rng.shuffle(sequences)
+    pattern = iter(zipf_pattern(len(sequences), count, exponent, rng))
+    operations = []
+    started = 0.0
+    for _ in xrange(count):
+        started += rng.expovariate(rate)
+        stream = rng.randrange(streams)
+        if rng.random() < writes:
+            kind = 'write'
+            shot_id, name = rng.choice(shots)
+            if backend == 'sql':
+                text = "UPDATE context SET name = '{0}' WHERE id = '{1}'"\
+                    .format(name, shot_id)
+            else:
+                text = json.dumps([dict(
+                    action='update', entity_type='Shot', entity_key=[shot_id],
+                    entity_data={'__entity_type__': 'Shot', 'name': name})])
+        else:
+            kind = 'read'
+            sequence = sequences[next(pattern)]
+            if backend == 'sql':
+                text = '''
+                    SELECT context.name FROM task, context
+                    JOIN (
+                        SELECT * FROM context
+                        JOIN `show` ON `show`.showid = context.parent_id
+                        WHERE context.name = '{0}'
+                        AND show.fullname = '{1}'
+                    ) AS anon_1 ON anon_1.id = context.parent_id
+                    WHERE task.taskid = context.id
+                    AND task.object_typeid IN (
+                        'bad911de-3bd6-47b9-8b46-3476e237cb36')
+                    '''.format(sequence, project)
+            else:
+                text = json.dumps([dict(
+                    action='query',
+                    expression='select name from Shot where project.name = '
+                               '"{0}" and parent.name = "{1}"'.format(
+                                   project, sequence))])
+        operations.append(
+            (started, stream, backend, kind, text, None, None, None))
+    return operations
+
+
+def trace_generate(ctx):
+    """
+    Write a synthetic trace of TRACE_OPERATIONS TRACE_BACKEND operations on
+    PROJECT_NAME to TRACE_PATH (see `generate_trace`).
+    """
+    import random
+
+    setup_ftrack(ctx)
+    project = global_data['PROJECT_NAME']
+    session = ftrack_session()
+
+    def query(expression):
+        return session.call([dict(action='query',
+                                  expression=expression)])[0]['data']
+
+    sequences = [x['name'] for x in query(
+        'select name from Sequence where project.name is "{0}"'.format(
+            project))]
+    shots = [(x['id'], x['name']) for x in query(
+        'select id, name from Shot where project.name is "{0}"'.format(
+            project))]
+    session.close()
+
+    operations = generate_trace(
+        global_data['TRACE_BACKEND'], project, sequences, shots,
+        int(global_data['TRACE_OPERATIONS']),
+        float(global_data['TRACE_RATE']), int(global_data['TRACE_STREAMS']),
+        float(global_data['TRACE_WRITES']), float(global_data['TRACE_ZIPF']),
+        random.Random(int(global_data['TRACE_SEED'])))
+    print 'wrote {0} operations to {1}'.format(
+        write_trace(global_data['TRACE_PATH'], operations, 'trace_generate'),
+        global_data['TRACE_PATH'])
+
+
+def _trace_connect(backend, engine):
+    # a connection of `backend` for one replay stream
+    if backend == 'ftrack':
+        return ftrack_session()
+    if backend == 'sqlalchemy':
+        return engine.connect()
+    return connect_db(global_data['DB_URI'])
+
+
+def _trace_close(backend, conn):
+    if backend == 'mysql':
+        conn.connection.close()
     else:
-        print "shot name:", r.fetchone()['name']
+        conn.close()
 
 
-# def setup_luma():
-#     """
-#     Get all shots of a sequence using MySQLdb directly.
-#     """
-#     # ----------------------------------------------------------------------
-#     # MYSQL
-#
-#     import MySQLdb
-#
-#
-# def test_luma_01():
-#     """
-#     Get all shots of a sequence using MySQLdb directly.
-#     """
-#     session = MySQLdb.connect(
-#         host='lumadb',
-#         db='luma',
-#         user='internal',
-#         passwd='dbConnect76').cursor(MySQLdb.cursors.DictCursor)
-#     # -update
-#
-#     query = '''SELECT shots.shot_name AS name FROM shots
-#     LEFT JOIN projects USING (id_project)
-#     WHERE projects.id_project = "boxcars" AND shots.prefix = "AF"'''
-#
-#     session.execute(query)
-#     r = session
-#     # -update
-#     if global_data['RESULT_MODE'] == 'all':
-#         shots = [x['name'] for x in r.fetchall()]
-#         print "num shots:", len(shots)
-#     else:
-#         print r.fetchone()['name']
+def _trace_execute(conn, backend, kind, text, params):
+    """
+    Run one trace operation over the `backend` connection `conn` and
+    return the rows it returned, or else affected.
+    """
+    import json
+
+    if backend == 'ftrack':
+        return sum(len(x.get('data') or [])
+                   for x in conn.call(json.loads(text))
+                   if isinstance(x, dict) and x.get('action') == 'query')
+
+    many = isinstance(params, dict) and '__many__' in params
+    if backend == 'sqlalchemy':
+        if many:
+            result = conn.execute(text, [
+                tuple(x) if isinstance(x, list) else x
+                for x in params['__many__']])
+        elif params is None:
+            result = conn.execute(text)
+        else:
+            result = conn.execute(
+                text, tuple(params) if isinstance(params, list) else params)
+        return len(result.fetchall()) if result.returns_rows \
+            else result.rowcount
+
+    if many:
+        conn.executemany(text, params['__many__'])
+    elif params is None:
+        conn.execute(text)
+    else:
+        conn.execute(text, params)
+    if kind == 'write':
+        conn.connection.commit()
+    return len(conn.fetchall()) if conn.description else conn.rowcount
+
 
 # -----------------------------------------------------------------------------
-# Setup
+# Startup
+
+# Every farm task pays for starting the interpreter, importing ftrack_api,
+# sqlalchemy and MySQLdb and building a first session (which crawls
+# FTRACK_EVENT_PLUGIN_PATH) before doing any work. `startup_01` measures each
+# of these steps in fresh subprocesses, so nothing is already imported or
+# cached. Python 2 has no `-X importtime`, so the child process replaces
+# `__import__` to time every import that loads new modules, by submodule.
+
+# run with `python -c` as: import MODULE | session SERVER_URL, the api key
+# of the session in FTRACK_API_KEY so it is not on the command line
+# prints "import <depth> <module> <self> <cumulative>" per loaded module and
+# "step <name> <seconds>" lines, tab separated
+_STARTUP_CHILD = r'''
+import os
+import sys
+import time
 
 
-def setup_ftrack_create():
+def _package(globals, level):
+    # package a relative import in the module `globals` is resolved against
+    if not globals or level == 0:
+        return None
+    package = globals.get('__package__')
+    if package is None:
+        package = globals.get('__name__', '')
+        if '__path__' not in globals:
+            package = package.rpartition('.')[0]
+    if level > 1:
+        package = package.rsplit('.', level - 1)[0]
+    return package
+
+
+def time_imports(records):
+    import __builtin__
+    real_import = __builtin__.__import__
+    # [start, seconds spent in recorded child imports] per open import
+    stack = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        package = _package(globals, level)
+        relative = '.'.join(filter(None, (package, name)))
+        known = set(module for module in (name, relative)
+                    if sys.modules.get(module) is not None)
+        loaded = len(sys.modules)
+        frame = [time.time(), 0.0]
+        stack.append(frame)
+        try:
+            return real_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - frame[0]
+            stack.pop()
+            if len(sys.modules) > loaded:
+                # python 2 imports implicitly relative first
+                module = relative if package is not None and (
+                    level > 0 or sys.modules.get(relative) is not None) \
+                    else name
+                if module in known and fromlist:
+                    # only submodules named in `from module import ...`
+                    module += '.' + (fromlist[0] if len(fromlist) == 1 else
+                                     '{' + ','.join(fromlist) + '}')
+                records.append((len(stack), module, elapsed - frame[1],
+                                elapsed))
+                if stack:
+                    stack[-1][1] += elapsed
+
+    __builtin__.__import__ = timed_import
+
+
+def timed(times, name, method):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            times[name] = times.get(name, 0.0) + time.time() - start
+    return wrapper
+
+
+records = []
+steps = {}
+if sys.argv[1] == 'import':
+    time_imports(records)
+    start = time.time()
+    __import__(sys.argv[2])
+    steps['import'] = time.time() - start
+else:
+    start = time.time()
+    import ftrack_api
+    steps['import'] = time.time() - start
+    Session = ftrack_api.Session
+    for name, attribute in (('plugins', '_discover_plugins'),
+                            ('schemas', '_load_schemas'),
+                            ('types', '_build_entity_type_classes'),
+                            ('locations', '_configure_locations')):
+        setattr(Session, attribute,
+                timed(steps, name, getattr(Session, attribute)))
+    start = time.time()
+    session = Session(server_url=sys.argv[2],
+                      api_key=os.environ['FTRACK_API_KEY'],
+                      auto_connect_event_hub=False)
+    steps['construct'] = time.time() - start
+    session.close()
+
+for record in records:
+    print 'import\t%d\t%s\t%r\t%r' % record
+for name, seconds in steps.items():
+    print 'step\t%s\t%r' % (name, seconds)
+'''
+
+
+class ImportRecorder(object):
     """
-    Create test project, sequences and shots using the ftrack_api.
+    Collects the per module import times reported by the `startup_01`
+    subprocesses of each run.
+
+    Attributes
+    ----------
+    runs : list of list
+        For each run, (imported module, depth, module, self seconds,
+        cumulative seconds) per module that was loaded.
     """
-    import os
 
-    # Remove any of our custom stuff from the plugin path.
-    # NOTE: Without this we get an additional overhead of ~1 second between
-    #       importing the api and constructing the session.
-    os.environ['FTRACK_EVENT_PLUGIN_PATH'] = ''
+    def __init__(self):
+        self.runs = []
+
+    def start_run(self):
+        self.runs.append([])
+
+    def record(self, imported, records):
+        """
+        Add the `records` of a subprocess that imported `imported`.
+        """
+        if self.runs:
+            self.runs[-1].extend((imported,) + tuple(record)
+                                 for record in records)
+
+    def discard(self, first, count):
+        """
+        Forget `count` runs starting at index `first`, e.g. warmup runs.
+        """
+        del self.runs[first:first + count]
+
+    def summarize(self):
+        """
+        Return a list of dicts with the mean self and cumulative seconds per
+        run of every loaded module, the largest self time first.
+        """
+        import collections
+
+        if not any(self.runs):
+            return []
+        totals = collections.OrderedDict()
+        for run in self.runs:
+            for imported, depth, module, own, cumulative in run:
+                total = totals.setdefault((imported, module), [depth, 0.0,
+                                                               0.0])
+                total[1] += own
+                total[2] += cumulative
+        result = [collections.OrderedDict([
+            ('imported', imported), ('module', module), ('depth', depth),
+            ('self', own / len(self.runs)),
+            ('cumulative', cumulative / len(self.runs)),
+        ]) for (imported, module), (depth, own, cumulative)
+            in totals.items()]
+        result.sort(key=lambda row: -row['self'])
+        return result
+
+
+# shared by all tests, see `ImportRecorder`
+imports = ImportRecorder()
+
+
+def format_imports(rows):
+    """
+    Return a human readable table of `ImportRecorder.summarize` output.
+    """
+    lines = ['imports (per run, by self time):',
+             '  {0:>9} {1:>9}  {2}'.format('self ms', 'cumul ms', 'module')]
+    for row in rows:
+        lines.append('  {0:9.2f} {1:9.2f}  {2} ({3})'.format(
+            row['self'] * 1e3, row['cumulative'] * 1e3, row['module'],
+            row['imported']))
+    return '\n'.join(lines)
 
-    import ftrack_api
 
+def run_startup_child(python, args, env=None):
+    """
+    Run `_STARTUP_CHILD` with `args` in a fresh `python` process.
 
-def test_ftrack_create():
+    Returns
+    -------
+    tuple
+        (records, steps): the (depth, module, self, cumulative) import
+        records and step name -> seconds reported by the child.
     """
-    Create test project, sequences and shots using the ftrack_api.
+    import subprocess
+
+    child = subprocess.Popen([python, '-c', _STARTUP_CHILD] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=env)
+    out, err = child.communicate()
+    if child.returncode:
+        raise RuntimeError('startup step {0} failed:\n{1}'.format(
+            ' '.join(args), err))
+    records = []
+    steps = {}
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if fields[0] == 'import':
+            records.append((int(fields[1]), fields[2], float(fields[3]),
+                            float(fields[4])))
+        elif fields[0] == 'step':
+            steps[fields[1]] = float(fields[2])
+    return records, steps
+
+
+def write_plugins(root, count):
     """
-    num_projects = int(global_data['PROJECTS'])
-    sequences_per_project = int(global_data['SEQUENCES_PER_PROJECT'])
-    shots_per_sequence = int(global_data['SHOTS_PER_SEQUENCES'])
-    tasks_per_shot = int(global_data['TASKS_PER_SHOT'])
+    Write `count` event plugins under `root`, one directory per plugin laid
+    out like a typical ftrack plugin (<plugin>/hook/<plugin>.py), each
+    subscribing to a topic.
+    """
+    import os
 
-    print "creating a total of {} projects, {} sequences, {} shots, {} tasks".format(
-        num_projects,
-        num_projects * sequences_per_project,
-        num_projects * sequences_per_project * shots_per_sequence,
-        num_projects * sequences_per_project * shots_per_sequence * tasks_per_shot,
-    )
+    for number in range(count):
+        name = 'plugin_{0}'.format(number)
+        hook = os.path.join(root, name, 'hook')
+        os.makedirs(hook)
+        with open(os.path.join(hook, name + '.py'), 'w') as f:
+            f.write(
+                'import ftrack_api\n\n\n'
+                'def register(session, **kw):\n'
+                '    if not isinstance(session, ftrack_api.Session):\n'
+                '        return\n'
+                '    session.event_hub.subscribe(\n'
+                '        "topic=perf.startup.{0}", lambda event: None)\n'
+                .format(number))
+
+
+def setup_startup(ctx):
+    """
+    Pick the modules and plugin path configurations of the cold start suite.
 
-    session = ftrack_api.Session(server_url=global_data['FTRACK_SERVER'],
-                                 api_key=global_data['FTRACK_APIKEY'])
-    # -update
+    STARTUP_PLUGIN_PATHS lists the FTRACK_EVENT_PLUGIN_PATH values a session
+    is built with: 'empty', 'environment' (the value this script was started
+    with), 'generated' (STARTUP_PLUGINS generated plugins) or a literal
+    path list.
+    """
+    import os
+    import imp
+    import sys
+    import atexit
+    import shutil
+    import tempfile
+
+    ctx.python = sys.executable
+    ctx.modules = []
+    for module in global_data['STARTUP_MODULES'].split(','):
+        try:
+            imp.find_module(module.split('.')[0])
+        except ImportError:
+            print 'skipping import of {0}: not installed'.format(module)
+        else:
+            ctx.modules.append(module)
+
+    ctx.plugin_paths = []
+    for config in global_data['STARTUP_PLUGIN_PATHS'].split(','):
+        if config == 'empty':
+            path = ''
+        elif config == 'environment':
+            path = os.environ.get('FTRACK_EVENT_PLUGIN_PATH', '')
+        elif config == 'generated':
+            path = tempfile.mkdtemp(prefix='perf_plugins_')
+            atexit.register(shutil.rmtree, path, True)
+            write_plugins(path, int(global_data['STARTUP_PLUGINS']))
+        else:
+            path = config
+            config = 'paths{0}'.format(len(ctx.plugin_paths) + 1)
+        print 'plugin path configuration {0}: {1!r}'.format(config, path)
+        ctx.plugin_paths.append((config, path))
 
-    # Choose project schema.
-    project_schema = session.query('ProjectSchema').first()
-    # -update
 
-    # -update
+def test_startup_01(ctx):
+    """
+    Time interpreter start, the import of every STARTUP_MODULES module and
+    the construction of a first ftrack session with every plugin path
+    configuration, each in a fresh process.
 
-    # Retrieve default types.
-    default_shot_status = project_schema.get_statuses('Shot')[0]
-    default_task_type = project_schema.get_types('Task')[0]
-    default_task_status = project_schema.get_statuses(
-        'Task', default_task_type['id'])[0]
+    Phases are the wall time of each process as seen from here, values the
+    times measured inside it. The session does not connect the event hub,
+    which happens in a background thread by default.
+    """
+    import os
+    import subprocess
+
+    for name, flags in (('interpreter', []), ('interpreter_no_site', ['-S'])):
+        with phase(name):
+            subprocess.check_call([ctx.python] + flags + ['-c', 'pass'])
+
+    for module in ctx.modules:
+        with phase('import_' + module):
+            records, steps = run_startup_child(ctx.python,
+                                               ['import', module])
+        imports.record(module, records)
+        phase.record('import_{0}'.format(module), steps['import'])
+
+    for config, path in ctx.plugin_paths:
+        env = dict(os.environ, FTRACK_EVENT_PLUGIN_PATH=path,
+                   FTRACK_API_KEY=global_data['FTRACK_APIKEY'])
+        with phase('session_' + config):
+            _, steps = run_startup_child(
+                ctx.python, ['session', global_data['FTRACK_SERVER']],
+                env=env)
+        for name, seconds in steps.items():
+            phase.record('session_{0}/{1}'.format(config, name), seconds)
 
-    counter = 0
 
-    for project_number in range(1, num_projects + 1):
-        # Create the project with the chosen schema.
-        project_name = 'perf_test_{0}'.format(project_number),
-        project = session.create('Project', {
-            'name': project_name,
-            'full_name': project_name,
-            'project_schema': project_schema
-        })
-        counter += 1
-        # Create sequences, shots and tasks.
-        for sequence_number in range(1, sequences_per_project + 1):
-            sequence = session.create('Sequence', {
-                'name': 'seq_{0}'.format(sequence_number),
-                'parent': project
-            })
-            counter += 1
-            for shot_number in range(1, shots_per_sequence + 1):
-                shot = session.create('Shot', {
-                    'name': 'shot_{0:03d}'.format(shot_number),
-                    'parent': sequence,
-                    'status': default_shot_status
-                })
-                counter += 1
-                for task_number in range(1, tasks_per_shot + 1):
-                    session.create('Task', {
-                        'name': 'task_{0}'.format(task_number),
-                        'parent': shot,
-                        'status': default_task_status,
-                        'type': default_task_type
-                    })
-                    counter += 1
-                    if counter > 10:
-                        # need to commit and garbage collect periodically to
-                        # avoid running out of memory
-                        session.commit()
-                        gc.collect()
-                        counter = 0
-
-    # -update
-    if counter > 0:
-        session.commit()
+# -----------------------------------------------------------------------------
+# History
+#
+# Every timed run is appended to a sqlite database (HISTORY_DB) with its
+# samples, the global data overrides and the environment it ran in, so later
+# runs can be compared against a labelled baseline (see --label/--compare).
+
+HISTORY_DDL = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created TEXT,
+    test TEXT,
+    label TEXT,
+    overrides TEXT,
+    global_data TEXT,
+    environment TEXT,
+    samples TEXT,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_test_label ON runs (test, label);
+'''
+
+
+def _public_global_data(data=None):
+    # `data` (default all global data) without credentials: the api key is
+    # dropped and the passwords of URLs such as DB_URI are masked
+    import re
+    if data is None:
+        data = global_data
+    data = dict((key, re.sub(r'(://[^:/@]*):[^@]*@', r'\1:***@', str(value)))
+                for key, value in data.items())
+    data.pop('FTRACK_APIKEY', None)
+    return data
+
+
+def _server_versions():
+    # versions reported by the servers behind this thread's connections
+    versions = {}
+    for (backend, _, _, _), pool in _connection_pools.items():
+        conn = pool.current()
+        if conn is None:
+            continue
+        try:
+            if backend == 'ftrack':
+                versions['ftrack_server'] = \
+                    conn.server_information.get('version')
+            elif backend == 'sqlalchemy':
+                versions['database'] = '.'.join(
+                    str(part) for part in
+                    conn.bind.dialect.server_version_info or ())
+            elif backend == 'mysql':
+                if _is_sqlite(conn):
+                    conn.execute('SELECT sqlite_version() AS version')
+                else:
+                    conn.execute('SELECT VERSION() AS version')
+                versions['database'] = conn.fetchone()['version']
+        except Exception as error:
+            versions[backend] = 'unknown ({0!r})'.format(error)
+    return versions
+
+
+def run_environment():
+    """
+    Return the host, python and library/server versions of this run.
+    """
+    import collections
+    import multiprocessing
+    import platform
+    import sys
 
+    libraries = collections.OrderedDict()
+    for module in ('ftrack_api', 'sqlalchemy', 'MySQLdb'):
+        if module in sys.modules:
+            libraries[module] = getattr(sys.modules[module], '__version__',
+                                        'unknown')
+    if 'sqlite3' in sys.modules:
+        libraries['sqlite'] = sys.modules['sqlite3'].sqlite_version
+    return collections.OrderedDict([
+        ('host', platform.node()),
+        ('platform', platform.platform()),
+        ('python', platform.python_version()),
+        ('cpus', multiprocessing.cpu_count()),
+        ('libraries', libraries),
+        ('servers', _server_versions()),
+    ])
+
+
+def _history_connection(path):
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.executescript(HISTORY_DDL)
+    return conn
+
+
+def save_history(path, name, samples, summary, overrides, label=None):
+    """
+    Append a run of test `name` to the history database at `path`.
 
-def get_sequence(project):
-    import ftrack_api
+    Parameters
+    ----------
+    overrides : dict
+        The global data given on the command line.
+    label : str
+        Name to find this run by later, e.g. 'baseline'.
 
-    session = ftrack_api.Session(server_url=global_data['FTRACK_SERVER'],
-                                 api_key=global_data['FTRACK_APIKEY'])
+    Returns
+    -------
+    int
+        Id of the stored run.
+    """
+    import datetime
+    import json
+
+    conn = _history_connection(path)
+    try:
+        cursor = conn.execute(
+            'INSERT INTO runs (created, test, label, overrides, global_data, '
+            'environment, samples, summary) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (datetime.datetime.utcnow().isoformat(), name, label,
+             json.dumps(overrides), json.dumps(_public_global_data()),
+             json.dumps(run_environment()), json.dumps(samples),
+             json.dumps(summary)))
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def load_history(path, name, label):
+    """
+    Return the latest run of test `name` stored with `label`, as a dict of
+    the `runs` columns with the json decoded, or None.
+    """
+    import json
+
+    conn = _history_connection(path)
+    try:
+        row = conn.execute(
+            'SELECT id, created, test, label, overrides, global_data, '
+            'environment, samples, summary FROM runs WHERE test = ? AND '
+            'label = ? ORDER BY id DESC LIMIT 1', (name, label)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    keys = ('id', 'created', 'test', 'label', 'overrides', 'global_data',
+            'environment', 'samples', 'summary')
+    run = dict(zip(keys, row))
+    for key in keys[4:]:
+        run[key] = json.loads(run[key])
+    return run
+
+
+def mann_whitney(baseline, candidate):
+    """
+    One sided Mann-Whitney U test of `candidate` being slower than
+    `baseline`.
 
-    seq = session.query('select name from Sequence where project.name = '
-                        '"{0}"'.format(project)).first()
-    return seq['name']
+    Uses the normal approximation with a tie correction, which is reasonable
+    from around 8 samples each.
 
+    Returns
+    -------
+    tuple
+        (U statistic of `candidate`, p-value)
+    """
+    n1, n2 = len(baseline), len(candidate)
+    ranked = sorted([(x, 0) for x in baseline] + [(x, 1) for x in candidate])
+    ranks = [0.0] * len(ranked)
+    ties = 0.0
+    i = 0
+    while i < len(ranked):
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    rank_sum = sum(rank for rank, (_, group) in zip(ranks, ranked) if group)
+    u = rank_sum - n2 * (n2 + 1) / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return u, 0.5
+    # continuity corrected z of U being larger than under the null
+    z = (u - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+    return u, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare_samples(baseline, candidate, alpha=0.05, threshold=0.05):
+    """
+    Compare the run times of a `candidate` against a `baseline`.
 
-def cleanup_ftrack_project():
-    import ftrack_api
-    num_projects = int(global_data['PROJECTS'])
+    A regression is a candidate median more than `threshold` (a fraction)
+    above the baseline's, with the Mann-Whitney p-value below `alpha`.
 
-    session = ftrack_api.Session(server_url=global_data['FTRACK_SERVER'],
-                                 api_key=global_data['FTRACK_APIKEY'])
+    Returns
+    -------
+    collections.OrderedDict
+        Both medians, their ratio with a bootstrap confidence interval, the
+        p-value and whether it is a regression.
+    """
+    import collections
+    import random
+
+    def median(values):
+        return percentile(values, 50)
+
+    rng = random.Random(0)
+    ratios = []
+    for _ in xrange(1000):
+        b = [baseline[rng.randrange(len(baseline))] for _ in baseline]
+        c = [candidate[rng.randrange(len(candidate))] for _ in candidate]
+        if median(b):
+            ratios.append(median(c) / median(b))
+    if median(baseline):
+        ratio = median(candidate) / median(baseline)
+    else:
+        # a baseline too fast to time: only a slower candidate counts
+        ratio = float('inf') if median(candidate) else 1.0
+    _, p_value = mann_whitney(baseline, candidate)
+    return collections.OrderedDict([
+        ('baseline_median', median(baseline)),
+        ('candidate_median', median(candidate)),
+        ('ratio', ratio),
+        ('ratio_ci_low', percentile(ratios, 2.5)),
+        ('ratio_ci_high', percentile(ratios, 97.5)),
+        ('p_value', p_value),
+        ('regression', p_value < alpha and ratio > 1 + threshold),
+    ])
+
+
+def format_comparison(name, baseline, candidate, comparison):
+    """
+    Return a human readable version of a `compare_samples` result between
+    the `baseline` and `candidate` history runs.
+    """
+    return ('{0}: {1} (run {2[id]}, {2[created]}) -> {3}: median '
+            '{4[baseline_median]:06f} -> {4[candidate_median]:06f} '
+            '({4[ratio]:.3f}x, 95% CI {4[ratio_ci_low]:.3f}-'
+            '{4[ratio_ci_high]:.3f}) p={4[p_value]:.4f} {5}'.format(
+                name, baseline['label'], baseline,
+                candidate.get('label') or 'this run', comparison,
+                'REGRESSION' if comparison['regression'] else 'ok'))
 
-    for project_number in range(1, num_projects + 1):
-        # Create the project with the chosen schema.
-        project_name = 'perf_test_{0}'.format(project_number)
-        print project_name
-        project = session.query('Project where name = '
-                                '"{0}"'.format(project_name)).first()
-        if project:
-            print "Deleting project '{0}'".format(project_name)
-            session.delete(project)
-            session.commit()
+
+# -----------------------------------------------------------------------------
+# Command line
 
 
 def gather_tests():
     tests = {
         'setup': (test_ftrack_create, setup_ftrack_create),
-        'cleanup': (cleanup_ftrack_project, 'pass')
+        'cleanup': (cleanup_ftrack_project, None),
+        'local_seed': (local_seed, None),
+        'local_serve': (local_serve, None),
+        'bulk_seed': (bulk_seed, None),
+        'bulk_setup': (bulk_setup, None),
+        'trace_generate': (trace_generate, None)
     }
     for name, value in globals().iteritems():
         parts = name.split('_')
@@ -634,26 +7761,230 @@ the data
     %(prog)s ftrack_02 --runs 5 -g FTRACK_SERVER='http://ftrack.luma.ninja' FTRACK_APIKEY='51d31b5e-4db9-11e5-a496-e0db550a3928'
     %(prog)s cleanup -g FTRACK_SERVER='http://ftrack.luma.ninja' FTRACK_APIKEY='51d31b5e-4db9-11e5-a496-e0db550a3928'
 
+Throughput of 1 to 32 concurrent processes hammering a query for 10s each:
+    %(prog)s mysql_01 --local --concurrency 1 2 4 8 16 32 --pool process -d 10
+
+Reuse connections between runs so only the query cost is measured (see
+ConnectionPool for the 'cold', 'pooled' and 'persistent' modes):
+    %(prog)s sqlalchemy_01 --runs 20 -g CONNECTION_MODE='pooled' POOL_SIZE='10'
+
+Stream all shots through a server side cursor instead of fetching them at
+once, reporting time to first row, rows/s and peak memory per run:
+    %(prog)s mysql_02 --runs 5 -g RESULT_MODE='stream' STREAM_CHUNK_SIZE='500'
+
+Compare lazy (N+1) against eager loading of each shot's context; the
+statements every sqlalchemy run sent are listed after the timings:
+    %(prog)s sqlalchemy_03 --runs 5 -g SQLALCHEMY_LOADING='lazy'
+    %(prog)s sqlalchemy_03 --runs 5 -g SQLALCHEMY_LOADING='selectin'
+
+Look shots up through the context_closure hierarchy index instead of joining
+a level at a time (closure_01/02 mirror mysql_01/02, closure_03/04 mirror
+sqlalchemy_01/02); the index is built on DB_URI if missing or stale:
+    %(prog)s closure_01 --runs 5 --local
+    %(prog)s mysql_01 closure_01 --local --runs 5 --sweep SEQUENCES_PER_PROJECT=10,100 SHOTS_PER_SEQUENCES=10,100
+
+Compare how fast rows are fetched and how much memory each holds as tuples,
+DictCursor dicts, ORM objects or compact columns (values in typed arrays and
+string pools):
+    %(prog)s sqlalchemy_02 --runs 5 -g MATERIALIZE='columnar'
+    %(prog)s mysql_02 --local --runs 5 --sweep MATERIALIZE=tuple,dict,columnar SHOTS_PER_SEQUENCES=100,1000
+
+Pass the names as literals, bound parameters or a server side prepared
+statement, and reuse a baked sqlalchemy query instead of building and
+compiling it every run (compile_seconds is recorded per sqlalchemy run):
+    %(prog)s mysql_01 --runs 10 --sweep MYSQL_STATEMENTS=literal,bound,prepared -g CONNECTION_MODE='persistent'
+    %(prog)s sqlalchemy_01 --runs 10 --sweep SQLALCHEMY_STATEMENTS=construct,baked -g CONNECTION_MODE='persistent'
+
+Fetch all shots a page at a time by offset or keyset (seeking past the last
+id), with several connections at once; sweeps list the peak memory of every
+page size:
+    %(prog)s ftrack_02 --runs 3 --sweep PAGE_SIZE=100,500,2000 PAGING=offset,keyset -g RESULT_MODE='paged'
+    %(prog)s mysql_02 --runs 3 -g RESULT_MODE='paged' PAGING='keyset' PAGE_WORKERS='4'
+
+Read extra Shot attributes with a cold, warm in-memory, file backed or cross
+process ftrack cache, or select them instead of auto-populating them; round
+trips, cache hit rates and avoided lazy fetches are recorded per run:
+    %(prog)s ftrack_01 --runs 5 --sweep FTRACK_CACHE=session,memory,file -g FTRACK_ATTRIBUTES='description,sort'
+    %(prog)s ftrack_02 --runs 5 -g FTRACK_AUTO_POPULATE='0' FTRACK_ATTRIBUTES='description,sort'
+
+Get the shots of every sequence of the project one query at a time, from 8
+threads or with 8 queries in flight on non-blocking sockets, comparing the
+total time and the per-query latencies:
+    %(prog)s fanout_01 fanout_02 --local --runs 5 --sweep FANOUT_MODE=sequential,threads,async -g FANOUT_LIMIT='8'
+
+Read the shots from a local sqlite mirror of the project, kept current from
+ftrack.update events, and measure how far it lags behind a storm of 1000
+renames committed 100 at a time:
+    %(prog)s mirror_01 --runs 10 --local
+    %(prog)s mirror_03 --runs 5 --local -g MIRROR_STORM='1000' MIRROR_STORM_BATCH='100'
+
+Capture the statements and requests of a test (here under load from 4
+threads) into a workload trace, or generate a synthetic one, then play it
+back at its recorded pace, 10 times faster or as fast as possible, reporting
+latency percentiles per class of operation:
+    %(prog)s ftrack_01 --runs 100 --concurrency 4 --trace perf_trace.jsonl.gz
+    %(prog)s trace_generate --runs 1 -g TRACE_BACKEND='sql' TRACE_RATE='100' TRACE_WRITES='0.1'
+    %(prog)s replay_01 --runs 3 --sweep TRACE_SQL=mysql,sqlalchemy TRACE_SPEED=1,10,0
+
+Find which objects a test leaves behind (memory use is always reported):
+    %(prog)s ftrack_02 --runs 5 --memory-profile ftrack_02_memory.json
+
+Fit how latency grows with the number of shots for each backend, and where
+it passes 1 second:
+    %(prog)s mysql_02 sqlalchemy_02 ftrack_02 --local --runs 5 --sweep SHOTS_PER_SEQUENCES=10,50,100,200 --budget 1 -o sweep.csv
+
+Build a production sized hierarchy directly in the database, or through the
+api with 8 sessions; both can be rerun to resume after an interruption:
+    %(prog)s bulk_seed -g PROJECTS='100' SEQUENCES_PER_PROJECT='50' SHOTS_PER_SEQUENCES='200' TASKS_PER_SHOT='10'
+    %(prog)s bulk_setup -g PROJECTS='100' BULK_WORKERS='8' BULK_BATCH_SIZE='500'
+
+Create and delete the test projects with 1 to 8 sessions at once, commits
+sized from the measured round-trip time, reporting entities/s per worker
+count:
+    %(prog)s cleanup setup --local --runs 1 --sweep BULK_WORKERS=1,2,4,8 -g BULK_BATCH_SIZE='auto'
+
+Put a simulated WAN link (latency, jitter, bandwidth, loss) between the
+tests and the database or ftrack server, e.g. to see how lazy attribute
+fetches add up from a remote site:
+    %(prog)s ftrack_01 --local --wan --runs 3 --sweep WAN_LATENCY_MS=0,20,80 -g FTRACK_ATTRIBUTES='description'
+    %(prog)s mysql_02 --wan --runs 5 -g WAN_LATENCY_MS='120' WAN_BANDWIDTH_KBPS='2000' WAN_LOSS='0.01'
+
+Record a baseline, then fail (exit status 1) if a later run is significantly
+slower, e.g. after upgrading the ftrack server:
+    %(prog)s ftrack_01 --runs 20 --label baseline
+    %(prog)s ftrack_01 --runs 20 --compare baseline
+
+Find where ftrack_01 spends its time; open the pstats with snakeviz or feed the
+.collapsed files to flamegraph.pl:
+    %(prog)s ftrack_01 --runs 20 --profile profiles/
+
+Replay 1000 Zipf skewed "shots of a sequence" requests through a 64 entry
+read-through cache in front of sqlalchemy, with 1%% of them creating and
+deleting a shot through the api (which invalidates the cached shot lists):
+    %(prog)s cache_01 --runs 5 -g QUERY_CACHE_BACKEND='sqlalchemy' QUERY_CACHE_SIZE='64' QUERY_CACHE_WRITES='0.01'
+
+Time interpreter start, the imports (per submodule) and a first session with
+no, the current and 100 generated event plugins, each in a fresh process:
+    %(prog)s startup_01 --runs 10 -g STARTUP_PLUGINS='100'
+
 Print more verbose output:
     %(prog)s -v
 
 Query an existing project instead of creating a test one:
     %(prog)s -p projectName
 
+Run against the local stand-in backend instead of sv-sql03/ftrack.luma.ninja.
+The store is seeded from PROJECTS, SEQUENCES_PER_PROJECT, SHOTS_PER_SEQUENCES
+and TASKS_PER_SHOT (and reused while those stay the same):
+    %(prog)s mysql_01 --runs 5 --local
+    %(prog)s ftrack_01 --runs 5 --local -g SHOTS_PER_SEQUENCES='200'
+
     ''')
 
     parser.add_argument(
-        dest='test', type=str, choices=gather_tests().keys(),
-        help='Specify the test you wish to run')
+        dest='test', type=str, choices=gather_tests().keys(), nargs='+',
+        help='Specify the test you wish to run (several with --sweep)')
 
     parser.add_argument(
         '-r', '--runs', type=int, default=1,
         help='Number of times to run each test.')
 
+    parser.add_argument(
+        '-w', '--warmup', type=int, default=0,
+        help='Number of untimed runs before the timed ones. Useful to keep '
+             'first-run costs (imports, caches) out of the statistics.')
+
+    parser.add_argument(
+        '-o', '--output', metavar='PATH',
+        help='Write every run sample and the summary statistics to PATH, as '
+             'csv if it ends in .csv, json otherwise.')
+
+    parser.add_argument(
+        '-c', '--concurrency', metavar='N', type=int, nargs='+',
+        help='Load test: run the test from N concurrent workers and report '
+             'throughput and latency percentiles. Several values give a '
+             'saturation curve. Each worker count runs for --duration '
+             'seconds, or until --runs requests were made in total.')
+
+    parser.add_argument(
+        '--pool', choices=('thread', 'process'), default='thread',
+        help='Run concurrent workers as threads or processes.')
+
+    parser.add_argument(
+        '-d', '--duration', type=float,
+        help='Seconds to run each worker count for with --concurrency.')
+
+    parser.add_argument(
+        '-s', '--sweep', metavar="VAR=v1,v2", nargs='+',
+        help='Run the tests at every combination of the given global data '
+             'values, e.g. SHOTS_PER_SEQUENCES=10,100,1000 RESULT_MODE=all,'
+             'first, and fit latency against row count. Data sizes can only '
+             'be swept with --local, which seeds (once) a store per size.')
+
+    parser.add_argument(
+        '--budget', metavar='SECONDS', type=float,
+        help='With --sweep, report the row count at which each fitted curve '
+             'exceeds this latency.')
+
+    parser.add_argument(
+        '-l', '--label', metavar='NAME',
+        help='Store this run in HISTORY_DB under NAME, e.g. baseline.')
+
+    parser.add_argument(
+        '--compare', metavar='LABEL', nargs='+',
+        help='Compare this run against the latest run of the test stored '
+             'with LABEL, and exit with status 1 on a significant slowdown. '
+             'With a second LABEL, compare those two stored runs instead of '
+             'running the test.')
+
+    parser.add_argument(
+        '--no-history', action='store_true',
+        help='Do not record this run in HISTORY_DB.')
+
+    parser.add_argument(
+        '-P', '--profile', metavar='DIR',
+        help='Profile the timed runs (not setup or warmup) and write pstats '
+             'and collapsed stacks (for flamegraph.pl) for the test and each '
+             'of its phases to DIR. Timings include the profiler overhead.')
+
+    parser.add_argument(
+        '--profiler', choices=('both', 'cprofile', 'sampling'),
+        default='both',
+        help='Profiler used by --profile: deterministic cProfile for pstats, '
+             'stack sampling every PROFILE_INTERVAL seconds for collapsed '
+             'stacks, or both at once (the samples then include cProfile '
+             'overhead).')
+
+    parser.add_argument(
+        '-m', '--memory-profile', metavar='PATH',
+        help='Count live objects per type before and after each run and '
+             'write the growth to PATH as json, to find what a test leaks '
+             'or caches. Slows down the untimed part of each run.')
+
+    parser.add_argument(
+        '--trace', metavar='PATH',
+        help='Capture the sql statements and ftrack requests of the runs, '
+             'with their timing and threads, into the workload trace PATH '
+             '(see replay_01). Works with the thread pool of --concurrency.')
+
     parser.add_argument(
         '-v', '--verbose', action='store_true',
-        help='Print and time everything that is happening. This is for '
-             'debugging and may affect the timing slightly')
+        help='Print the time and phases of every run as it finishes.')
+
+    parser.add_argument(
+        '--no-calibrate', action='store_true',
+        help='Do not measure and subtract the harness overhead (the time '
+             'an empty test takes) from the samples.')
+
+    parser.add_argument(
+        '--local', action='store_true',
+        help='Run against a local sqlite store and stand-in ftrack server '
+             'instead of DB_URI/FTRACK_SERVER. See LOCAL_DB and LOCAL_PORT.')
+    parser.add_argument(
+        '--wan', action='store_true',
+        help='Reach the MySQL and ftrack servers through a local proxy '
+             'simulating a WAN link (WAN_LATENCY_MS, WAN_JITTER_MS, '
+             'WAN_BANDWIDTH_KBPS, WAN_LOSS and WAN_RTO_MS).')
 
     # TODO: add feature to read from .json file
     parser.add_argument(
@@ -665,6 +7996,27 @@ Query an existing project instead of creating a test one:
     return parser
 
 
+def report_comparison(name, baseline, candidate):
+    """
+    Print the comparison of two history runs of test `name` and exit with
+    status 1 if `candidate` is a regression.
+    """
+    import sys
+
+    comparison = compare_samples(
+        baseline['samples'], candidate['samples'],
+        alpha=float(global_data['COMPARE_ALPHA']),
+        threshold=float(global_data['COMPARE_THRESHOLD']))
+    print format_comparison(name, baseline, candidate, comparison)
+    if baseline['overrides'] != candidate['overrides']:
+        print 'note: global data overrides differ: {0} -> {1}'.format(*[
+            ' '.join('{0}={1}'.format(*item)
+                     for item in sorted(run['overrides'].items())) or '-'
+            for run in (baseline, candidate)])
+    if comparison['regression']:
+        sys.exit(1)
+
+
 def main(argv=None):
 
     import sys
@@ -675,6 +8027,17 @@ def main(argv=None):
     args = parser.parse_args(argv)
 
     num = args.runs
+    if args.sweep:
+        if not args.local and any(spec.split('=', 1)[0] in SIZE_KEYS
+                                  for spec in args.sweep):
+            parser.error('sweeping data sizes requires --local')
+    elif len(args.test) > 1:
+        parser.error('several tests can only be run with --sweep')
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes a baseline and optionally a candidate')
+    if args.trace and (args.sweep or
+                       (args.concurrency and args.pool == 'process')):
+        parser.error('--trace records one test, from threads only')
 
     for item in args.globals:
         var, value = item.split('=')
@@ -684,13 +8047,119 @@ def main(argv=None):
         print "Overriding {0} with {1}".format(var, value)
         global_data[var] = value
 
-    print "Running test {0}".format(args.test)
-    test_func, setup_func = gather_tests()[args.test]
-    elapsed = execx(test_func, setup=setup_func, number=num,
-                    verbose=args.verbose)
-
-    print '{0}: Total Average ({1} runs): {2:06f}'.format(args.test, num,
-                                                          elapsed / num)
+    if args.sweep:
+        points = run_sweep(args.test, args.sweep, number=num,
+                           warmup=args.warmup, local=args.local,
+                           wan=args.wan)
+        curves = fit_sweep(points, args.sweep)
+        print format_sweep_fits(curves, budget=args.budget)
+        if args.output:
+            write_sweep_results(args.output, points, curves)
+        return
+
+    test = args.test[0]
+    if args.compare:
+        baseline = load_history(global_data['HISTORY_DB'], test,
+                                args.compare[0])
+        if baseline is None:
+            parser.error('no {0} run of {1} in {2}'.format(
+                args.compare[0], test, global_data['HISTORY_DB']))
+        if len(args.compare) == 2:
+            candidate = load_history(global_data['HISTORY_DB'], test,
+                                     args.compare[1])
+            if candidate is None:
+                parser.error('no {0} run of {1} in {2}'.format(
+                    args.compare[1], test, global_data['HISTORY_DB']))
+            return report_comparison(test, baseline, candidate)
+
+    if global_data['FTRACK_CACHE'] == 'shared':
+        # before --pool process forks the workers that share it
+        ftrack_cache_store('shared')
+
+    if args.local:
+        # `setup` and the bulk loaders populate an empty store
+        start_local_backend(
+            hierarchy=test not in ('setup', 'bulk_seed', 'bulk_setup'))
+    if args.wan:
+        start_wan_proxies()
+
+    print "Running test {0} ({1} connections)".format(
+        test, global_data['CONNECTION_MODE'])
+    test_func, setup_func = gather_tests()[test]
+    if args.trace:
+        traces.install()
+        traces.enabled = True
+
+    if args.concurrency:
+        curve = load_curve(test, test_func, setup_func,
+                           args.concurrency, pool=args.pool,
+                           duration=args.duration, requests=num)
+        if args.output:
+            write_load_results(args.output, test, curve)
+        if args.trace:
+            print 'wrote {0} operations to {1}'.format(
+                write_trace(args.trace, traces.operations, test), args.trace)
+        return
+
+    memory.profile = bool(args.memory_profile)
+    profiler = None
+    if args.profile:
+        profiler = TestProfiler(
+            deterministic=args.profiler != 'sampling',
+            sampling=args.profiler != 'cprofile',
+            interval=float(global_data['PROFILE_INTERVAL']))
+    samples, overhead = run_test(test_func, setup=setup_func, number=num,
+                                 warmup=args.warmup, verbose=args.verbose,
+                                 calibrate=not args.no_calibrate,
+                                 profiler=profiler)
+    summary = summarize_samples(samples)
+    summary['overhead'], summary['phase_overhead'] = overhead
+
+    print '{0}: Total Average ({1} runs): {2:06f}'.format(test, num,
+                                                          summary['mean'])
+    print format_summary(test, summary)
+    if not args.no_calibrate:
+        print ('harness overhead: {0:.2f}us per run (subtracted), {1:.2f}us '
+               'per phase'.format(overhead[0] * 1e6, overhead[1] * 1e6))
+    phases = phase.summarize(summary['mean'])
+    if phases:
+        print format_phases(phases)
+    values = phase.summarize_values()
+    if values:
+        print format_values(values)
+    executed = statements.summarize()
+    if executed:
+        print format_statements(
+            executed, int(global_data['N_PLUS_ONE_THRESHOLD']),
+            rows=values['rows']['mean'] if 'rows' in values else None)
+    imported = imports.summarize()
+    if imported:
+        print format_imports(imported[:20])
+    if profiler is not None:
+        print format_hot_functions(profiler.hot_functions(),
+                                   sampled=not profiler.deterministic)
+        written = profiler.write(args.profile, test)
+        print 'wrote {0} profile files to {1}'.format(len(written),
+                                                      args.profile)
+    if args.memory_profile:
+        types = memory.summarize_types()
+        print format_types(types[:10])
+        write_memory_profile(args.memory_profile, test, types)
+    if args.trace:
+        print 'wrote {0} operations to {1}'.format(
+            write_trace(args.trace, traces.operations, test), args.trace)
+    if args.output:
+        write_results(args.output, test, samples, summary,
+                      warmup=args.warmup, phases=phases, values=values,
+                      statements=executed, imports=imported)
+    overrides = _public_global_data(
+        dict(item.split('=', 1) for item in args.globals))
+    run = dict(label=args.label, samples=samples, overrides=overrides)
+    if not args.no_history:
+        run['id'] = save_history(global_data['HISTORY_DB'], test, samples,
+                                 summary, overrides, label=args.label)
+    if args.compare:
+        return report_comparison(test, baseline, run)
 
 
 